@@ -0,0 +1,102 @@
+import os
+import json
+import glob
+
+# Offline batch mode: requests are rendered into OpenAI Batch-format JSONL
+# shards (also accepted by vLLM's run_batch), and the outputs are read back
+# into the run's ResultStore. The custom_id of every request is its result
+# store key, so after ingestion the normal pipeline serves every answer from
+# the store and writes the usual JSON/Excel outputs without new model calls.
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+CREATE_ARGUMENTS = {"model", "messages", "max_tokens", "temperature", "n", "response_format"}
+
+def batch_request(custom_id, model, messages, max_tokens, temperature, extra_body=None, **kwargs):
+    # `extra_body` (e.g. vLLM's guided_json) is sent as top-level body fields, like the OpenAI client does
+    body = {"model": model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature, **kwargs, **(extra_body or {})}
+    return {"custom_id": custom_id, "method": "POST", "url": CHAT_COMPLETIONS_URL, "body": body}
+
+class BatchShardWriter:
+    # Writes requests to out_dir/<prefix>_0000.jsonl, ... starting a new shard
+    # once it would exceed max_requests lines or max_bytes (the OpenAI Batch
+    # API limits are 50,000 requests and 200 MB per file).
+    def __init__(self, out_dir, prefix, max_requests=50000, max_bytes=190 * 1024**2):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.shards = []
+        self.file = None
+        self.requests = 0
+        self.bytes = 0
+
+    def open_shard(self):
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.out_dir, f"{self.prefix}_{len(self.shards):04d}.jsonl")
+        self.shards.append(path)
+        self.file = open(path, "w", encoding="utf-8")
+        self.requests = 0
+        self.bytes = 0
+
+    def add(self, request):
+        line = json.dumps(request, ensure_ascii=False) + "\n"
+        size = len(line.encode("utf-8"))
+        if self.file is None or self.requests >= self.max_requests or (self.requests and self.bytes + size > self.max_bytes):
+            self.open_shard()
+        self.file.write(line)
+        self.requests += 1
+        self.bytes += size
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.shards
+
+def read_batch_outputs(paths):
+    # Yields (custom_id, content, error) for every line of the batch output files
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                output = json.loads(line)
+                response = output.get("response")
+                if output.get("error") or response is None or response.get("status_code") != 200:
+                    yield output["custom_id"], None, output.get("error") or response
+                    continue
+                yield output["custom_id"], response["body"]["choices"][0]["message"]["content"], None
+
+def ingest_batch_outputs(output_dir, store):
+    # Stores every successful answer under its custom_id; failed requests stay
+    # missing and are queried interactively when the pipeline runs afterwards.
+    stored, failed = 0, 0
+    for custom_id, content, error in read_batch_outputs(sorted(glob.glob(os.path.join(output_dir, "*.jsonl")))):
+        if error is not None:
+            print(f"Batch request {custom_id} failed: {error}")
+            failed += 1
+            continue
+        if custom_id not in store:
+            store.put(custom_id, content)
+        stored += 1
+    return stored, failed
+
+def execute_batch_locally(shard_path, output_path, client):
+    # Stand-in for the batch service: sends every request of a shard through
+    # `client` and writes a Batch-format output file
+    with open(shard_path, "r", encoding="utf-8") as f_in, open(output_path, "w", encoding="utf-8") as f_out:
+        for i, line in enumerate(f_in):
+            request = json.loads(line)
+            body = request["body"]
+            kwargs = {key: value for key, value in body.items() if key in CREATE_ARGUMENTS}
+            extra_body = {key: value for key, value in body.items() if key not in CREATE_ARGUMENTS}
+            output = {"id": f"batch_req_{i}", "custom_id": request["custom_id"], "response": None, "error": None}
+            try:
+                response = client.chat.completions.create(**kwargs, **({"extra_body": extra_body} if extra_body else {}))
+                output["response"] = {"status_code": 200, "request_id": response.id, "body": response.model_dump()}
+            except Exception as error:
+                output["error"] = {"code": type(error).__name__, "message": str(error)}
+            f_out.write(json.dumps(output, ensure_ascii=False) + "\n")
+    return output_path
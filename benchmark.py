@@ -0,0 +1,730 @@
+import os
+import io
+import sys
+import time
+import json
+import random
+import shutil
+import zipfile
+import tempfile
+import subprocess
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from openai import OpenAI
+from instrumentation import CallRecorder, InstrumentedClient
+from llm_client import create_client
+from mock_server import DIAGNOSIS_RESPONSE, canned_responder, lognormal_latency, prompt_text, start_mock_server
+from result_store import ResultStore
+from tile_prefilter import TilePrefilter
+from tile_sources import stream_zip_tiles
+from image_index import build_image_index
+from image_preprocessing import ImagePreprocessor
+from output_parser import parse_diagnosis
+from schemas import DIAGNOSIS_FIELDS, DIAGNOSIS_FIELD_ALIASES
+import roi_detection
+
+def make_synthetic_tiles(out_dir, n_tiles, tile_bytes = 64 * 1024):
+    os.makedirs(out_dir, exist_ok = True)
+    tiles = []
+    for i in range(n_tiles):
+        path = os.path.join(out_dir, f'tile_({i * 512.0}, {i * 256.0}).jpg')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(tile_bytes))
+        tiles.append(path)
+    return tiles
+
+def benchmark_roi_throughput(n_tiles = 200, in_flight_values = (1, 4, 8, 16, 32), latency = 0.05):
+    server, base_url = start_mock_server(latency = latency)
+    client = OpenAI(api_key = 'mock', base_url = base_url)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        examples = make_synthetic_tiles(os.path.join(tmp_dir, 'examples'), 10)
+        tiles = make_synthetic_tiles(os.path.join(tmp_dir, 'tiles'), n_tiles)
+        results = {}
+        for max_in_flight in in_flight_values:
+            start = time.perf_counter()
+            n_done = sum(1 for _ in roi_detection.classify_tiles(client = client, images = tiles, example_images_ROI = examples[:6], example_images_NOT_ROI = examples[6:],
+                                                                  model_name = 'mock', max_tokens = 1000, temperature = 0.2, max_in_flight = max_in_flight))
+            elapsed = time.perf_counter() - start
+            results[max_in_flight] = n_done / elapsed
+            print(f'max_in_flight={max_in_flight:>3}: {results[max_in_flight]:8.1f} tiles/sec')
+    server.shutdown()
+    return results
+
+def benchmark_image_index(n_files = 100000, rois_per_patient = 10, n_queries = 50):
+    # Compares the old per-patient os.listdir scan against one indexed scandir pass;
+    # both must find the same ROIs for every queried patient, also when read back from the persisted index
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_dir = os.path.join(tmp_dir, 'AML_Box_1')
+        os.makedirs(image_dir)
+        patients = [f'AML_Box1_P{i:05d}' for i in range(n_files // rois_per_patient)]
+        for patient in patients:
+            for roi in range(rois_per_patient):
+                open(os.path.join(image_dir, f'{patient}_ROI_{roi}.jpg'), 'wb').close()
+        queried = patients[:n_queries]
+        
+        start = time.perf_counter()
+        listdir_images = {}
+        for patient in queried:
+            listdir_images[patient] = sorted(os.path.join(image_dir, i) for i in os.listdir(image_dir) if patient + '_' in i)
+        listdir_time = time.perf_counter() - start
+        
+        index_file = os.path.join(tmp_dir, 'image_index.json')
+        start = time.perf_counter()
+        index = build_image_index([image_dir], index_file = index_file)
+        cold_images = {patient: index[patient] for patient in queried}
+        cold_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        index = build_image_index([image_dir], index_file = index_file)
+        warm_images = {patient: index[patient] for patient in queried}
+        warm_time = time.perf_counter() - start
+        
+        for patient in queried:
+            if not listdir_images[patient] == cold_images[patient] == warm_images[patient]:
+                raise AssertionError(f'Image index and listdir disagree for {patient}')
+        
+    print(f'{n_files} files, {n_queries} patients: listdir per patient {listdir_time:.2f}s, '
+          f'index cold {cold_time:.2f}s, index from persisted file {warm_time:.2f}s')
+    return listdir_time, cold_time, warm_time
+
+def make_synthetic_jpegs(out_dir, n_images, size = 2048, seed = 23):
+    # Smooth stain-like colour field with noise, so JPEG sizes resemble real tiles
+    os.makedirs(out_dir, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    y, x = np.mgrid[0:size, 0:size] / size
+    for i in range(n_images):
+        base = np.stack([200 - 80 * np.sin(6 * x + i), 150 + 60 * np.cos(5 * y - i), 210 - 40 * x * y], axis = -1)
+        pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+        path = os.path.join(out_dir, f'tile_({i * 512.0}, {i * 256.0}).jpg')
+        Image.fromarray(pixels).save(path, quality = 95)
+        paths.append(path)
+    return paths
+
+def benchmark_preprocessing(max_sides = (None, 1536, 1024, 768, 512), jpeg_quality = 85, n_tiles = 20, latency = 0.0):
+    # Request payload size and round-trip latency of is_roi (10 examples + 1 tile) per resolution
+    server, base_url = start_mock_server(latency = latency)
+    client = OpenAI(api_key = 'mock', base_url = base_url)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        examples = make_synthetic_jpegs(os.path.join(tmp_dir, 'examples'), 10)
+        tiles = make_synthetic_jpegs(os.path.join(tmp_dir, 'tiles'), n_tiles, seed = 7)
+        for max_side in max_sides:
+            roi_detection.image_preprocessor = ImagePreprocessor(max_side = max_side, jpeg_quality = jpeg_quality) if max_side is not None else None
+            prefix = roi_detection.get_few_shot_prefix(examples[:6], examples[6:])
+            payload_bytes = len(json.dumps(roi_detection.build_roi_messages(prefix, roi_detection.encode_image(tiles[0]))))
+            start = time.perf_counter()
+            for tile in tiles:
+                roi_detection.is_roi(client = client, example_images_ROI = examples[:6], example_images_NOT_ROI = examples[6:], base64_image = roi_detection.encode_image(tile),
+                                     model_name = 'mock', max_tokens = 1000, temperature = 0.2)
+            latency_per_request = (time.perf_counter() - start) / n_tiles
+            results[max_side] = (payload_bytes, latency_per_request)
+            print(f'max_side={str(max_side):>5}: payload {payload_bytes / 1024**2:7.2f} MB, {latency_per_request * 1000:7.1f} ms/request')
+    roi_detection.image_preprocessor = None
+    server.shutdown()
+    return results
+
+GERMAN_TEXT = ('Zellreiches Knochenmark mit reichlich Markbröckelchen, die Granulopoese ist linksverschoben '
+               'und zeigt vereinzelt Pseudo-Pelger-Formen sowie hypogranuläre Myelozyten ')
+
+def make_malformed_outputs(n = 1000, seed = 23):
+    # Fuzz corpus of diagnosis outputs with the defects seen in practice: fences,
+    # unquoted values, inner quotes, trailing commas, alias keys, long free text
+    # and truncation by max_tokens
+    rng = random.Random(seed)
+    aliases = {field: alias for alias, field in DIAGNOSIS_FIELD_ALIASES.items()}
+    corpus = []
+    for _ in range(n):
+        lines = []
+        for field in DIAGNOSIS_FIELDS:
+            key = aliases[field] if field in aliases and rng.random() < 0.5 else field
+            value = GERMAN_TEXT * rng.randint(1, 40) if field == 'gedanken' else GERMAN_TEXT[:rng.randint(5, len(GERMAN_TEXT))]
+            if field == 'Blastengehalt':
+                value = f'{rng.randint(0, 90)} %'
+            if rng.random() < 0.2:
+                value = value.replace('Markbröckelchen', '"Markbröckelchen"')
+            if rng.random() < 0.3:
+                lines.append(f'"{key}": {value}')
+            else:
+                lines.append(f'"{key}": "{value}"')
+        text = '{\n' + ',\n'.join(lines) + (',\n}' if rng.random() < 0.3 else '\n}')
+        if rng.random() < 0.5:
+            text = '```json\n' + text + '\n```'
+        if rng.random() < 0.3:
+            text = text[:rng.randint(1, len(text))]
+        corpus.append(text)
+    return corpus
+
+def benchmark_output_parser(n = 2000):
+    corpus = make_malformed_outputs(n)
+    n_chars = sum(len(text) for text in corpus)
+    recovered = 0
+    start = time.perf_counter()
+    for text in corpus:
+        values, status = parse_diagnosis(text)
+        recovered += sum(1 for field_status in status.values() if field_status != 'missing')
+    elapsed = time.perf_counter() - start
+    print(f'{n} malformed outputs ({n_chars / 1e6:.1f}M chars) parsed in {elapsed:.2f}s, '
+          f'{n_chars / elapsed / 1e6:.1f}M chars/sec, {recovered / (n * len(DIAGNOSIS_FIELDS)):.1%} fields recovered')
+    # Linear scaling check on a single unquoted value of growing length
+    for length in (10**4, 10**5, 10**6):
+        text = '{"gedanken": ' + (GERMAN_TEXT * (length // len(GERMAN_TEXT)))
+        start = time.perf_counter()
+        parse_diagnosis(text)
+        print(f'  unterminated value of {length:>8} chars: {(time.perf_counter() - start) * 1000:8.1f} ms')
+    return elapsed
+
+def make_synthetic_cohort(out_dir, n_patients = 10, rois_per_patient = 10, tiles_per_patient = 30, size = 384, seed = 23):
+    # Patients x ROIs in one flat folder (All_In/Maverick layout), one tile folder
+    # per patient (roi_detection layout) and the same tiles as one zip per patient
+    rng = np.random.default_rng(seed)
+    roi_dir = os.path.join(out_dir, 'rois')
+    tile_dir = os.path.join(out_dir, 'tiles')
+    zip_dir = os.path.join(out_dir, 'zips')
+    os.makedirs(roi_dir, exist_ok = True)
+    os.makedirs(zip_dir, exist_ok = True)
+    y, x = np.mgrid[0:size, 0:size] / size
+
+    def jpeg_bytes(i):
+        base = np.stack([200 - 80 * np.sin(6 * x + i), 150 + 60 * np.cos(5 * y - i), 210 - 40 * x * y], axis = -1)
+        pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format = 'JPEG', quality = 90)
+        return buffer.getvalue()
+
+    patients = [f'AML_Box1_S{i:04d}' for i in range(n_patients)]
+    zip_files = []
+    for p, patient in enumerate(patients):
+        for r in range(rois_per_patient):
+            with open(os.path.join(roi_dir, f'{patient}_ROI_{r}.jpg'), 'wb') as f:
+                f.write(jpeg_bytes(p * rois_per_patient + r))
+        os.makedirs(os.path.join(tile_dir, patient), exist_ok = True)
+        zip_path = os.path.join(zip_dir, f'{patient}.{p:064x}.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_ref:
+            for t in range(tiles_per_patient):
+                name = f'tile_({t * 512.0}, {p * 256.0}).jpg'
+                data = jpeg_bytes(t)
+                with open(os.path.join(tile_dir, patient, name), 'wb') as f:
+                    f.write(data)
+                zip_ref.writestr(f'{patient}/{name}', data)
+        zip_files.append(zip_path)
+    return {"patients": patients, "roi_dir": roi_dir, "tile_dir": tile_dir, "zip_files": zip_files}
+
+class EncodeTimer:
+    # Sums the CPU time spent in the module's encode functions over all threads
+    # while active; nested calls (encode_tile -> encode_image) are counted once
+    def __init__(self, module, names = ('encode_image', 'encode_tile')):
+        self.module = module
+        self.names = [name for name in names if hasattr(module, name)]
+        self.cpu_time = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.originals = {}
+
+    def timed(self, encode):
+        def timed_encode(*args):
+            depth = getattr(self.local, 'depth', 0)
+            self.local.depth = depth + 1
+            start = time.thread_time()
+            try:
+                return encode(*args)
+            finally:
+                self.local.depth = depth
+                if depth == 0:
+                    with self.lock:
+                        self.cpu_time += time.thread_time() - start
+        return timed_encode
+
+    def __enter__(self):
+        for name in self.names:
+            self.originals[name] = getattr(self.module, name)
+            setattr(self.module, name, self.timed(self.originals[name]))
+        return self
+
+    def __exit__(self, *exc):
+        for name, encode in self.originals.items():
+            setattr(self.module, name, encode)
+
+def run_scenario(name, run, module, server):
+    # `run` returns the number of items processed; memory is the Python heap peak seen by tracemalloc
+    requests, failures = server.stats["requests"], server.stats["failures"]
+    tracemalloc.start()
+    with EncodeTimer(module) as timer:
+        start = time.perf_counter()
+        n_items = run()
+        elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {"scenario": name, "items": n_items, "seconds": elapsed, "items_per_sec": n_items / elapsed, "encode_cpu_sec": timer.cpu_time,
+              "peak_mb": peak / 1024**2, "requests": server.stats["requests"] - requests, "failures": server.stats["failures"] - failures}
+    print(f'{name:<15} {n_items:>5} items in {elapsed:6.2f}s ({result["items_per_sec"]:7.1f}/s), encode CPU {timer.cpu_time:5.2f}s, '
+          f'peak {result["peak_mb"]:7.1f} MB, {result["requests"]} requests ({result["failures"]} simulated failures)')
+    return result
+
+def benchmark_pipelines(n_patients = 10, tiles_per_patient = 30, latency_median = 0.2, tokens_per_second = 200, failure_rate = 0.02,
+                        max_in_flight = 8, seed = 23):
+    # End-to-end scenarios for the three pipelines against the mock server, with
+    # lognormal latency, token-paced generation and retried simulated failures
+    import evaluate_AML_All_In as all_in
+    import evaluate_AML_Maverick as maverick
+    server, base_url = start_mock_server(responder = canned_responder, latency = lognormal_latency(latency_median), tokens_per_second = tokens_per_second,
+                                         failure_rate = failure_rate, seed = seed)
+    client = create_client('mock', base_url, backoff_base = 0.05, backoff_max = 1.0)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cohort = make_synthetic_cohort(tmp_dir, n_patients = n_patients, tiles_per_patient = tiles_per_patient, seed = seed)
+        tiles = [os.path.join(cohort["tile_dir"], patient, name) for patient in cohort["patients"]
+                 for name in sorted(os.listdir(os.path.join(cohort["tile_dir"], patient)))]
+        examples = tiles[:10]
+
+        def roi_directory():
+            return sum(1 for _ in roi_detection.classify_tiles(client, tiles, examples[:6], examples[6:], 'mock', 1000, 0.2, max_in_flight = max_in_flight))
+
+        def roi_zip_stream():
+            return sum(1 for _ in roi_detection.classify_tiles(client, stream_zip_tiles(cohort["zip_files"]), examples[:6], examples[6:], 'mock', 1000, 0.2,
+                                                               max_in_flight = max_in_flight))
+
+        def all_in_diagnosis():
+            for patient in cohort["patients"]:
+                encoded_images = [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{all_in.encode_image(path)}"}}
+                                  for path in all_in.load_images(image_dir = cohort["roi_dir"], patient = patient)]
+                all_in.generate_diagnose(encoded_images = encoded_images, client = client, model_name = 'mock', max_tokens = 2000, temperature = 0.2)
+            return len(cohort["patients"])
+
+        def maverick_pipeline():
+            out_dir = os.path.join(tmp_dir, 'maverick')
+            os.makedirs(out_dir, exist_ok = True)
+            store = ResultStore(os.path.join(out_dir, 'results_store.jsonl'))
+            with ThreadPoolExecutor(max_workers = 5 * max_in_flight) as roi_executor, ThreadPoolExecutor(max_workers = 4) as patient_executor:
+                futures = [patient_executor.submit(maverick.process_patient, client, patient, cohort["roi_dir"], roi_executor, 'mock', store, out_dir, out_dir)
+                           for patient in cohort["patients"]]
+                for future in futures:
+                    future.result()
+            return len(cohort["patients"])
+
+        results.append(run_scenario('roi_directory', roi_directory, roi_detection, server))
+        roi_detection.few_shot_cache.clear()
+        results.append(run_scenario('roi_zip_stream', roi_zip_stream, roi_detection, server))
+        results.append(run_scenario('all_in', all_in_diagnosis, all_in, server))
+        results.append(run_scenario('maverick', maverick_pipeline, maverick, server))
+    server.shutdown()
+    return results
+
+def make_triage_tiles(n_tiles = 200, background_share = 0.6, blurred_share = 0.1, size = 512, seed = 23):
+    # (kind, JPEG bytes) for a slide-like mix of white background, blurred tissue and sharp tissue tiles
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    tiles = []
+    for i in range(n_tiles):
+        draw = rng.random()
+        if draw < background_share:
+            kind = 'background'
+            pixels = np.full((size, size, 3), 242.0) + rng.normal(0, 3, (size, size, 3))
+        else:
+            kind = 'blurred' if draw < background_share + blurred_share else 'tissue'
+            base = np.stack([170 - 70 * np.sin(9 * x + i), 90 + 50 * np.cos(7 * y - i), 170 - 40 * x * y], axis = -1)
+            pixels = base + rng.normal(0, 30, base.shape)
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        if kind == 'blurred':
+            image = image.filter(ImageFilter.GaussianBlur(6))
+        buffer = io.BytesIO()
+        image.save(buffer, format = 'JPEG', quality = 90)
+        tiles.append((kind, buffer.getvalue()))
+    return tiles
+
+def benchmark_prefilter(n_tiles = 200, auto_accept = False):
+    # Time per tile of the local triage and the share of tiles that still need a model call
+    tiles = make_triage_tiles(n_tiles)
+    prefilter = TilePrefilter(auto_accept = auto_accept)
+    decisions = {}
+    start = time.perf_counter()
+    for kind, data in tiles:
+        decision = prefilter.check(data)[0]
+        decisions[(kind, decision)] = decisions.get((kind, decision), 0) + 1
+    elapsed = time.perf_counter() - start
+    stats = prefilter.stats()
+    print(f'{n_tiles} tiles triaged in {elapsed:.2f}s ({elapsed / n_tiles * 1000:.1f} ms/tile), '
+          f'{stats["model_call_fraction"]:.0%} still sent to the model')
+    for (kind, decision), count in sorted(decisions.items()):
+        print(f'  {kind:<10} -> {decision:<6} {count:>4}')
+    return stats
+
+def benchmark_roi_batching(k_values = (1, 2, 4, 8, 16), n_tiles = 96, latency = 0.1, tokens_per_second = 100, prompt_tokens_per_second = 20000,
+                           max_in_flight = 8):
+    # Tiles/sec and tokens per tile of is_roi with K tiles per request; prefill is
+    # simulated, so the shared few-shot context shows up in latency as well as tokens
+    server, base_url = start_mock_server(responder = canned_responder, latency = latency, tokens_per_second = tokens_per_second,
+                                         prompt_tokens_per_second = prompt_tokens_per_second)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        examples = make_synthetic_tiles(os.path.join(tmp_dir, 'examples'), 10)
+        tiles = make_synthetic_tiles(os.path.join(tmp_dir, 'tiles'), n_tiles)
+        for k in k_values:
+            recorder = CallRecorder()
+            client = InstrumentedClient(OpenAI(api_key = 'mock', base_url = base_url), recorder)
+            start = time.perf_counter()
+            n_done = sum(1 for _ in roi_detection.classify_tiles(client, tiles, examples[:6], examples[6:], 'mock', 1000, 0.2, max_in_flight = max_in_flight,
+                                                                  tiles_per_request = k))
+            elapsed = time.perf_counter() - start
+            tokens = sum(row["Prompt_Tokens"] + row["Completion_Tokens"] for row in recorder.summary())
+            requests = sum(row["Requests"] for row in recorder.summary())
+            results[k] = (n_done / elapsed, tokens / n_done)
+            print(f'K={k:>3}: {results[k][0]:7.1f} tiles/sec, {results[k][1]:8.0f} tokens/tile, {requests} requests')
+    server.shutdown()
+    return results
+
+class SlowDisk:
+    # Adds a fixed delay to every image read/encode of `module`, standing in for /mnt/bulk-* latency
+    def __init__(self, module, names, delay):
+        self.module = module
+        self.names = names
+        self.delay = delay
+        self.originals = {}
+
+    def __enter__(self):
+        for name in self.names:
+            original = self.originals[name] = getattr(self.module, name)
+            def slow(*args, original = original, **kwargs):
+                time.sleep(self.delay)
+                return original(*args, **kwargs)
+            setattr(self.module, name, slow)
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self.originals.items():
+            setattr(self.module, name, original)
+
+def benchmark_prefetch(n_patients = 8, n_tiles = 1000, disk_latency = 0.02, latency = 0.1, max_in_flight = 8, budget_mb = 8):
+    # Items/sec with and without read-ahead when every image read costs `disk_latency`,
+    # and the Python heap peak over a large tile set with a small prefetch budget
+    import evaluate_AML_All_In as all_in
+    from prefetch import Prefetcher
+    server, base_url = start_mock_server(responder = canned_responder, latency = latency)
+    client = OpenAI(api_key = 'mock', base_url = base_url)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cohort = make_synthetic_cohort(tmp_dir, n_patients = n_patients, tiles_per_patient = 1)
+        tiles = make_synthetic_tiles(os.path.join(tmp_dir, 'tiles'), n_tiles)
+        examples = tiles[:10]
+        store = ResultStore(os.path.join(tmp_dir, 'results_store.jsonl'))
+
+        def all_in_run(prefetcher):
+            prepare = lambda patient: all_in.prepare_patient(patient, cohort["roi_dir"], 'mock', 'prefetch', store)
+            prepared = prefetcher.iterate(cohort["patients"], prepare) if prefetcher is not None else ((patient, prepare(patient)) for patient in cohort["patients"])
+            for patient, (key, encoded_images) in prepared:
+                all_in.generate_diagnose(encoded_images = encoded_images, client = client, model_name = 'mock', max_tokens = 2000, temperature = 0.2)
+            return n_patients
+
+        def roi_run(prefetcher):
+            return sum(1 for _ in roi_detection.classify_tiles(client, tiles, examples[:6], examples[6:], 'mock', 1000, 0.2, max_in_flight = max_in_flight,
+                                                               prefetcher = prefetcher))
+
+        for name, run, module, encoder in (("all_in", all_in_run, all_in, 'encode_image'), ("roi_tiles", roi_run, roi_detection, 'encode_tile')):
+            roi_detection.get_few_shot_prefix(examples[:6], examples[6:])
+            for label, prefetcher in (("inline", None), ("prefetch", Prefetcher(budget_mb * 1024**2, max_workers = 8))):
+                with SlowDisk(module, [encoder], disk_latency):
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    n_items = run(prefetcher)
+                    elapsed = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                results[(name, label)] = (n_items / elapsed, peak / 1024**2)
+                print(f'{name:<10} {label:<9}: {n_items / elapsed:7.1f} items/sec, heap peak {peak / 1024**2:6.1f} MB'
+                      + (f', {prefetcher.stats()}' if prefetcher is not None else ''))
+    server.shutdown()
+    return results
+
+def benchmark_tile_sampling(grid_size = 40, target_rois = 30, stride = 4, latency = 0.05, max_in_flight = 8, seed = 23):
+    # Model calls and ROIs found with coarse-to-fine sampling versus classifying every
+    # tile, on a slide whose ROIs sit in a few blob-shaped marrow particle areas
+    from tile_sampling import sample_slide
+    rng = random.Random(seed)
+    blobs = [(rng.uniform(0, grid_size), rng.uniform(0, grid_size), rng.uniform(2, 4)) for _ in range(4)]
+    positives = set()
+
+    def responder(payload):
+        url = payload["messages"][-1]["content"][-1]["image_url"]["url"]
+        return json.dumps({"Thoughts": "", "ROI": "Yes" if url.split(',', 1)[1] in positives else "No"})
+
+    server, base_url = start_mock_server(responder = responder, latency = latency)
+    client = OpenAI(api_key = 'mock', base_url = base_url)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        examples = make_synthetic_tiles(os.path.join(tmp_dir, 'examples'), 10)
+        slide_dir = os.path.join(tmp_dir, 'AML_Box1_S0000')
+        os.makedirs(slide_dir)
+        tiles = []
+        for column in range(grid_size):
+            for row in range(grid_size):
+                path = os.path.join(slide_dir, f'tile_({column * 512.0 + 37.5}, {row * 512.0 + 11.25}).jpg')
+                data = os.urandom(1024)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                if any((column - x) ** 2 + (row - y) ** 2 <= r ** 2 for x, y, r in blobs):
+                    positives.add(roi_detection.base64.b64encode(data).decode('utf-8'))
+                tiles.append(path)
+        classify = lambda images: roi_detection.classify_tiles(client, images, examples[:6], examples[6:], 'mock', 1000, 0.2, max_in_flight = max_in_flight)
+        for label, run in (("all tiles", lambda: ((tile, response, triage, 'classified') for tile, response, triage in classify(tiles))),
+                           ("coarse-to-fine", lambda: sample_slide(tiles, classify, target_rois, stride))):
+            requests = server.stats["requests"]
+            start = time.perf_counter()
+            stages = {}
+            rois = 0
+            for tile, response, triage, stage in run():
+                stages[stage] = stages.get(stage, 0) + 1
+                rois += response is not None and '"Yes"' in response
+            elapsed = time.perf_counter() - start
+            calls = server.stats["requests"] - requests
+            results[label] = (calls, rois, elapsed)
+            print(f'{label:<15}: {calls:5d} model calls, {rois:4d} ROIs found ({len(positives)} on the slide), {elapsed:6.2f}s, {stages}')
+    server.shutdown()
+    return results
+
+def make_cell_tile(rng, size = 512):
+    # Pink background with randomly placed stained nuclei, so every tile has its own structure
+    image = Image.new('RGB', (size, size), (232, 190, 205))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(40, 120)):
+        x, y, r = rng.uniform(0, size), rng.uniform(0, size), rng.uniform(6, 22)
+        tone = rng.randint(60, 140)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill = (tone, tone // 2, tone + 60))
+    buffer = io.BytesIO()
+    image.filter(ImageFilter.GaussianBlur(1)).save(buffer, format = 'JPEG', quality = 90)
+    return buffer.getvalue()
+
+def benchmark_tile_dedup(n_unique = 120, duplicate_share = 0.4, threshold = 4, latency = 0.05, max_in_flight = 8, seed = 23):
+    # Model calls with and without perceptual-hash grouping on a patient whose tiles
+    # include exact and re-encoded copies (as from re-extracted archives), and how
+    # many distinct tiles were wrongly merged; a second pass reuses the index
+    from tile_dedup import TileDeduplicator
+    rng = random.Random(seed)
+    server, base_url = start_mock_server(responder = canned_responder, latency = latency)
+    client = OpenAI(api_key = 'mock', base_url = base_url)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        examples = make_synthetic_tiles(os.path.join(tmp_dir, 'examples'), 10)
+        slide_dir = os.path.join(tmp_dir, 'AML_Box1_S0000')
+        os.makedirs(slide_dir)
+        tiles = []
+        origin = {}
+        for i in range(n_unique):
+            data = make_cell_tile(rng)
+            copies = [data]
+            if rng.random() < duplicate_share:
+                with Image.open(io.BytesIO(data)) as image:
+                    buffer = io.BytesIO()
+                    image.save(buffer, format = 'JPEG', quality = rng.randint(70, 90))
+                copies.append(buffer.getvalue() if rng.random() < 0.5 else data)
+            for c, copy in enumerate(copies):
+                path = os.path.join(slide_dir, f'tile_({i * 512.0}, {c * 512.0}).jpg')
+                with open(path, 'wb') as f:
+                    f.write(copy)
+                tiles.append(path)
+                origin[path] = i
+        rng.shuffle(tiles)
+        store = ResultStore(os.path.join(tmp_dir, 'results_store.jsonl'))
+        index_path = os.path.join(tmp_dir, 'tile_hash_index.jsonl')
+        for label in ("every tile", "phash groups", "next run"):
+            # Created per pass, so the next run loads the index the previous pass wrote
+            dedup = TileDeduplicator(index_path, threshold) if label != "every tile" else None
+            # The next run sees the duplicates under new names, as from a re-extracted archive
+            run_tiles = tiles
+            if label == "next run":
+                run_tiles = []
+                for tile in tiles:
+                    renamed = tile.replace('.jpg', '_rerun.jpg')
+                    shutil.copy(tile, renamed)
+                    origin[renamed] = origin[tile]
+                    run_tiles.append(renamed)
+            requests = server.stats["requests"]
+            start = time.perf_counter()
+            merged = 0
+            for tile, response, triage in roi_detection.classify_tiles(client, run_tiles, examples[:6], examples[6:], 'mock', 1000, 0.2, max_in_flight = max_in_flight,
+                                                                       store = store if dedup is not None else None, prompt_hash = 'dedup', dedup = dedup):
+                if triage is not None and triage.get("Duplicate_Of") is not None:
+                    merged += origin[tile] != origin[triage["Duplicate_Of"]]
+            elapsed = time.perf_counter() - start
+            calls = server.stats["requests"] - requests
+            results[label] = (calls, merged, elapsed)
+            print(f'{label:<13}: {len(run_tiles)} tiles ({n_unique} distinct), {calls} model calls, {merged} distinct tiles merged, {elapsed:5.2f}s'
+                  + (f', {dedup.stats()}' if dedup is not None else ''))
+    server.shutdown()
+    return results
+
+def long_thoughts_responder(payload):
+    # is_roi answers with a few sentences of reasoning, in the order the prompt asks for
+    thoughts = "Gut fokussiert, gleichmäßig verteilte Zellen mit erkennbaren Vorstufen der Erythro- und Granulopoese. " * 4
+    if '{"ROI"' in prompt_text(payload):
+        return json.dumps({"ROI": "Yes", "Thoughts": thoughts}, ensure_ascii = False)
+    return json.dumps({"Thoughts": thoughts, "ROI": "Yes"}, ensure_ascii = False)
+
+def benchmark_roi_streaming(n_tiles = 48, latency = 0.1, tokens_per_second = 100, max_in_flight = 8):
+    # Time-to-decision per tile and generated characters per tile for the non-streaming
+    # is_roi, streaming with the full reasoning, and streams closed after the decision
+    server, base_url = start_mock_server(responder = long_thoughts_responder, latency = latency, tokens_per_second = tokens_per_second)
+    configs = [("blocking", None), ("stream, full thoughts", (False, None)), ("stream, cancel after decision", (False, 0)),
+               ("decision first, 80 chars", (True, 80)), ("decision first, no thoughts", (True, 0))]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        examples = make_synthetic_tiles(os.path.join(tmp_dir, 'examples'), 10)
+        tiles = make_synthetic_tiles(os.path.join(tmp_dir, 'tiles'), n_tiles)
+        for label, config in configs:
+            streaming = roi_detection.RoiStreaming(*config) if config is not None else None
+            recorder = CallRecorder()
+            client = InstrumentedClient(OpenAI(api_key = 'mock', base_url = base_url), recorder)
+            chars_before = server.stats["completion_chars"]
+            start = time.perf_counter()
+            n_done = sum(1 for _ in roi_detection.classify_tiles(client, tiles, examples[:6], examples[6:], 'mock', 1000, 0.2, max_in_flight = max_in_flight,
+                                                                  streaming = streaming))
+            elapsed = time.perf_counter() - start
+            if streaming is not None:
+                time_to_decision = streaming.stats()["time_to_decision_p50"]
+            else:
+                time_to_decision = recorder.summary()[0]["Latency_p50"]
+            chars = (server.stats["completion_chars"] - chars_before) / n_done
+            results[label] = (time_to_decision, n_done / elapsed, chars)
+            print(f'{label:<30}: decision after {time_to_decision:.3f}s (p50), {n_done / elapsed:6.1f} tiles/sec, {chars:5.0f} chars generated/tile')
+    server.shutdown()
+    return results
+
+def sampled_diagnosis_responder(payload):
+    # Diagnoses as sampled at a higher temperature: mostly the same category, Blastengehalt scattered around 40 %
+    # Seeded requests are reproducible per patient (the last image stands for the patient)
+    rng = random.Random(f'{payload["seed"]}:{prompt_text(payload)}:{str(payload["messages"][-1]["content"][-1])[-64:]}') if payload.get("seed") is not None else random
+    diagnose = json.loads(DIAGNOSIS_RESPONSE)
+    diagnose["Blastengehalt"] = f'{rng.choice([30, 35, 40, 40, 45, 50, 60])} %'
+    if rng.random() < 0.25:
+        diagnose["Diagnose"] = "Verdacht auf myelodysplastisches Syndrom mit Blastenvermehrung"
+    return json.dumps(diagnose, ensure_ascii = False)
+
+def benchmark_self_consistency(n_patients = 6, n_samples = 5, latency = 0.05, tokens_per_second = 1000, prompt_tokens_per_second = 20000):
+    # Time, prefill tokens and uploaded bytes per patient for n_samples diagnoses as sequential reruns,
+    # as concurrent single requests (server without `n`) and as one request with n choices
+    import evaluate_AML_All_In as all_in
+    import llm_client
+    from self_consistency import aggregate_diagnoses
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cohort = make_synthetic_cohort(tmp_dir, n_patients = n_patients, tiles_per_patient = 1)
+        store = ResultStore(os.path.join(tmp_dir, 'results_store.jsonl'))
+        encoded = [all_in.prepare_patient(patient, cohort["roi_dir"], 'mock', 'consistency', store)[1] for patient in cohort["patients"]]
+        for label, supports_n in (("sequential reruns", True), ("concurrent, server without n", False), ("one request, n choices", True)):
+            server, base_url = start_mock_server(responder = sampled_diagnosis_responder, latency = latency, tokens_per_second = tokens_per_second,
+                                                 prompt_tokens_per_second = prompt_tokens_per_second, supports_n = supports_n)
+            client = OpenAI(api_key = 'mock', base_url = base_url)
+            llm_client.unsupported_n_models.clear()
+            dispersions = []
+            start = time.perf_counter()
+            for encoded_images in encoded:
+                if label == "sequential reruns":
+                    samples = [all_in.generate_diagnose(encoded_images, client, 'mock', 2000, 0.7, seed = seed) for seed in range(n_samples)]
+                else:
+                    samples = all_in.generate_diagnose_samples(encoded_images, client, 'mock', 2000, 0.7, n_samples)
+                dispersions.append(aggregate_diagnoses(samples)[1]["Dispersion"])
+            elapsed = time.perf_counter() - start
+            results[label] = (elapsed / n_patients, server.stats["prompt_tokens"] / n_patients, server.stats["request_bytes"] / n_patients)
+            print(f'{label:<29}: {results[label][0]:5.2f}s/patient, {server.stats["requests"] / n_patients:4.1f} requests/patient, '
+                  f'{results[label][1]:7.0f} prefill tokens/patient, {results[label][2] / 1024**2:5.2f} MB sent/patient, '
+                  f'mean dispersion Diagnose {np.mean([d["Diagnose"] for d in dispersions]):.2f}, '
+                  f'Blastengehalt {np.mean([d["Blastengehalt"] for d in dispersions]):.1f} pp')
+            server.shutdown()
+    return results
+
+def benchmark_results_table_crash(n_rows = 5, batch_size = 2):
+    # Rows readable from a results table whose writer process died without close(): every flushed batch should survive
+    from results_table import iter_table_rows
+    script = ("import os, sys; from mock_server import DIAGNOSIS_RESPONSE; from results_table import ResultsTable\n"
+              "table = ResultsTable(sys.argv[1], batch_size = int(sys.argv[2]))\n"
+              "for i in range(int(sys.argv[3])): table.add_diagnosis(f'P{i}', DIAGNOSIS_RESPONSE)\n"
+              "os._exit(1)\n")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in ('results.csv', 'results.parquet'):
+            path = os.path.join(tmp_dir, name)
+            subprocess.run([sys.executable, '-c', script, path, str(batch_size), str(n_rows)], cwd = os.path.dirname(os.path.abspath(__file__)))
+            results[name] = sum(1 for _ in iter_table_rows(path))
+            print(f'{name:<16}: {results[name]} of {n_rows} rows readable after a crash ({n_rows // batch_size * batch_size} flushed)')
+    return results
+
+def benchmark_batch_round_trip(n_tiles = 40, n_patients = 4, latency = 0.01):
+    # Offline batch mode end to end with execute_batch_locally standing in for the batch service:
+    # write the shards, execute them against the mock server, ingest the outputs, then run the
+    # interactive pipeline, which must be served from the store without any further model calls
+    import evaluate_AML_All_In as all_in
+    from batch_inference import execute_batch_locally, ingest_batch_outputs
+    server, base_url = start_mock_server(responder = canned_responder, latency = latency)
+    client = OpenAI(api_key = 'mock', base_url = base_url)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        examples = make_synthetic_tiles(os.path.join(tmp_dir, 'examples'), 10)
+        tiles = make_synthetic_tiles(os.path.join(tmp_dir, 'tiles'), n_tiles)
+        # A byte-identical copy of the first tile shares its key and must not repeat its custom_id
+        duplicate = os.path.join(tmp_dir, 'tiles', 'tile_(-512.0, -256.0).jpg')
+        shutil.copyfile(tiles[0], duplicate)
+        tiles.append(duplicate)
+        cohort = make_synthetic_cohort(os.path.join(tmp_dir, 'cohort'), n_patients = n_patients, tiles_per_patient = 1)
+        roi_hash = roi_detection.roi_prompt_hash(examples[:6], examples[6:])
+        diagnose_hash = 'batch-diagnose'
+
+        def roi_pipeline(store, client):
+            return sum(1 for _ in roi_detection.classify_tiles(client, tiles, examples[:6], examples[6:], 'mock', 1000, 0.2, store = store, prompt_hash = roi_hash))
+
+        def diagnose_pipeline(store, client):
+            for patient in cohort["patients"]:
+                key, encoded_images = all_in.prepare_patient(patient, cohort["roi_dir"], 'mock', diagnose_hash, store)
+                if encoded_images is not None:
+                    store.put(key, all_in.generate_diagnose(encoded_images, client, 'mock', 2000, 0.2))
+            return len(cohort["patients"])
+
+        scenarios = [
+            ("roi", lambda store, batch_dir: roi_detection.write_roi_batch(tiles, examples[:6], examples[6:], 'mock', 1000, 0.2, store, roi_hash, batch_dir),
+             roi_pipeline),
+            ("diagnose", lambda store, batch_dir: all_in.write_diagnose_batch(cohort["patients"], cohort["roi_dir"], 'mock', diagnose_hash, store, batch_dir),
+             diagnose_pipeline),
+        ]
+        for name, write_batch, pipeline in scenarios:
+            run_dir = os.path.join(tmp_dir, name)
+            os.makedirs(os.path.join(run_dir, 'batch_outputs'))
+            store = ResultStore(os.path.join(run_dir, 'results_store.jsonl'))
+            shards = write_batch(store, os.path.join(run_dir, 'batch_requests'))
+            custom_ids = []
+            for shard in shards:
+                with open(shard, encoding = 'utf-8') as f:
+                    custom_ids.extend(json.loads(line)["custom_id"] for line in f)
+            if len(custom_ids) != len(set(custom_ids)):
+                raise AssertionError(f'{name}: {len(custom_ids) - len(set(custom_ids))} repeated custom_id(s) in the batch shards')
+            requests_before = server.stats["requests"]
+            for shard in shards:
+                execute_batch_locally(shard, os.path.join(run_dir, 'batch_outputs', os.path.basename(shard)), client)
+            executed = server.stats["requests"] - requests_before
+            stored, failed = ingest_batch_outputs(os.path.join(run_dir, 'batch_outputs'), store)
+            recorder = CallRecorder()
+            n_items = pipeline(store, InstrumentedClient(client, recorder))
+            calls = sum(row["Requests"] for row in recorder.summary())
+            if calls:
+                raise AssertionError(f'{name}: {calls} model calls after ingesting the batch outputs')
+            results[name] = (executed, stored, failed, calls)
+            print(f'{name:<9}: {len(shards)} shard(s), {executed} requests executed, {stored} ingested, {failed} failed, '
+                  f'{calls} model calls for {n_items} items afterwards')
+    server.shutdown()
+    return results
+
+if __name__ == "__main__":
+    benchmark_roi_throughput()
+    benchmark_image_index()
+    benchmark_preprocessing()
+    benchmark_output_parser()
+    benchmark_pipelines()
+    benchmark_prefilter()
+    benchmark_roi_batching()
+    benchmark_roi_streaming()
+    benchmark_prefetch()
+    benchmark_tile_sampling()
+    benchmark_tile_dedup()
+    benchmark_self_consistency()
+    benchmark_results_table_crash()
+    benchmark_batch_round_trip()
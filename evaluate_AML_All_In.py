@@ -2,7 +2,8 @@
 import os
 from tqdm import tqdm
 import json
-from openai import OpenAI
+from llm_client import create_choices, create_client, create_structured
+from instrumentation import CallRecorder, InstrumentedClient
 import pandas as pd
 import base64
 from datetime import datetime
@@ -10,7 +11,16 @@ import shutil
 import csv
 from pathlib import Path
 import torch
-import re
+from image_preprocessing import ImagePreprocessor
+from image_index import get_image_index
+from response_cache import ResponseCache, CachingClient
+from result_store import ResultStore, get_run_dir, hash_files, hash_messages, make_key, write_json_atomic
+from results_table import CONSISTENCY_FLOAT_FIELDS, CONSISTENCY_RESULT_FIELDS, RESULT_FIELDS, ResultsTable, export_excel
+from schemas import DIAGNOSIS_JSON_SCHEMA, structured_output_kwargs
+from batch_inference import BatchShardWriter, batch_request, ingest_batch_outputs
+from prefetch import Prefetcher
+from self_consistency import aggregate_diagnoses, consistency_columns
+from concurrent.futures import ThreadPoolExecutor
 
 # Function to get video names using multiple filters 
 def get_patient_names(clini_table):
@@ -24,18 +34,21 @@ def get_patient_names(clini_table):
     return patients
 
 def load_images(image_dir, patient):
-    images = os.listdir(image_dir)
-    images = [i for i in images if patient+ '_' in i]
-    images = [os.path.join(image_dir, i) for i in images]
+    images = get_image_index(image_dir).get(patient, [])
     if not len(images) == 10:
         raise ValueError(f"Patient {patient} has {len(images)} images, expected 10.")
     return images
 
+# Optional ImagePreprocessor applied before base64 encoding, set in __main__
+image_preprocessor = None
+
 def encode_image(image_path):
+    if image_preprocessor is not None:
+        return image_preprocessor.encode(image_path)
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
-def generate_diagnose (encoded_images, client, model_name, max_tokens, temperature):
+def build_diagnose_messages(encoded_images):
     
     messages=[
         {
@@ -93,61 +106,68 @@ def generate_diagnose (encoded_images, client, model_name, max_tokens, temperatu
             ]
         }
     ]
+    return messages
+
+def generate_diagnose (encoded_images, client, model_name, max_tokens, temperature, structured_output = None, seed = None):
     
-    response = client.chat.completions.create(
+    messages = build_diagnose_messages(encoded_images)
+    response = create_structured(client, structured_output, DIAGNOSIS_JSON_SCHEMA, 'diagnosis',
                 model=model_name,
                 messages = messages,
                 max_tokens = max_tokens,
                 temperature = temperature, 
+                **({"seed": seed} if seed is not None else {}),
             )
     file_content = response.choices[0].message.content
     return file_content
 
-import re
-import json
-
-def fix_json_string(raw_text):
-    # Step 1: Cleanup markdown markers and leading/trailing whitespace
-    raw_text = raw_text.strip()
-    raw_text = re.sub(r'^```json\n?', '', raw_text)
-    raw_text = re.sub(r'\n```$', '', raw_text)
-
-    # Step 2: Fix unquoted values
-    def replacer(match):
-        key = match.group(1)
-        value = match.group(2).strip()
-
-        if re.match(r'^-?\d+(\.\d+)?$', value) or value in ['true', 'false', 'null']:
-            return f'"{key}": {value}'
-        elif value.startswith('"') and value.endswith('"'):
-            return f'"{key}": {value}'  # already quoted
-        else:
-            value = value.replace('"', '\\"')
-            return f'"{key}": "{value}"'
-
-    # Handles cases where value is not quoted properly
-    pattern = r'"([^"]+)"\s*:\s*([^",\n]+(?:\s[^",\n]+)*)'
-    fixed_text = re.sub(pattern, replacer, raw_text)
+def generate_diagnose_samples(encoded_images, client, model_name, max_tokens, temperature, n, structured_output = None):
+    # n diagnoses of one patient for self-consistency. One request with n choices shares the prefill of the 10 images;
+    # from servers that reject or ignore `n` the missing samples come from concurrent single requests reusing the
+    # encoded images, each with its own seed (identical requests would all get the one cached response)
+    samples = create_choices(client, structured_output, DIAGNOSIS_JSON_SCHEMA, 'diagnosis', n, model = model_name,
+                             messages = build_diagnose_messages(encoded_images), max_tokens = max_tokens, temperature = temperature)
+    if len(samples) < n:
+        with ThreadPoolExecutor(max_workers = n - len(samples)) as executor:
+            samples += executor.map(lambda seed: generate_diagnose(encoded_images, client, model_name, max_tokens, temperature, structured_output, seed = seed),
+                                    range(len(samples), n))
+    return samples[:n]
 
-    # Step 3: Remove trailing commas before closing braces/brackets
-    fixed_text = re.sub(r',\s*([}\]])', r'\1', fixed_text)
-
-    # Step 4: Try loading into JSON
-    try:
-        return json.loads(fixed_text)
-    except json.JSONDecodeError as e:
-        print("❌ JSON decode error:", e)
-        print("🛠 Fixed text preview:\n", fixed_text[:500])
-        raise
+def prepare_patient(patient, image_dir, model_name, prompt_hash, store):
+    # Lists, hashes and (unless the store already has the answer) encodes a patient's ROIs; returns (key, encoded_images)
+    images = load_images(image_dir = image_dir, patient = patient)
+    key = make_key(patient, hash_files(images), model_name, prompt_hash)
+    if key in store:
+        return key, None
+    encoded_images = [
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(path)}"}}
+        for path in images
+    ]
+    return key, encoded_images
 
+def write_diagnose_batch(patients, image_dir, model_name, prompt_hash, store, batch_dir, structured_output = None):
+    # Renders the diagnosis request of every patient not yet in the store into batch shards
+    writer = BatchShardWriter(batch_dir, 'diagnose')
+    for patient in tqdm(patients):
+        images = load_images(image_dir = image_dir, patient = patient)
+        key = make_key(patient, hash_files(images), model_name, prompt_hash)
+        if key in store:
+            continue
+        encoded_images = [
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(path)}"}}
+            for path in images
+        ]
+        writer.add(batch_request(key, model_name, build_diagnose_messages(encoded_images), max_tokens = 2000, temperature = 0.2,
+                                 **structured_output_kwargs(DIAGNOSIS_JSON_SCHEMA, 'diagnosis', structured_output)))
+    return writer.close()
 
-def write_results_to_csv(input_dir, output_file):
-    input_dir = Path(input_dir)
-    rows = []
-    all_keys = set()
+def write_results_to_csv(input_dir, output_file, table_path = None):
+    # Rebuilds the results table from the diagnose JSONs one file at a time and exports it to Excel
+    table_path = table_path or os.path.splitext(output_file)[0] + '.parquet'
+    results_table = ResultsTable(table_path)
 
     # Loop through all JSON files
-    for file in input_dir.glob("*.json"):
+    for file in Path(input_dir).glob("*.json"):
         print(file)
         with open(file, "r", encoding="utf-8") as f:
             data = json.load(f)
@@ -155,35 +175,10 @@ def write_results_to_csv(input_dir, output_file):
         patient_id = data.get("Patient", file.stem)
         patient_id = patient_id.replace('_ROIs.json', '')
         
-        # Step 1: Get the Diagnose or Ergebnis field
-        raw_diagnose = data.get("Ergebnis")
-
-        # Step 2: Clean up Markdown formatting from Diagnose
-        if raw_diagnose.startswith("```json"):
-            raw_diagnose = raw_diagnose.strip("`").strip()
-            first_newline = raw_diagnose.find('\n')
-            raw_diagnose = raw_diagnose[first_newline+1:]  # Skip first line
-            if raw_diagnose.endswith("```"):
-                raw_diagnose = raw_diagnose.rsplit("```", 1)[0]
-
-        # Step 3: Parse the cleaned JSON string
-        try:
-            diagnose_dict = json.loads(raw_diagnose)
-        except:
-            
-            diagnose_dict = fix_json_string(raw_diagnose)
-            
-
-        # Add patient as a separate column
-        diagnose_dict["Patient"] = patient_id
-        all_keys.update(diagnose_dict.keys())
-        rows.append(diagnose_dict)
-
-    # Assuming you already have a list of dicts in `rows` and all keys in `fieldnames`
-    df = pd.DataFrame(rows)
+        results_table.add_diagnosis(patient_id, data.get("Ergebnis"))
 
-    df = df[["Patient"] + [col for col in df.columns if col != "Patient"]]
-    df.to_excel(output_file, index=False)
+    results_table.close()
+    export_excel(table_path, output_file)
 
         
 # main function
@@ -193,6 +188,34 @@ if __name__ == "__main__":
     IMG_DIR = '/mnt/bulk-saturn/chiara/chiara/03_WSI/ROIs_manuell_Lara/AML_Box_1'
     
     only_generate_csv = False
+    # 'interactive' queries the server directly; 'batch_submit' writes OpenAI Batch JSONL shards to <run>/batch_requests and stops;
+    # 'batch_ingest' (with resume_run set to that run) loads the outputs from <run>/batch_outputs and then runs as usual
+    run_mode = 'interactive'
+    # Set to an existing run folder name to resume it; finished patients are not re-queried
+    resume_run = None
+    # Responses are cached across runs under MAIN_DIR/response_cache; cache_only fails fast on a miss.
+    # Off by default: with the cache on, rerunning the same request returns the stored answer instead of a new sample
+    use_response_cache = False
+    cache_only = False
+    # Downscale and re-encode images as JPEG before sending them; bytes saved are printed at the end
+    preprocess_images = False
+    # Constrain decoding to the diagnosis schema: None (free-form), 'json_schema', 'guided_json' (vLLM) or 'json_object'
+    structured_output = None
+    # Results are appended to results.parquet (a folder of part files) as patients finish ('.csv' works without pyarrow); Excel is exported at the end
+    results_table_name = 'results.parquet'
+    export_results_excel = True
+    # Shared server limits, None disables a limit
+    max_connections = 32
+    requests_per_second = 8
+    tokens_per_minute = None
+    # Read and encode the next patients' ROIs in the background while the current request is in flight;
+    # encoded patients waiting for their request are capped at prefetch_mb (None encodes right before each request)
+    prefetch_mb = 256
+    # Self-consistency: sample each diagnosis consistency_samples times (one request with n choices where the server supports it)
+    # and keep the majority Diagnose and median Blastengehalt with a per-field dispersion score; None keeps a single answer.
+    # Interactive runs only
+    consistency_samples = None
+    consistency_temperature = 0.7
 
     if not only_generate_csv:
         
@@ -207,8 +230,8 @@ if __name__ == "__main__":
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         folder_name = f"run_{timestamp}_{model_name}"
         
-        OUT_DIR = os.path.join(OUT_DIR, folder_name)
-        os.makedirs(OUT_DIR, exist_ok = True)
+        OUT_DIR = get_run_dir(OUT_DIR, folder_name, resume_run)
+        store = ResultStore(os.path.join(OUT_DIR, 'results_store.jsonl'))
         
         shutil.copy('/mnt/bulk-ganymede/narmin/narmin/AML_Project/AML_Project/evaluate_AML_All_In.py', os.path.join(OUT_DIR, 'code_copy.txt'))
         
@@ -220,28 +243,88 @@ if __name__ == "__main__":
         with open('/mnt/bulk-ganymede/narmin/narmin/MSI_LLM/key.json', 'r') as f:
             config = json.load(f)
         
-        client = OpenAI(api_key=config['Pluto'], base_url= 'http://192.168.33.27/v1')
+        # All model calls share one pooled, rate-limited and retrying client
+        api_client = create_client(api_key=config['Pluto'], base_url= 'http://192.168.33.27/v1', max_connections = max_connections,
+                                   requests_per_second = requests_per_second, tokens_per_minute = tokens_per_minute)
+        # Every request that reaches the server is logged to model_calls.jsonl; a per-stage summary and metrics.prom follow at the end
+        recorder = CallRecorder(os.path.join(OUT_DIR, 'model_calls.jsonl'))
+        client = InstrumentedClient(api_client, recorder)
+        if use_response_cache:
+            response_cache = ResponseCache(os.path.join(MAIN_DIR, 'response_cache'), cache_only = cache_only)
+            client = CachingClient(client, response_cache)
+        if preprocess_images:
+            image_preprocessor = ImagePreprocessor(max_side = 1024, jpeg_quality = 85, cache_dir = os.path.join(MAIN_DIR, 'preprocessed_images'))
         
-        for patient in tqdm(patients):
-            
-            images = load_images(image_dir = IMG_DIR, patient = patient)
-            
-            
-            encoded_images = [
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(path)}"}}
-                for path in images
-            ]
+        prompt_hash = hash_messages(build_diagnose_messages([]))
+        if preprocess_images:
+            prompt_hash = hash_messages([prompt_hash, image_preprocessor.settings()])
+        if structured_output is not None:
+            prompt_hash = hash_messages([prompt_hash, structured_output])
+        if consistency_samples:
+            if run_mode != 'interactive':
+                raise ValueError("Self-consistency sampling is only supported with run_mode = 'interactive'.")
+            # Stored results are lists of samples
+            prompt_hash = hash_messages([prompt_hash, {"samples": consistency_samples, "temperature": consistency_temperature}])
+        
+        if run_mode == 'batch_ingest':
+            stored, failed = ingest_batch_outputs(os.path.join(OUT_DIR, 'batch_outputs'), store)
+            print(f"Ingested {stored} batch results, {failed} failed requests will be queried interactively")
+        
+        if run_mode == 'batch_submit':
+            shards = write_diagnose_batch(patients, IMG_DIR, model_name, prompt_hash, store, os.path.join(OUT_DIR, 'batch_requests'), structured_output)
+            print(f"Wrote {len(shards)} batch shards to {os.path.join(OUT_DIR, 'batch_requests')}; put their outputs into "
+                  f"{os.path.join(OUT_DIR, 'batch_outputs')} and rerun with run_mode = 'batch_ingest', resume_run = '{os.path.basename(OUT_DIR)}'")
+        else:
+            table_path = os.path.join(OUT_DIR, results_table_name)
+            result_fields = CONSISTENCY_RESULT_FIELDS if consistency_samples else RESULT_FIELDS
+            results_table = ResultsTable(table_path, fields = result_fields, float_fields = CONSISTENCY_FLOAT_FIELDS if consistency_samples else ())
+        
+            prefetcher = Prefetcher(prefetch_mb * 1024**2, max_workers = 2) if prefetch_mb is not None else None
+            prepare = lambda patient: prepare_patient(patient, IMG_DIR, model_name, prompt_hash, store)
+            prepared = prefetcher.iterate(patients, prepare) if prefetcher is not None else ((patient, prepare(patient)) for patient in patients)
+        
+            for patient, (key, encoded_images) in tqdm(prepared, total = len(patients)):
             
-            diagnose = generate_diagnose(encoded_images = encoded_images, client = client, model_name = model_name, max_tokens=2000, temperature=0.2)
+                if encoded_images is None:
+                    diagnose = store.get(key)
+                elif consistency_samples:
+                    diagnose = generate_diagnose_samples(encoded_images = encoded_images, client = client, model_name = model_name, max_tokens=2000,
+                                                         temperature = consistency_temperature, n = consistency_samples, structured_output = structured_output)
+                    store.put(key, diagnose)
+                else:
+                    diagnose = generate_diagnose(encoded_images = encoded_images, client = client, model_name = model_name, max_tokens=2000, temperature=0.2,
+                                                 structured_output = structured_output)
+                    store.put(key, diagnose)
+                # Only the prefetcher's queue holds encoded images for patients still to come
+                encoded_images = None
             
-            diagnose_file = os.path.join(DIAGNOSE_DIR,  patient + '.json')  
+                diagnose_file = os.path.join(DIAGNOSE_DIR,  patient + '.json')  
             
-            entry = {"Patient": patient,"Ergebnis": diagnose}         
+                if consistency_samples:
+                    samples = diagnose
+                    diagnose, consistency = aggregate_diagnoses(samples)
+                    entry = {"Patient": patient, "Ergebnis": diagnose, "Samples": samples, "Consistency": consistency}
+                    extra = consistency_columns(consistency)
+                else:
+                    entry = {"Patient": patient,"Ergebnis": diagnose}         
+                    extra = {}
                  
-            with open(diagnose_file, "a", encoding="utf-8") as f:
-                json.dump(entry, f, ensure_ascii=False, indent=2)
-                
-        write_results_to_csv(input_dir = DIAGNOSE_DIR, output_file = os.path.join(OUT_DIR, 'results.xlsx'))
+                write_json_atomic(diagnose_file, entry)
+                results_table.add_diagnosis(patient, diagnose, **extra)
+        
+            results_table.close()
+            print(api_client.histogram.summary())
+            print(recorder.format_summary())
+            recorder.write_prometheus(os.path.join(OUT_DIR, 'metrics.prom'))
+            recorder.close()
+            if use_response_cache:
+                print(response_cache.stats())
+            if preprocess_images:
+                print(image_preprocessor.stats())
+            if prefetcher is not None:
+                print(prefetcher.stats())
+            if export_results_excel:
+                export_excel(table_path, os.path.join(OUT_DIR, 'results.xlsx'), fields = result_fields)
     else:
         OUT_DIR = '/mnt/bulk-ganymede/narmin/narmin/AML_Project/output/run_2025-07-18_12-55-00_medgemma-27b-it-q6'
         DIAGNOSE_DIR = OUT_DIR + '/diagnose'
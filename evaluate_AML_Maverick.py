@@ -2,13 +2,22 @@
 import os
 from tqdm import tqdm
 import json
-from openai import OpenAI
+from llm_client import create_client, create_structured
+from instrumentation import CallRecorder, InstrumentedClient
 import pandas as pd
 import base64
 from datetime import datetime
 import shutil
 import csv
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from image_preprocessing import ImagePreprocessor
+from image_index import get_image_index
+from response_cache import ResponseCache, CachingClient
+from result_store import ResultStore, get_run_dir, hash_bytes, hash_file, hash_messages, make_key, write_json_atomic
+from results_table import ResultsTable, export_excel
+from schemas import DIAGNOSIS_JSON_SCHEMA
+from prefetch import Prefetcher
 
 # Function to get video names using multiple filters 
 def get_patient_names(clini_table):
@@ -18,19 +27,20 @@ def get_patient_names(clini_table):
     return patients
 
 def load_images(image_dir, patient):
-    images = os.listdir(image_dir)
-    images = [i for i in images if patient in i]
-    images = [os.path.join(image_dir, i) for i in images]
+    images = get_image_index(image_dir).get(patient, [])
     return images
 
+# Optional ImagePreprocessor applied before base64 encoding, set in __main__
+image_preprocessor = None
+
 def encode_image(image_path):
+    if image_preprocessor is not None:
+        return image_preprocessor.encode(image_path)
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
 
-def get_morphology_descriptions(client, base64_image, model_name, max_tokens, temperature):
-    response = client.chat.completions.create(
-        model = model_name,
-        messages=[
+def build_morphology_messages(base64_image):
+    return [
             {
                 "role": "system",
                 "content": """
@@ -71,17 +81,20 @@ def get_morphology_descriptions(client, base64_image, model_name, max_tokens, te
                 }
                 ]
             }
-        ],
+        ]
+
+def get_morphology_descriptions(client, base64_image, model_name, max_tokens, temperature):
+    response = client.chat.completions.create(
+        model = model_name,
+        messages = build_morphology_messages(base64_image),
         max_tokens=max_tokens,
         temperature=temperature)
     
     file_content = response.choices[0].message.content
     return file_content
 
-def get_description_summary(client, description_list ,model_name, max_tokens, temperature):
-    response = client.chat.completions.create(
-        model = model_name,
-        messages=[
+def build_summary_messages(description_list):
+    return [
             {
                 "role": "user",
                 "content": [
@@ -91,17 +104,20 @@ def get_description_summary(client, description_list ,model_name, max_tokens, te
                     """}
                 ]
             }
-        ],
+        ]
+
+def get_description_summary(client, description_list ,model_name, max_tokens, temperature):
+    response = client.chat.completions.create(
+        model = model_name,
+        messages=build_summary_messages(description_list),
         max_tokens=max_tokens,
         temperature=temperature)  
     
     file_content = response.choices[0].message.content
     return file_content
 
-def generate_diagnose (descirptions, client, model_name, max_tokens, temperature):
-    response = client.chat.completions.create(
-                model=model_name,
-                messages = [
+def build_diagnose_messages(descirptions):
+    return [
                 {"role": "system",
                 "content": """
                 Du bist Facharzt für Hämatologie mit Spezialisierung auf Knochenmarkzytomorphologie. Du kennst die morphologischen Merkmale aus FAB- und WHO-Klassifikationen und nutzt sie ausschließlich zur strukturierten morphologischen Analyse (Kernform, Nukleolen, Granula, Dysplasiezeichen), nicht zur Subtypisierung.
@@ -139,54 +155,105 @@ def generate_diagnose (descirptions, client, model_name, max_tokens, temperature
                     }
                 ]
                 }
-            ],
+            ]
+
+def generate_diagnose (descirptions, client, model_name, max_tokens, temperature, structured_output = None):
+    response = create_structured(client, structured_output, DIAGNOSIS_JSON_SCHEMA, 'diagnosis',
+                model=model_name,
+                messages = build_diagnose_messages(descirptions),
                 max_tokens = max_tokens,
                 temperature = temperature, 
             )
     file_content = response.choices[0].message.content
     return file_content
 
-def write_results_to_csv(input_dir, output_file):
-    input_dir = Path(input_dir)
-    # Collect all rows here
-    rows = []
-    all_keys = set()
+def prepare_roi(image, patient, model_name, store):
+    # Returns (key, base64_image); the image is only encoded if the store has no description for it
+    prompt_hash = hash_messages(build_morphology_messages(''))
+    if image_preprocessor is not None:
+        prompt_hash = hash_messages([prompt_hash, image_preprocessor.settings()])
+    key = make_key(patient, hash_file(image), model_name, prompt_hash)
+    if key in store:
+        return key, None
+    return key, encode_image(image)
+
+def prepare_patient(patient, image_dir, model_name, store):
+    images = load_images(image_dir = image_dir, patient = patient)
+    return [(image, prepare_roi(image, patient, model_name, store)) for image in images]
+
+def describe_roi(client, image, patient, model_name, store, prepared = None):
+    key, base64_image = prepared if prepared is not None else prepare_roi(image, patient, model_name, store)
+    if base64_image is None:
+        return store.get(key)
+    description_roi = get_morphology_descriptions(client = client, base64_image = base64_image, model_name = model_name, max_tokens=1000, temperature=0.2)
+    store.put(key, description_roi)
+    return description_roi
+
+def process_patient(client, patient, image_dir, roi_executor, model_name, store, descriptions_dir, diagnose_dir, diagnose_from_summary = False,
+                    structured_output = None, prepared = None):
+    # The ROI descriptions of a patient are requested concurrently and its diagnosis
+    # is sent as soon as the last one arrives, while other patients are still being described.
+    # `prepared` is the prepare_patient result when a Prefetcher already encoded the ROIs.
+    if prepared is None:
+        prepared = prepare_patient(patient, image_dir, model_name, store)
+    images = [image for image, _ in prepared]
+    futures = [roi_executor.submit(describe_roi, client, image, patient, model_name, store, roi) for image, roi in prepared]
+    del prepared
+    description_list = [future.result() for future in futures]
+    roi_descriptions = [{
+        "ROI": 'ROI_' +image.split('_')[-1].replace('.png', ''),
+        "Morphology Description": description_roi
+    } for image, description_roi in zip(images, description_list)]
+    # Save the full list to a single JSON file
+    write_json_atomic(os.path.join(descriptions_dir, patient + '_ROIs.json'), roi_descriptions)
+    
+    if diagnose_from_summary:
+        key = make_key(patient, hash_bytes(json.dumps(description_list, ensure_ascii=False).encode('utf-8')), model_name, hash_messages(build_summary_messages('')))
+        if key in store:
+            description_summary = store.get(key)
+        else:
+            description_summary = get_description_summary(client = client, description_list = description_list, model_name = model_name, max_tokens=1000, temperature=0.2)
+            store.put(key, description_summary)
+        write_json_atomic(os.path.join(descriptions_dir, patient + '_Summary.json'), description_summary)
+        description = patient + '_Summary.json'
+        data = description_summary
+    else:
+        description = patient + '_ROIs.json'
+        data = "\n\n".join(entry["ROI"] + ':' + entry["Morphology Description"] for entry in roi_descriptions)
+    
+    prompt_hash = hash_messages(build_diagnose_messages(''))
+    if structured_output is not None:
+        prompt_hash = hash_messages([prompt_hash, structured_output])
+    key = make_key(patient, hash_bytes(data.encode('utf-8')), model_name, prompt_hash)
+    if key in store:
+        diagnose = store.get(key)
+    else:
+        diagnose = generate_diagnose(data, client = client, model_name = model_name, max_tokens=1000, temperature=0.2,
+                                     structured_output = structured_output)
+        store.put(key, diagnose)
+    
+    diagnose_file = os.path.join(diagnose_dir, description.replace('_Summary.json', '.json'))
+    entry = {"Patient": description,"Ergebnis": diagnose}
+    write_json_atomic(diagnose_file, entry)
+    return entry
+
+def write_results_to_csv(input_dir, output_file, table_path = None):
+    # Rebuilds the results table from the diagnose JSONs one file at a time and exports it to Excel
+    table_path = table_path or os.path.splitext(output_file)[0] + '.parquet'
+    results_table = ResultsTable(table_path)
 
     # Loop through all JSON files
-    for file in input_dir.glob("*.json"):
+    for file in Path(input_dir).glob("*.json"):
         with open(file, "r", encoding="utf-8") as f:
             data = json.load(f)
 
         patient_id = data.get("Patient", file.stem)
         patient_id = patient_id.replace('_ROIs.json', '')
         
-        # Step 1: Get the Diagnose or Ergebnis field
-        raw_diagnose = data.get("Ergebnis")
-
-        # Step 2: Clean up Markdown formatting from Diagnose
-        if raw_diagnose.startswith("```json"):
-            raw_diagnose = raw_diagnose.strip("`").strip()
-            first_newline = raw_diagnose.find('\n')
-            raw_diagnose = raw_diagnose[first_newline+1:]  # Skip first line
-            if raw_diagnose.endswith("```"):
-                raw_diagnose = raw_diagnose.rsplit("```", 1)[0]
-
-        # Step 3: Parse the cleaned JSON string
-        diagnose_dict = json.loads(raw_diagnose)
-
-        # Add patient as a separate column
-        diagnose_dict["Patient"] = patient_id
-        all_keys.update(diagnose_dict.keys())
-        rows.append(diagnose_dict)
+        results_table.add_diagnosis(patient_id, data.get("Ergebnis"))
 
-    # Assuming you already have a list of dicts in `rows` and all keys in `fieldnames`
-    df = pd.DataFrame(rows)
-
-    # Reorder columns (optional, to ensure 'Patient' is first)
-    df = df[["Patient"] + [col for col in df.columns if col != "Patient"]]
-
-    # Write to Excel
-    df.to_excel(output_file, index=False)
+    results_table.close()
+    export_excel(table_path, output_file)
 
         
 # main function
@@ -195,6 +262,30 @@ if __name__ == "__main__":
     MAIN_DIR = '/mnt/bulk-ganymede/narmin/narmin/AML_Project'
     IMG_DIR = '/mnt/bulk-saturn/chiara/chiara/03_WSI/ROIs_manuell_Lara/AML_Box_1'
     diagnose_from_summary = False
+    # Set to an existing run folder name to resume it; finished descriptions and diagnoses are not re-queried
+    resume_run = None
+    # Responses are cached across runs under MAIN_DIR/response_cache; cache_only fails fast on a miss.
+    # Off by default: with the cache on, rerunning the same request returns the stored answer instead of a new sample
+    use_response_cache = False
+    cache_only = False
+    # Downscale and re-encode images as JPEG before sending them; bytes saved are printed at the end
+    preprocess_images = False
+    # Constrain decoding of the diagnosis to its schema: None (free-form), 'json_schema', 'guided_json' (vLLM) or 'json_object'
+    structured_output = None
+    # Results are appended to results.parquet (a folder of part files) as patients finish ('.csv' works without pyarrow); Excel is exported at the end
+    results_table_name = 'results.parquet'
+    export_results_excel = True
+    # Shared server limits, None disables a limit
+    max_connections = 32
+    requests_per_second = 8
+    tokens_per_minute = None
+    model_name = 'Llama-4-Maverick-17B-128E-Instruct-FP8'
+    # Patients are processed as a stream: each patient's diagnosis starts as soon as its own descriptions are done
+    max_patients_in_flight = 4
+    max_descriptions_in_flight = 40
+    # Read and encode the ROIs of upcoming patients in the background; encoded patients waiting
+    # for a slot are capped at prefetch_mb (None encodes each ROI right before its request)
+    prefetch_mb = 256
 
     TABLE_DIR = MAIN_DIR + '/tables'
     OUT_DIR = MAIN_DIR + '/output'
@@ -204,8 +295,8 @@ if __name__ == "__main__":
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     folder_name = f"run_{timestamp}"
     
-    OUT_DIR = os.path.join(OUT_DIR, folder_name)
-    os.makedirs(OUT_DIR, exist_ok = True)
+    OUT_DIR = get_run_dir(OUT_DIR, folder_name, resume_run)
+    store = ResultStore(os.path.join(OUT_DIR, 'results_store.jsonl'))
     
     shutil.copy('/mnt/bulk-ganymede/narmin/narmin/AML_Project/AML_Project/evaluate_AML.py', os.path.join(OUT_DIR, 'evaluate_AML_Copy.txt'))
     
@@ -220,48 +311,55 @@ if __name__ == "__main__":
     with open('/mnt/bulk-ganymede/narmin/narmin/MSI_LLM/key.json', 'r') as f:
         config = json.load(f)
     
-    client = OpenAI(api_key=config['Pluto'], base_url= 'http://192.168.33.27/v1')
+    # All model calls share one pooled, rate-limited and retrying client
+    api_client = create_client(api_key=config['Pluto'], base_url= 'http://192.168.33.27/v1', max_connections = max_connections,
+                               requests_per_second = requests_per_second, tokens_per_minute = tokens_per_minute)
+    # Every request that reaches the server is logged to model_calls.jsonl; a per-stage summary and metrics.prom follow at the end
+    recorder = CallRecorder(os.path.join(OUT_DIR, 'model_calls.jsonl'))
+    client = InstrumentedClient(api_client, recorder)
+    if use_response_cache:
+        response_cache = ResponseCache(os.path.join(MAIN_DIR, 'response_cache'), cache_only = cache_only)
+        client = CachingClient(client, response_cache)
+    if preprocess_images:
+        image_preprocessor = ImagePreprocessor(max_side = 1024, jpeg_quality = 85, cache_dir = os.path.join(MAIN_DIR, 'preprocessed_images'))
 
-    for patient in tqdm(patients):
-        images = load_images(image_dir = IMG_DIR, patient = patient)
-        descriptions_ROI_file = os.path.join(DESCRIPTIONS_DIR, patient + '_ROIs.json')
-        description_list=[]
-        roi_descriptions = []
-        for image in images:
-            # Load base64 image
-            base64_image = encode_image(image)
-            description_roi = get_morphology_descriptions(client = client, base64_image = base64_image, model_name = 'Llama-4-Maverick-17B-128E-Instruct-FP8', max_tokens=1000, temperature=0.2)
-            description_list.append(description_roi)
-            # Append to list
-            roi_descriptions.append({
-                "ROI": 'ROI_' +image.split('_')[-1].replace('.png', ''),
-                "Morphology Description": description_roi
-            })
-        # Save the full list to a single JSON file
-        with open(descriptions_ROI_file, "w", encoding="utf-8") as f:
-            json.dump(roi_descriptions, f, ensure_ascii=False, indent=2)
-            
-        if diagnose_from_summary:       
-            description_summary = get_description_summary(client = client, description_list = description_list, model_name = 'Llama-4-Maverick-17B-128E-Instruct-FP8', max_tokens=1000, temperature=0.2)
-            description_summary_file = os.path.join(DESCRIPTIONS_DIR, patient + '_Summary.json')
-            with open(description_summary_file, "a", encoding="utf-8") as f:
-                json.dump(description_summary, f, ensure_ascii=False, indent=2)    
-        
-    descriptions = os.listdir(DESCRIPTIONS_DIR)   
-    if diagnose_from_summary:
-        descriptions = [i for i in descriptions if'_Summary.json' in i]
-    
-    for description in tqdm(descriptions):
-        with open(os.path.join(DESCRIPTIONS_DIR, description), 'r', encoding='utf-8') as f:
-            roi_data = json.load(f)
+    prefetcher = Prefetcher(prefetch_mb * 1024**2) if prefetch_mb is not None else None
+    prepare = lambda patient: prepare_patient(patient, IMG_DIR, model_name, store)
+    prepared_patients = prefetcher.iterate(patients, prepare) if prefetcher is not None else ((patient, None) for patient in patients)
+    with ThreadPoolExecutor(max_workers = max_descriptions_in_flight) as roi_executor, ThreadPoolExecutor(max_workers = max_patients_in_flight) as patient_executor:
+        table_path = os.path.join(OUT_DIR, results_table_name)
+        results_table = ResultsTable(table_path)
+        progress = tqdm(total = len(patients))
 
-        data = "\n\n".join(entry["ROI"] + ':' + entry["Morphology Description"] for entry in roi_data)              
-        diagnose = generate_diagnose(data, client = client, model_name = 'Llama-4-Maverick-17B-128E-Instruct-FP8', max_tokens=1000, temperature=0.2)
-        
-        diagnose_file = os.path.join(DIAGNOSE_DIR, description.replace('_Summary.json', '.json'))    
-        entry = {"Patient": description,"Ergebnis": diagnose}              
-        with open(diagnose_file, "a", encoding="utf-8") as f:
-            json.dump(entry, f, ensure_ascii=False, indent=2)
+        def add_results(done):
+            for future in done:
+                entry = future.result()
+                results_table.add_diagnosis(entry["Patient"].replace('_ROIs.json', ''), entry["Ergebnis"])
+                progress.update()
+
+        # Patients are submitted as slots free up, so the prefetcher only runs ahead by its byte budget
+        futures = set()
+        for patient, prepared in prepared_patients:
+            while len(futures) >= max_patients_in_flight:
+                done, futures = wait(futures, return_when = FIRST_COMPLETED)
+                add_results(done)
+            futures.add(patient_executor.submit(process_patient, client, patient, IMG_DIR, roi_executor, model_name, store, DESCRIPTIONS_DIR, DIAGNOSE_DIR,
+                                                diagnose_from_summary, structured_output, prepared))
+            del prepared
+        add_results(wait(futures).done)
+        progress.close()
+        results_table.close()
             
-    write_results_to_csv(input_dir = DIAGNOSE_DIR, output_file = os.path.join(OUT_DIR, 'results.xlsx'))
+    print(api_client.histogram.summary())
+    print(recorder.format_summary())
+    recorder.write_prometheus(os.path.join(OUT_DIR, 'metrics.prom'))
+    recorder.close()
+    if use_response_cache:
+        print(response_cache.stats())
+    if preprocess_images:
+        print(image_preprocessor.stats())
+    if prefetcher is not None:
+        print(prefetcher.stats())
+    if export_results_excel:
+        export_excel(table_path, os.path.join(OUT_DIR, 'results.xlsx'))
             
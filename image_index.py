@@ -0,0 +1,77 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+def get_patient_id(file_name):
+    # ROI files are named '<AML>_<Box>_<ID>_<...>', the patient is the first three parts
+    parts = file_name.split('_')
+    if len(parts) < 4:
+        return None
+    return '_'.join(parts[0:3])
+
+def scan_directory(image_dir):
+    # One os.scandir pass over the directory, grouping file paths by patient
+    patients = {}
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            patient = get_patient_id(entry.name)
+            if patient is not None:
+                patients.setdefault(patient, []).append(entry.path)
+    for paths in patients.values():
+        paths.sort()
+    return patients
+
+def build_image_index(image_dirs, index_file=None, max_workers=8):
+    # Maps patient ID to ROI paths across `image_dirs`. With `index_file` the
+    # per-directory listings are persisted and a directory is only rescanned
+    # when its mtime has changed since the last run. Changed directories are
+    # scanned in parallel.
+    if isinstance(image_dirs, str):
+        image_dirs = [image_dirs]
+    cached = {}
+    if index_file is not None and os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+
+    directories = {}
+    stale = []
+    for image_dir in image_dirs:
+        mtime_ns = os.stat(image_dir).st_mtime_ns
+        entry = cached.get(image_dir)
+        if entry is None or entry["mtime_ns"] != mtime_ns:
+            stale.append((image_dir, mtime_ns))
+        directories[image_dir] = entry
+    changed = bool(stale)
+    if stale:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            scans = executor.map(scan_directory, [image_dir for image_dir, _ in stale])
+            for (image_dir, mtime_ns), patients in zip(stale, scans):
+                directories[image_dir] = {"mtime_ns": mtime_ns, "patients": patients}
+
+    if index_file is not None and changed:
+        tmp_file = index_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(directories, f)
+        os.replace(tmp_file, index_file)
+
+    index = {}
+    for entry in directories.values():
+        for patient, paths in entry["patients"].items():
+            index.setdefault(patient, []).extend(paths)
+    return index
+
+image_indexes = {}
+image_index_lock = threading.Lock()
+
+def get_image_index(image_dir):
+    # In-process index of one directory, rebuilt only when the directory changes
+    mtime_ns = os.stat(image_dir).st_mtime_ns
+    with image_index_lock:
+        cached = image_indexes.get(image_dir)
+        if cached is None or cached[0] != mtime_ns:
+            cached = (mtime_ns, scan_directory(image_dir))
+            image_indexes[image_dir] = cached
+        return cached[1]
@@ -0,0 +1,82 @@
+import io
+import os
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+class ImagePreprocessor:
+    # Optional stage between reading an image and base64-encoding it: downscale
+    # to `max_side`, optionally center-crop to a fraction of each side, and
+    # re-encode as JPEG. Results are memoized by the SHA-256 of the source bytes
+    # in memory and, with `cache_dir`, on disk across runs.
+    def __init__(self, max_side=None, jpeg_quality=85, center_crop=None, cache_dir=None, max_memory_entries=256):
+        self.max_side = max_side
+        self.jpeg_quality = jpeg_quality
+        self.center_crop = center_crop
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.images = 0
+        self.source_bytes = 0
+        self.output_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def settings(self):
+        return {"max_side": self.max_side, "jpeg_quality": self.jpeg_quality, "center_crop": self.center_crop}
+
+    def process_bytes(self, data):
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert("RGB")
+            if self.center_crop is not None:
+                width, height = image.size
+                crop_width, crop_height = int(width * self.center_crop), int(height * self.center_crop)
+                left, top = (width - crop_width) // 2, (height - crop_height) // 2
+                image = image.crop((left, top, left + crop_width, top + crop_height))
+            if self.max_side is not None and max(image.size) > self.max_side:
+                image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=self.jpeg_quality)
+        return output.getvalue()
+
+    def encode_bytes(self, data):
+        params = "{max_side}-{jpeg_quality}-{center_crop}".format(**self.settings())
+        key = hashlib.sha256(data).hexdigest() + "-" + params
+        with self.lock:
+            encoded = self.memory.get(key)
+            if encoded is not None:
+                self.memory.move_to_end(key)
+        if encoded is None:
+            cache_file = os.path.join(self.cache_dir, key + ".jpg") if self.cache_dir is not None else None
+            if cache_file is not None and os.path.exists(cache_file):
+                with open(cache_file, "rb") as f:
+                    processed = f.read()
+            else:
+                processed = self.process_bytes(data)
+                if cache_file is not None:
+                    # One temp file per writer: threads encoding identical tiles at once must not replace each other's file
+                    tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+                    with open(tmp_file, "wb") as f:
+                        f.write(processed)
+                    os.replace(tmp_file, cache_file)
+            encoded = base64.b64encode(processed).decode('utf-8')
+            with self.lock:
+                self.memory[key] = encoded
+                if len(self.memory) > self.max_memory_entries:
+                    self.memory.popitem(last=False)
+        with self.lock:
+            self.images += 1
+            self.source_bytes += len(data)
+            self.output_bytes += len(encoded) * 3 // 4
+        return encoded
+
+    def encode(self, image_path):
+        with open(image_path, "rb") as image_file:
+            return self.encode_bytes(image_file.read())
+
+    def stats(self):
+        return {"images": self.images, "source_bytes": self.source_bytes, "output_bytes": self.output_bytes,
+                "bytes_saved": self.source_bytes - self.output_bytes}
@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import threading
+from types import SimpleNamespace
+from llm_client import LatencyHistogram
+
+# Per-call instrumentation for chat.completions.create. InstrumentedClient
+# sits directly on top of the ResilientClient, so it sees every request that
+# reaches the server (cache hits never get here) including the time spent in
+# retries. Records go to a JSONL file as they happen; per-stage summaries and
+# a Prometheus textfile are produced at the end of the run.
+
+# Frames in these files are wrappers; the stage is the first function outside them
+WRAPPER_FILES = {"llm_client.py", "response_cache.py", "instrumentation.py"}
+
+def caller_stage():
+    frame = sys._getframe(2)
+    while frame is not None and os.path.basename(frame.f_code.co_filename) in WRAPPER_FILES:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+def request_bytes(request):
+    # Sums the message strings instead of serializing the payload, which would cost more than the bookkeeping itself
+    size = 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            size += len(content)
+        else:
+            for part in content or []:
+                if part.get("type") == "image_url":
+                    size += len(part["image_url"]["url"])
+                else:
+                    size += len(part.get("text", ""))
+    return size
+
+class StageStats:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.ttft = LatencyHistogram()
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.request_bytes = 0
+        self.retries = 0
+
+class CallRecorder:
+    def __init__(self, path=None):
+        self.path = path
+        self.file = open(path, "a", encoding="utf-8") if path is not None else None
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, model, latency, ttft, usage, size, retries, status):
+        record = {"time": time.time(), "stage": stage, "model": model, "latency": round(latency, 4),
+                  "ttft": round(ttft, 4) if ttft is not None else None,
+                  "prompt_tokens": usage.prompt_tokens if usage is not None else None,
+                  "completion_tokens": usage.completion_tokens if usage is not None else None,
+                  "request_bytes": size, "retries": retries, "status": status}
+        with self.lock:
+            stats = self.stages.setdefault((stage, model), StageStats())
+            stats.requests += 1
+            stats.errors += status != "ok"
+            stats.request_bytes += size
+            stats.retries += retries
+            if usage is not None:
+                stats.prompt_tokens += usage.prompt_tokens or 0
+                stats.completion_tokens += usage.completion_tokens or 0
+            if self.file is not None:
+                self.file.write(json.dumps(record) + "\n")
+        if status == "ok":
+            stats.latency.observe(latency)
+            if ttft is not None:
+                stats.ttft.observe(ttft)
+
+    def model_stats(self, model):
+        # All stages of one model merged into one StageStats
+        merged = StageStats()
+        with self.lock:
+            stages = [stats for (_, stage_model), stats in self.stages.items() if stage_model == model]
+        for stats in stages:
+            merged.requests += stats.requests
+            merged.errors += stats.errors
+            merged.retries += stats.retries
+            merged.prompt_tokens += stats.prompt_tokens
+            merged.completion_tokens += stats.completion_tokens
+            merged.request_bytes += stats.request_bytes
+            with stats.latency.lock:
+                latencies = list(stats.latency.latencies)
+            for seconds in latencies:
+                merged.latency.observe(seconds)
+        return merged
+
+    def summary(self):
+        rows = []
+        with self.lock:
+            stages = list(self.stages.items())
+        for (stage, model), stats in stages:
+            rows.append({"Stage": stage, "Model": model, "Requests": stats.requests, "Errors": stats.errors, "Retries": stats.retries,
+                         "Latency_p50": stats.latency.percentile(50), "Latency_p95": stats.latency.percentile(95),
+                         "Latency_p99": stats.latency.percentile(99), "TTFT_p50": stats.ttft.percentile(50),
+                         "Prompt_Tokens": stats.prompt_tokens, "Completion_Tokens": stats.completion_tokens,
+                         "Request_MB": round(stats.request_bytes / 1024**2, 2)})
+        return rows
+
+    def format_summary(self):
+        rows = self.summary()
+        if not rows:
+            return "No model calls recorded."
+        columns = list(rows[0].keys())
+        cells = [[f"{row[column]:.3f}" if isinstance(row[column], float) else str(row[column]) for column in columns] for row in rows]
+        widths = [max(len(column), *(len(row[i]) for row in cells)) for i, column in enumerate(columns)]
+        lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+        lines += ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in cells]
+        return "\n".join(lines)
+
+    def write_prometheus(self, path):
+        # Textfile-collector format, written atomically so a scrape never sees a partial file
+        lines = ["# TYPE llm_request_duration_seconds histogram"]
+        totals = {"llm_requests_total": [], "llm_errors_total": [], "llm_retries_total": [], "llm_prompt_tokens_total": [],
+                  "llm_completion_tokens_total": [], "llm_request_bytes_total": []}
+        with self.lock:
+            stages = list(self.stages.items())
+        for (stage, model), stats in stages:
+            labels = f'stage="{stage}",model="{model}"'
+            histogram = stats.latency
+            with histogram.lock:
+                counts = list(histogram.counts)
+                latency_sum = sum(histogram.latencies)
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, counts):
+                cumulative += count
+                lines.append(f'llm_request_duration_seconds_bucket{{{labels},le="{bucket}"}} {cumulative}')
+            lines.append(f'llm_request_duration_seconds_bucket{{{labels},le="+Inf"}} {sum(counts)}')
+            lines.append(f"llm_request_duration_seconds_sum{{{labels}}} {latency_sum}")
+            lines.append(f"llm_request_duration_seconds_count{{{labels}}} {sum(counts)}")
+            for name, value in (("llm_requests_total", stats.requests), ("llm_errors_total", stats.errors), ("llm_retries_total", stats.retries),
+                                ("llm_prompt_tokens_total", stats.prompt_tokens), ("llm_completion_tokens_total", stats.completion_tokens),
+                                ("llm_request_bytes_total", stats.request_bytes)):
+                totals[name].append(f"{name}{{{labels}}} {value}")
+        for name, samples in totals.items():
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(samples)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class InstrumentedClient:
+    def __init__(self, client, recorder, label=None):
+        self.client = client
+        self.recorder = recorder
+        # Recorded in place of the request's model, e.g. to tell apart two endpoints serving the same model
+        self.label = label
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def retries(self):
+        # ResilientClient leaves the retry count of the calling thread's last request here
+        return getattr(getattr(self.client, "local", None), "retries", 0)
+
+    def create(self, **kwargs):
+        stage = caller_stage()
+        model = self.label or kwargs.get("model")
+        size = request_bytes(kwargs)
+        start = time.monotonic()
+        try:
+            response = self.client.chat.completions.create(**kwargs)
+        except Exception as error:
+            self.recorder.record(stage, model, time.monotonic() - start, None, None, size, self.retries(), type(error).__name__)
+            raise
+        if kwargs.get("stream"):
+            return self.timed_stream(response, stage, model, size, start, self.retries())
+        self.recorder.record(stage, model, time.monotonic() - start, None, getattr(response, "usage", None), size, self.retries(), "ok")
+        return response
+
+    def timed_stream(self, stream, stage, model, size, start, retries):
+        # Usage only arrives on the last chunk when stream_options={"include_usage": True} is set
+        ttft = None
+        usage = None
+        status = "ok"
+        try:
+            for chunk in stream:
+                if ttft is None and chunk.choices:
+                    ttft = time.monotonic() - start
+                usage = getattr(chunk, "usage", None) or usage
+                yield chunk
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        except Exception as error:
+            status = type(error).__name__
+            raise
+        finally:
+            # Closing the HTTP response is what tells the server to stop generating
+            if hasattr(stream, "close"):
+                stream.close()
+            self.recorder.record(stage, model, time.monotonic() - start, ttft, usage, size, retries, status)
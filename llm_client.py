@@ -0,0 +1,188 @@
+import time
+import random
+import bisect
+import threading
+from types import SimpleNamespace
+import httpx
+import openai
+from openai import OpenAI
+from schemas import structured_output_kwargs
+
+RETRYABLE_ERRORS = (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300]
+
+class TokenBucket:
+    # Refills `rate` units per second up to `capacity`; acquire() blocks until
+    # enough units are available. The level may go negative when a request
+    # turns out to be more expensive than estimated.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self.refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount):
+        with self.lock:
+            self.refill()
+            self.level -= amount
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.latencies.append(seconds)
+
+    def percentile(self, q):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))]
+
+    def summary(self):
+        labels = [f"<={bucket}s" for bucket in self.buckets] + [f">{self.buckets[-1]}s"]
+        return {"count": len(self.latencies), "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99),
+                "buckets": dict(zip(labels, self.counts))}
+
+def estimate_tokens(request):
+    # Rough pre-request estimate for the tokens/min budget: ~4 characters per
+    # text token, a fixed cost per image, plus the completion budget.
+    text_chars = 0
+    images = 0
+    for message in request.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            text_chars += len(content)
+        else:
+            for part in content or []:
+                if part.get("type") == "image_url":
+                    images += 1
+                else:
+                    text_chars += len(part.get("text", ""))
+    return text_chars // 4 + images * 1000 + request.get("max_tokens", 0) * request.get("n", 1)
+
+class ResilientClient:
+    # Wraps an OpenAI client with rate limiting (requests/sec and tokens/min),
+    # retries with exponential backoff and full jitter on transient errors, and
+    # an overall per-request deadline. Latencies of successful calls are kept in
+    # a histogram.
+    def __init__(self, client, requests_per_second=None, tokens_per_minute=None, max_retries=5,
+                 backoff_base=1.0, backoff_max=60.0, timeout=300.0, deadline=900.0):
+        self.client = client
+        self.request_bucket = TokenBucket(requests_per_second, max(1, requests_per_second)) if requests_per_second else None
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.deadline = deadline
+        self.histogram = LatencyHistogram()
+        self.retries = 0
+        # Retries of the current thread's last request, read by InstrumentedClient
+        self.local = threading.local()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        deadline = time.monotonic() + self.deadline
+        estimate = estimate_tokens(kwargs)
+        attempt = 0
+        self.local.retries = 0
+        while True:
+            if self.request_bucket is not None:
+                self.request_bucket.acquire()
+            if self.token_bucket is not None:
+                self.token_bucket.acquire(estimate)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Request deadline of {self.deadline}s exceeded after {attempt} retries.")
+            start = time.monotonic()
+            try:
+                response = self.client.chat.completions.create(**kwargs, timeout=min(self.timeout, remaining))
+            except RETRYABLE_ERRORS as error:
+                attempt += 1
+                self.retries += 1
+                self.local.retries = attempt
+                if attempt > self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if time.monotonic() + delay >= deadline:
+                    raise
+                print(f"Retrying after {type(error).__name__} (attempt {attempt}/{self.max_retries}) in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.histogram.observe(time.monotonic() - start)
+            usage = getattr(response, "usage", None)
+            if self.token_bucket is not None and usage is not None:
+                self.token_bucket.adjust(usage.total_tokens - estimate)
+            return response
+
+def create_client(api_key, base_url, max_connections=32, connect_timeout=10.0, **kwargs):
+    # Shared entry point for all model calls: one pooled HTTP connection set,
+    # OpenAI's own retries disabled in favour of ResilientClient's.
+    http_client = httpx.Client(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                               timeout=httpx.Timeout(kwargs.get("timeout", 300.0), connect=connect_timeout))
+    client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    return ResilientClient(client, **kwargs)
+
+unsupported_structured_modes = set()
+
+def create_structured(client, structured_output, schema, schema_name, **kwargs):
+    # Sends the request with constrained decoding when `structured_output` is
+    # set; if the server rejects the mode, it falls back to free-form output
+    # and does not try that mode again in this run.
+    if structured_output is not None and structured_output not in unsupported_structured_modes:
+        try:
+            return client.chat.completions.create(**kwargs, **structured_output_kwargs(schema, schema_name, structured_output))
+        except openai.BadRequestError as error:
+            print(f"Server does not support structured output mode {structured_output}, falling back to free-form: {error}")
+            unsupported_structured_modes.add(structured_output)
+    return client.chat.completions.create(**kwargs)
+
+unsupported_n_models = set()
+
+def create_choices(client, structured_output, schema, schema_name, n, **kwargs):
+    # Asks for n choices of one request, so the server decodes all of them from
+    # a single prefill, and returns their contents. The list is empty when the
+    # server rejects `n` and shorter than n when it ignores it; either way `n`
+    # is not sent for that model again in this run.
+    model = kwargs.get("model")
+    if n <= 1 or model in unsupported_n_models:
+        return []
+    structured_supported = structured_output not in unsupported_structured_modes
+    try:
+        response = create_structured(client, structured_output, schema, schema_name, n=n, **kwargs)
+    except openai.BadRequestError as error:
+        print(f"Server does not support n={n} for {model}, falling back to single requests: {error}")
+        unsupported_n_models.add(model)
+        if structured_supported:
+            # create_structured cannot tell whether `n` or the structured output mode was rejected; single requests try the mode again
+            unsupported_structured_modes.discard(structured_output)
+        return []
+    contents = [choice.message.content for choice in response.choices]
+    if len(contents) < n:
+        print(f"Server returned {len(contents)} of n={n} choices for {model}, requesting further samples separately")
+        unsupported_n_models.add(model)
+    return contents
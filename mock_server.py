@@ -0,0 +1,189 @@
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llm_client import estimate_tokens
+
+ROI_RESPONSE = '{"Thoughts": "Gut fokussiert, gleichmäßig verteilte Zellen.", "ROI": "Yes"}'
+ROI_DECISION_FIRST_RESPONSE = '{"ROI": "Yes", "Thoughts": "Gut fokussiert, gleichmäßig verteilte Zellen."}'
+DIAGNOSIS_RESPONSE = json.dumps({
+    "gedanken": "Hyperzelluläres Mark mit deutlicher Vermehrung unreifer Vorstufen.",
+    "Qualität des Ausstrichs-Markbröckelchen": "Reichlich Markbröckelchen",
+    "Qualität des Ausstrichs-Zellgehalt": "Hyperzellulär",
+    "Erythropoese": "Reduziert, vereinzelt megaloblastär",
+    "Granulopoese": "Reduziert, Ausreifungsstörung",
+    "Megakaryopoese": "Vermindert, keine Mikromegakaryozyten",
+    "Lymphopoese": "Unauffällig",
+    "Blastengehalt": "45 %",
+    "Besonderheiten": "Vereinzelt Auerstäbchen",
+    "Diagnose": "Morphologisch vereinbar mit akuter myeloischer Leukämie",
+}, ensure_ascii=False)
+MORPHOLOGY_RESPONSE = ("Zellreiches Knochenmark mit gut beurteilbaren Markbröckelchen. Granulopoese mit Ausreifungsstörung, "
+                       "Erythropoese reduziert ohne wesentliche Dysplasiezeichen, Megakaryozyten vereinzelt. "
+                       "Blastenanteil geschätzt 40 %, teils mit prominenten Nukleolen, vereinzelt Auerstäbchen.")
+SUMMARY_RESPONSE = ("Über alle zehn ROIs zellreiches Mark mit dominierender Blastenpopulation (ca. 40 %), "
+                    "reduzierter Erythro- und Megakaryopoese und Ausreifungsstörung der Granulopoese.")
+
+def roi_responder(payload):
+    return ROI_RESPONSE
+
+def roi_batch_response(n_tiles):
+    return json.dumps({"Tiles": [{"Tile": number, **json.loads(ROI_RESPONSE)} for number in range(1, n_tiles + 1)]}, ensure_ascii=False)
+
+def prompt_text(payload):
+    parts = []
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(part.get("text", "") for part in content or [])
+    return "\n".join(parts)
+
+def canned_responder(payload):
+    # Answers in the shape each pipeline prompt asks for: is_roi (single and batched), the two
+    # diagnosis prompts, the Maverick summary and per-ROI morphology descriptions
+    text = prompt_text(payload)
+    if '"Tiles"' in text:
+        return roi_batch_response(sum(1 for line in text.splitlines() if line.startswith("Tile ") and line.endswith(":")))
+    if '{"ROI"' in text:
+        return ROI_DECISION_FIRST_RESPONSE
+    if '"Thoughts"' in text:
+        return ROI_RESPONSE
+    if '"Diagnose"' in text:
+        return DIAGNOSIS_RESPONSE
+    if 'Gesamtbefundtext' in text:
+        return SUMMARY_RESPONSE
+    return MORPHOLOGY_RESPONSE
+
+def lognormal_latency(median, sigma = 0.5):
+    # Latency distribution for start_mock_server: most requests near `median`, with a long tail
+    def sample(rng):
+        return rng.lognormvariate(0, sigma) * median
+    return sample
+
+def make_completion(payload, content, prompt_tokens = 0, completion_tokens = 0):
+    # `content` is a list of contents when the request asked for n choices
+    contents = content if isinstance(content, list) else [content]
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "mock"),
+        "choices": [{"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"} for i, content in enumerate(contents)],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+def make_chunk(payload, delta, finish_reason = None):
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": payload.get("model", "mock"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+def make_handler(responder, latency, tokens_per_second = None, prompt_tokens_per_second = None,
+                 failure_rate = 0.0, failure_status = 503, seed = None, stats = None, supports_n = True):
+    # `latency` is a fixed number of seconds or a function of a random.Random
+    # (see lognormal_latency). Tokens are counted as ~4 characters; with
+    # tokens_per_second set, generation time grows with the answer length.
+    # n choices share one prefill and are decoded in parallel; without
+    # supports_n a request with n > 1 is rejected with a 400.
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    stats = stats if stats is not None else {}
+    stats.update({"requests": 0, "failures": 0, "request_bytes": 0, "cancelled": 0, "completion_chars": 0, "prompt_tokens": 0})
+
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body):
+            body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_event(self, data):
+            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            payload = json.loads(raw)
+            with rng_lock:
+                delay = latency(rng) if callable(latency) else latency
+                failed = rng.random() < failure_rate
+                stats["requests"] += 1
+                stats["failures"] += failed
+                stats["request_bytes"] += len(raw)
+            if failed:
+                time.sleep(delay / 2)
+                self.send_json(failure_status, {"error": {"message": "Simulated failure", "type": "server_error", "code": failure_status}})
+                return
+            n = payload.get("n") or 1
+            if n > 1 and not supports_n:
+                self.send_json(400, {"error": {"message": "Only one completion choice is allowed", "type": "invalid_request_error", "code": 400}})
+                return
+            content = responder(payload)
+            prompt_tokens = estimate_tokens({"messages": payload.get("messages", [])})
+            completion_tokens = max(1, len(content) // 4)
+            with rng_lock:
+                stats["prompt_tokens"] += prompt_tokens
+            if prompt_tokens_per_second:
+                delay += prompt_tokens / prompt_tokens_per_second
+            time.sleep(delay)
+            if not payload.get("stream"):
+                contents = [content] + [responder(payload) for _ in range(n - 1)]
+                if tokens_per_second:
+                    time.sleep(max(len(content) // 4 for content in contents) / tokens_per_second)
+                with rng_lock:
+                    stats["completion_chars"] += sum(len(content) for content in contents)
+                completion_tokens = sum(max(1, len(content) // 4) for content in contents)
+                self.send_json(200, make_completion(payload, contents if n > 1 else content, prompt_tokens, completion_tokens))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            try:
+                self.send_event(json.dumps(make_chunk(payload, {"role": "assistant", "content": ""})))
+                for i in range(0, len(content), 16):
+                    if tokens_per_second:
+                        time.sleep(4 / tokens_per_second)
+                    self.send_event(json.dumps(make_chunk(payload, {"content": content[i:i + 16]}), ensure_ascii=False))
+                    with rng_lock:
+                        stats["completion_chars"] += len(content[i:i + 16])
+                self.send_event(json.dumps(make_chunk(payload, {}, "stop")))
+                if (payload.get("stream_options") or {}).get("include_usage"):
+                    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+                    self.send_event(json.dumps({**make_chunk(payload, {}), "choices": [], "usage": usage}))
+                self.send_event("[DONE]")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client cancelled the stream; a real server would stop generating here
+                with rng_lock:
+                    stats["cancelled"] += 1
+
+        def log_message(self, format, *args):
+            pass
+    return MockHandler
+
+def start_mock_server(responder = roi_responder, latency = 0.05, host = "127.0.0.1", port = 0, **behaviour):
+    # Local OpenAI-compatible stub; returns the server and a base_url usable with OpenAI(base_url=...).
+    # `behaviour` is passed to make_handler; request counters are kept in server.stats.
+    stats = {}
+    server = ThreadingHTTPServer((host, port), make_handler(responder, latency, stats = stats, **behaviour))
+    server.daemon_threads = True
+    server.stats = stats
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+if __name__ == "__main__":
+    server, base_url = start_mock_server(responder = canned_responder, latency = lognormal_latency(2.0), port = 8000,
+                                         tokens_per_second = 50, failure_rate = 0.01)
+    print(f"Mock server listening on {base_url}")
+    threading.Event().wait()
@@ -0,0 +1,276 @@
+import json
+from schemas import DIAGNOSIS_FIELDS, DIAGNOSIS_FIELD_ALIASES, ROI_FIELDS, canonical_field
+
+# Tolerant, single-pass parser for the JSON-ish objects the models return.
+# It handles markdown fences, unquoted values, unescaped inner quotes,
+# trailing commas and output truncated by max_tokens. Every character is
+# visited a bounded number of times, so run time stays linear in the length
+# of the output (no regex backtracking).
+
+WHITESPACE = ' \t\r\n'
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', '\\': '\\', '/': '/'}
+
+def strip_fences(text):
+    text = text.strip()
+    if text.startswith('```'):
+        newline = text.find('\n')
+        text = text[newline + 1:] if newline != -1 else ''
+    end = text.rfind('```')
+    if end != -1:
+        text = text[:end]
+    return text.strip()
+
+def skip_whitespace(text, i):
+    while i < len(text) and text[i] in WHITESPACE:
+        i += 1
+    return i
+
+def closes_string(text, i, is_key):
+    # A quote only closes a string if what follows fits the JSON structure;
+    # otherwise it is an unescaped quote inside the text.
+    j = skip_whitespace(text, i)
+    if j >= len(text):
+        return True
+    if is_key:
+        return text[j] == ':'
+    if text[j] == ',':
+        # A comma only ends the value if the next key (or the end) follows
+        k = skip_whitespace(text, j + 1)
+        return k >= len(text) or text[k] in '"}' or '\n' in text[j + 1:k]
+    return text[j] in '}]' or (text[j] == '"' and '\n' in text[i:j])
+
+def read_string(text, i, is_key=False):
+    chars = []
+    i += 1
+    while i < len(text):
+        c = text[i]
+        if c == '\\' and i + 1 < len(text):
+            escape = text[i + 1]
+            if escape == 'u' and i + 6 <= len(text):
+                try:
+                    chars.append(chr(int(text[i + 2:i + 6], 16)))
+                    i += 6
+                    continue
+                except ValueError:
+                    pass
+            chars.append(ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        if c == '"' and closes_string(text, i + 1, is_key):
+            return ''.join(chars), i + 1, True
+        chars.append(c)
+        i += 1
+    return ''.join(chars), i, False
+
+def read_nested(text, i):
+    # Raw text of a nested object/array up to its matching bracket
+    start = i
+    depth = 0
+    in_string = False
+    while i < len(text):
+        c = text[i]
+        if in_string:
+            if c == '\\':
+                i += 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '{[':
+            depth += 1
+        elif c in '}]':
+            depth -= 1
+            if depth == 0:
+                raw = text[start:i + 1]
+                try:
+                    return json.loads(raw), i + 1, True
+                except ValueError:
+                    return raw, i + 1, True
+        i += 1
+    return text[start:], i, False
+
+def read_unquoted(text, i):
+    # Unquoted values run until the end of the line, the closing brace or a
+    # comma that starts the next key
+    start = i
+    while i < len(text):
+        c = text[i]
+        if c == '\n' or c == '}':
+            break
+        if c == ',':
+            j = skip_whitespace(text, i + 1)
+            if j >= len(text) or text[j] in '"}':
+                break
+        i += 1
+    raw = text[start:i].strip().rstrip(',').strip()
+    if raw in ('true', 'false', 'null'):
+        return json.loads(raw), i, i < len(text)
+    try:
+        return int(raw), i, i < len(text)
+    except ValueError:
+        pass
+    try:
+        return float(raw), i, i < len(text)
+    except ValueError:
+        return raw, i, i < len(text)
+
+def read_unquoted_key(text, i):
+    start = i
+    while i < len(text) and text[i] not in ':\n':
+        i += 1
+    return text[start:i].strip(), i
+
+def read_value(text, i):
+    if text[i] == '"':
+        return read_string(text, i)
+    if text[i] in '{[':
+        return read_nested(text, i)
+    return read_unquoted(text, i)
+
+def scan_object(text):
+    # Returns (key, value, complete) for every key/value pair found in the first object
+    pairs = []
+    i = text.find('{')
+    i = 0 if i == -1 else i + 1
+    while True:
+        i = skip_whitespace(text, i)
+        while i < len(text) and text[i] == ',':
+            i = skip_whitespace(text, i + 1)
+        if i >= len(text) or text[i] == '}':
+            break
+        if text[i] == '"':
+            key, i, complete = read_string(text, i, is_key=True)
+            if not complete:
+                break
+        else:
+            key, i = read_unquoted_key(text, i)
+            if i >= len(text) or text[i] != ':':
+                # A line without a key/value pair, carry on with the next one
+                continue
+        i = skip_whitespace(text, i)
+        if i >= len(text):
+            break
+        i = skip_whitespace(text, i + 1)
+        if i >= len(text):
+            pairs.append((key, None, False))
+            break
+        value, i, complete = read_value(text, i)
+        pairs.append((key, value, complete))
+    return pairs
+
+def parse_model_output(raw_text, fields=DIAGNOSIS_FIELDS, aliases=DIAGNOSIS_FIELD_ALIASES):
+    # Returns (values, status): values keyed by canonical field name and a
+    # per-field status of 'ok' (valid JSON), 'repaired' (recovered by the
+    # tolerant scan), 'truncated' (value cut off) or 'missing'.
+    text = strip_fences(raw_text or '')
+    values = {}
+    status = {}
+    data = None
+    start, end = text.find('{'), text.rfind('}')
+    if start != -1 and end > start:
+        try:
+            data = json.loads(text[start:end + 1])
+        except ValueError:
+            data = None
+    if isinstance(data, dict):
+        for key, value in data.items():
+            field = canonical_field(key, fields, aliases)
+            values[field] = value
+            status[field] = 'ok'
+    else:
+        for key, value, complete in scan_object(text):
+            field = canonical_field(key, fields, aliases)
+            values[field] = value
+            status[field] = 'repaired' if complete else 'truncated'
+    for field in fields:
+        if field not in status:
+            status[field] = 'missing'
+    return values, status
+
+def parse_diagnosis(raw_text):
+    return parse_model_output(raw_text, DIAGNOSIS_FIELDS, DIAGNOSIS_FIELD_ALIASES)
+
+def parse_roi_decision(raw_text):
+    return parse_model_output(raw_text, ROI_FIELDS, {})
+
+def parse_roi_batch(raw_text, n_tiles):
+    # Per-tile {"Thoughts", "ROI"} decisions in tile order, or None unless the
+    # answer holds exactly one valid entry for each of the n_tiles tiles
+    text = strip_fences(raw_text or '')
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    if not starts:
+        return None
+    try:
+        data = json.JSONDecoder().raw_decode(text, min(starts))[0]
+    except ValueError:
+        return None
+    entries = data.get("Tiles") if isinstance(data, dict) else data
+    if not isinstance(entries, list) or len(entries) != n_tiles or not all(isinstance(entry, dict) for entry in entries):
+        return None
+    if all(isinstance(entry.get("Tile"), int) for entry in entries):
+        if sorted(entry["Tile"] for entry in entries) != list(range(1, n_tiles + 1)):
+            return None
+        entries = sorted(entries, key=lambda entry: entry["Tile"])
+    decisions = []
+    for entry in entries:
+        decision = str(entry.get("ROI", "")).strip().capitalize()
+        if decision not in ("Yes", "No"):
+            return None
+        decisions.append({"Thoughts": entry.get("Thoughts", ""), "ROI": decision})
+    return decisions
+
+def format_parse_status(status):
+    problems = [f"{field}: {field_status}" for field, field_status in status.items() if field_status != 'ok']
+    return '; '.join(problems) if problems else 'ok'
+
+class RoiDecisionScanner:
+    # Incremental scanner for a streamed is_roi answer. Chunks are fed as they
+    # arrive and every character is looked at once; `decision` is set as soon as
+    # the ROI value is complete and `thoughts` holds the (possibly still partial)
+    # reasoning, so the caller can stop the stream without waiting for the rest.
+    def __init__(self):
+        self.decision = None
+        self.thoughts = ''
+        self.thoughts_done = False
+        self.in_string = False
+        self.escape = False
+        self.chars = []
+        self.last_string = None
+        self.value_field = None
+
+    def feed(self, chunk):
+        for c in chunk:
+            if self.in_string:
+                if self.escape:
+                    self.chars.append(ESCAPES.get(c, c))
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    self.end_string(''.join(self.chars))
+                else:
+                    self.chars.append(c)
+            elif c == '"':
+                self.in_string = True
+                self.chars = []
+            elif c == ':':
+                self.value_field = canonical_field(self.last_string, ROI_FIELDS, {}) if self.last_string is not None else None
+                self.last_string = None
+            elif c in ',{}':
+                self.value_field = None
+        if self.in_string and self.value_field == "Thoughts":
+            self.thoughts = ''.join(self.chars)
+
+    def end_string(self, value):
+        if self.value_field is None:
+            self.last_string = value
+            return
+        if self.value_field == "ROI":
+            decision = value.strip().capitalize()
+            if decision in ("Yes", "No"):
+                self.decision = decision
+        elif self.value_field == "Thoughts":
+            self.thoughts = value
+            self.thoughts_done = True
+        self.value_field = None
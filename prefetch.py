@@ -0,0 +1,105 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Read-ahead for the pipelines: `load` (reading, hashing and base64-encoding an
+# image, a tile or a patient's ROIs) runs in background threads for the next
+# items while the caller's requests are in flight. Loaded payloads wait in an
+# ordered queue whose size is capped in bytes; a payload is dropped from the
+# queue when it is handed out, so after that only the request holds it.
+
+def payload_bytes(payload):
+    # Size of the strings/bytes a payload holds (base64 text dominates)
+    if isinstance(payload, (str, bytes)):
+        return len(payload)
+    if isinstance(payload, dict):
+        return sum(payload_bytes(value) for value in payload.values())
+    if isinstance(payload, (list, tuple)):
+        return sum(payload_bytes(value) for value in payload)
+    return 0
+
+class Prefetcher:
+    # iterate(items, load) yields (item, load(item)) in the order of `items`. New
+    # loads start while the queued payloads (with loads still running counted at
+    # the average payload size seen so far) stay below max_bytes and at most
+    # max_items are queued; at least one item is always loaded, however large.
+    # Queue-depth and wait statistics add up over all iterate calls.
+    def __init__(self, max_bytes=256 * 1024**2, max_workers=4, max_items=64):
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.max_items = max_items
+        self.queued_bytes = 0
+        self.loaded = 0
+        self.loaded_bytes = 0
+        self.lock = threading.Lock()
+        self.counts = {"items": 0, "waits": 0, "wait_seconds": 0.0, "depth_total": 0, "depth_max": 0, "queued_bytes_max": 0}
+
+    def settings(self):
+        return {"max_bytes": self.max_bytes, "max_workers": self.max_workers, "max_items": self.max_items}
+
+    def run(self, load, entry):
+        payload = load(entry["item"])
+        size = payload_bytes(payload)
+        with self.lock:
+            self.queued_bytes += size - entry["bytes"]
+            self.counts["queued_bytes_max"] = max(self.counts["queued_bytes_max"], self.queued_bytes)
+            entry["bytes"] = size
+            self.loaded += 1
+            self.loaded_bytes += size
+        return payload
+
+    def reserve(self):
+        with self.lock:
+            estimate = self.loaded_bytes // self.loaded if self.loaded else 0
+            self.queued_bytes += estimate
+            return estimate
+
+    def iterate(self, items, load):
+        items = iter(items)
+        pending = deque()
+        exhausted = False
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while True:
+                while not exhausted and len(pending) < self.max_items and (not pending or self.queued_bytes < self.max_bytes):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    entry = {"item": item, "bytes": self.reserve()}
+                    entry["future"] = executor.submit(self.run, load, entry)
+                    pending.append(entry)
+                if not pending:
+                    return
+                entry = pending.popleft()
+                if not entry["future"].done():
+                    # The caller outran the read-ahead
+                    start = time.monotonic()
+                    entry["future"].exception()
+                    self.counts["waits"] += 1
+                    self.counts["wait_seconds"] += time.monotonic() - start
+                payload = entry["future"].result()
+                with self.lock:
+                    self.queued_bytes -= entry["bytes"]
+                self.counts["items"] += 1
+                self.counts["depth_total"] += len(pending)
+                self.counts["depth_max"] = max(self.counts["depth_max"], len(pending))
+                item = entry["item"]
+                del entry
+                yield item, payload
+                del item, payload
+        finally:
+            for entry in pending:
+                entry["future"].cancel()
+            executor.shutdown(wait=True)
+            # Loads the caller did not take are no longer queued
+            with self.lock:
+                self.queued_bytes -= sum(entry["bytes"] for entry in pending)
+
+    def stats(self):
+        items = self.counts["items"]
+        return {"items": items, "waits": self.counts["waits"], "wait_seconds": round(self.counts["wait_seconds"], 3),
+                "queue_depth_mean": self.counts["depth_total"] / items if items else None, "queue_depth_max": self.counts["depth_max"],
+                "queued_mb_max": round(self.counts["queued_bytes_max"] / 1024**2, 2), "budget_mb": round(self.max_bytes / 1024**2, 2)}
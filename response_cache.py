@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+from openai.types.chat import ChatCompletion
+
+class CacheMissError(Exception):
+    pass
+
+def canonical_messages(messages):
+    # Replace inline base64 images by the SHA-256 of their data so the key does
+    # not have to carry (or re-serialise) megabytes of image payload.
+    canonical = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, (list, tuple)):
+            parts = []
+            for part in content:
+                if part.get("type") == "image_url":
+                    url = part["image_url"]["url"]
+                    part = {"type": "image_url", "image_url": {"sha256": hashlib.sha256(url.encode("utf-8")).hexdigest()}}
+                parts.append(part)
+            content = parts
+        canonical.append({**message, "content": content})
+    return canonical
+
+def make_cache_key(request):
+    request = {**request, "messages": canonical_messages(request["messages"])}
+    return hashlib.sha256(json.dumps(request, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    # On-disk, content-addressed cache of chat completions with LRU eviction:
+    # a hit refreshes the entry's mtime and the oldest entries are removed once
+    # the cache grows beyond max_bytes. `entries` (path -> size) is kept in LRU
+    # order, oldest first, starting from the files' mtimes.
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3, cache_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.cache_only = cache_only
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        files = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+        self.entries = OrderedDict((path, size) for _, path, size in sorted(files))
+        self.total_bytes = sum(self.entries.values())
+        self.evict()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self.lock:
+                self.misses += 1
+            if self.cache_only:
+                raise CacheMissError(f"No cached response for key {key} (cache-only mode).")
+            return None
+        with self.lock:
+            self.hits += 1
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted by another thread after it was read; the data is still good
+                pass
+            if path in self.entries:
+                self.entries.move_to_end(path)
+        return data
+
+    def put(self, key, data):
+        path = self.path_for(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            # Renamed under the lock, so an eviction never runs between the file appearing and its entry
+            os.replace(tmp_path, path)
+            self.total_bytes += size - self.entries.get(path, 0)
+            self.entries[path] = size
+            self.entries.move_to_end(path)
+            self.evict()
+
+    def evict(self):
+        # Called with the lock held (or from __init__); the least recently used entries go first
+        while self.total_bytes > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.entries), "bytes": self.total_bytes}
+
+class CachingClient:
+    # Wraps an OpenAI client and answers chat.completions.create from the cache
+    # when the same request (model, messages, images, sampling params) was sent before.
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+        # Requests answered from the cache through this client
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        if kwargs.get("stream"):
+            return self.client.chat.completions.create(**kwargs)
+        key = make_cache_key(kwargs)
+        cached = self.cache.get(key)
+        if cached is not None:
+            with self.lock:
+                self.hits += 1
+            return ChatCompletion.model_validate(cached)
+        response = self.client.chat.completions.create(**kwargs)
+        self.cache.put(key, response.model_dump(mode="json"))
+        return response
@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import threading
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hash_bytes(f.read())
+
+def hash_files(paths):
+    return hash_bytes("".join(hash_file(path) for path in paths).encode("utf-8"))
+
+def hash_messages(messages):
+    return hash_bytes(json.dumps(messages, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+
+def make_key(patient, image_hash, model_name, prompt_hash):
+    return "|".join([patient, image_hash, model_name, prompt_hash])
+
+def write_json_atomic(path, data):
+    # Write to a temporary file next to the target and rename it, so a crash
+    # never leaves a half-written result behind.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def get_run_dir(out_dir, folder_name, resume_run=None):
+    # Reuse an existing run folder when resuming, otherwise start a fresh one
+    if resume_run is not None:
+        run_dir = os.path.join(out_dir, resume_run)
+        if not os.path.isdir(run_dir):
+            raise FileNotFoundError(f"Cannot resume, run folder {run_dir} does not exist.")
+        return run_dir
+    run_dir = os.path.join(out_dir, folder_name)
+    os.makedirs(run_dir, exist_ok=True)
+    return run_dir
+
+class ResultStore:
+    # Append-only JSONL store of completed model results, one line per item.
+    # Every line is flushed and fsynced, and a torn last line from a crash is
+    # ignored on load, so each stored result is either complete or absent.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.results[record["key"]] = record["value"]
+            # Terminate a torn last line so the next record starts on its own line
+            with open(path, "rb+") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def get(self, key, default=None):
+        return self.results.get(key, default)
+
+    def put(self, key, value):
+        line = json.dumps({"key": key, "value": value}, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.results[key] = value
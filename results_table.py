@@ -0,0 +1,55 @@
+import os
+import csv
+import glob
+import json
+from output_parser import format_parse_status, parse_diagnosis
+from schemas import DIAGNOSIS_FIELDS
+from tile_output import ManifestWriter
+
+RESULT_FIELDS = ['Patient'] + DIAGNOSIS_FIELDS + ['Parse_Status']
+# Multi-model sweeps keep one row per patient and model
+SWEEP_RESULT_FIELDS = ['Patient', 'Model'] + DIAGNOSIS_FIELDS + ['Parse_Status']
+# Self-consistency runs add the sample count and per-field dispersion of the aggregated diagnosis
+CONSISTENCY_RESULT_FIELDS = RESULT_FIELDS + ['Samples', 'Diagnose_Dispersion', 'Blastengehalt_Dispersion', 'Dispersion']
+CONSISTENCY_FLOAT_FIELDS = ('Samples', 'Diagnose_Dispersion', 'Blastengehalt_Dispersion')
+
+def diagnosis_row(patient, raw_diagnose, **extra):
+    # One results row with a fixed set of columns; keys outside the schema are dropped
+    values, status = parse_diagnosis(raw_diagnose)
+    row = {"Patient": patient, **extra, "Parse_Status": format_parse_status(status)}
+    for field in DIAGNOSIS_FIELDS:
+        value = values.get(field)
+        row[field] = value if value is None or isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    return row
+
+class ResultsTable(ManifestWriter):
+    # Appends one parsed diagnosis per patient as soon as it is available, so
+    # the table on disk grows with the run and memory stays bounded by batch_size.
+    def __init__(self, path, batch_size=50, fields=RESULT_FIELDS, float_fields=()):
+        super().__init__(path, batch_size=batch_size, fields=fields, float_fields=float_fields)
+
+    def add_diagnosis(self, patient, raw_diagnose, **extra):
+        self.add(diagnosis_row(patient, raw_diagnose, **extra))
+
+def iter_table_rows(path, batch_size=1000):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        # A directory of part files in write order (see ManifestWriter), or a single file
+        parts = sorted(glob.glob(os.path.join(path, 'part-*.parquet'))) if os.path.isdir(path) else [path]
+        for part in parts:
+            for batch in pq.ParquetFile(part).iter_batches(batch_size=batch_size):
+                yield from batch.to_pylist()
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            yield from csv.DictReader(f)
+
+def export_excel(table_path, output_file, fields=RESULT_FIELDS):
+    # Streams the results table into a write-only workbook instead of building a DataFrame
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(fields)
+    if os.path.exists(table_path):
+        for row in iter_table_rows(table_path):
+            sheet.append([row.get(field) for field in fields])
+    workbook.save(output_file)
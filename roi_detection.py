@@ -2,13 +2,31 @@ import zipfile
 import os
 from tqdm import tqdm
 import json
-from openai import OpenAI
+from llm_client import LatencyHistogram, create_client, create_structured
+from instrumentation import CallRecorder, InstrumentedClient
 import pandas as pd
 import base64
 from datetime import datetime
 import shutil
 import csv
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from image_preprocessing import ImagePreprocessor
+from response_cache import ResponseCache, CachingClient
+from result_store import ResultStore, get_run_dir, hash_bytes, hash_messages, make_key, write_json_atomic
+from itertools import islice
+from output_parser import RoiDecisionScanner, parse_roi_batch
+from schemas import ROI_DECISION_FIRST_JSON_SCHEMA, ROI_JSON_SCHEMA, roi_batch_json_schema, structured_output_kwargs
+from batch_inference import BatchShardWriter, batch_request, ingest_batch_outputs
+from tile_prefilter import TilePrefilter
+from tile_sampling import sample_slide
+from tile_dedup import TileDeduplicator
+from prefetch import Prefetcher
+from tile_output import ManifestWriter, TileSorter, parse_tile_coordinates
+from tile_sources import ZipTile, count_zip_tiles, materialize_tile, read_tile, stream_zip_tiles, tile_name, tile_patient, zip_patient
 
 def unzip_files(input_files, output_folder):
     patients = []
@@ -25,12 +43,36 @@ def load_images(image_dir):
     images = [os.path.join(image_dir, i) for i in images if '.jpg' in i]
     return images
 
+# Optional ImagePreprocessor applied before base64 encoding, set in __main__
+image_preprocessor = None
+
 def encode_image(image_path):
+    if image_preprocessor is not None:
+        return image_preprocessor.encode(image_path)
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
+
+def encode_tile(tile, data = None):
+    # `data` are the tile's bytes when the caller has already read them
+    if data is None:
+        if not isinstance(tile, ZipTile):
+            return encode_image(tile)
+        data = tile.data
+    if image_preprocessor is not None:
+        return image_preprocessor.encode_bytes(data)
+    return base64.b64encode(data).decode('utf-8')
     
-def is_roi(client, example_images_ROI, example_images_NOT_ROI, base64_image, model_name, max_tokens, temperature):
-    
+few_shot_cache = {}
+few_shot_lock = threading.Lock()
+
+def few_shot_signature(example_images_ROI, example_images_NOT_ROI):
+    def stat_paths(paths):
+        stats = [(path, os.stat(path)) for path in paths]
+        return tuple((path, stat.st_mtime_ns, stat.st_size) for path, stat in stats)
+    preprocessing = tuple(sorted(image_preprocessor.settings().items())) if image_preprocessor is not None else None
+    return stat_paths(example_images_ROI), stat_paths(example_images_NOT_ROI), preprocessing
+
+def build_few_shot_prefix(example_images_ROI, example_images_NOT_ROI):
     encoded_example_images_ROI = [
         {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(path)}"}}
         for path in example_images_ROI
@@ -39,37 +81,32 @@ def is_roi(client, example_images_ROI, example_images_NOT_ROI, base64_image, mod
     encoded_example_images_NOT_ROI = [
         {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encode_image(path)}"}}
         for path in example_images_NOT_ROI
-    ]        
-    response = client.chat.completions.create(
-        model = model_name,
-        messages=[
-            {
-                "role": "system",
-                "content": """
+    ]
+    system_message = {
+        "role": "system",
+        "content": """
                 You are an expert pathologist’s assistant trained to support diagnostic workflows by identifying regions of interest (ROIs) in bone marrow histology images.
                 Your role is to determine whether an image region is suitable for further diagnostic analysis, such as cell morphology assessment and lineage quantification.
                 """,
-            },
-            {
-                "role": "user",
-                "content": [
-                {
-                "type": "text",
-                "text": f"""
+    }
+    user_content = (
+        {
+        "type": "text",
+        "text": f"""
                 Here are few example ROI images that are considered diagnostically relevant (ROI = Yes):
                 """
-                },
-                *encoded_example_images_ROI,
-                {
-                "type": "text",
-                "text": f"""
+        },
+        *encoded_example_images_ROI,
+        {
+        "type": "text",
+        "text": f"""
                 Here are few example ROI images that are considered diagnostically NOT relevant (ROI = No):
                 """
-                },
-                *encoded_example_images_NOT_ROI,                
-                {
-                    "type": "text",
-                    "text": """A diagnostically useful tile (ROI = Yes) must meet **all** of the following criteria:
+        },
+        *encoded_example_images_NOT_ROI,
+        {
+            "type": "text",
+            "text": """A diagnostically useful tile (ROI = Yes) must meet **all** of the following criteria:
                     - It is sharply focused and clearly stained.
                     - It shows evenly distributed cellular content with distinguishable cells.
                     - It has adequate cellularity
@@ -87,24 +124,431 @@ def is_roi(client, example_images_ROI, example_images_NOT_ROI, base64_image, mod
                     Tiles with predominantly fat, background, damaged tissue, or poor staining/focus should be rejected (ROI = No), even if a small amount of tissue is present.Your output should follow this exact JSON format:{{"Thoughts": "<your brief analysis and reasoning>", "ROI": "<Yes or No>"}}.
                     Now, evaluate the following new image:
                     """
-                },
+        }
+    )
+    return system_message, user_content
+
+def get_few_shot_prefix(example_images_ROI, example_images_NOT_ROI):
+    # The examples are read and encoded once per run; the cached prefix is only
+    # rebuilt when the example file set, one of their mtimes or the preprocessing changes.
+    signature = few_shot_signature(example_images_ROI, example_images_NOT_ROI)
+    with few_shot_lock:
+        if signature not in few_shot_cache:
+            few_shot_cache.clear()
+            few_shot_cache[signature] = build_few_shot_prefix(example_images_ROI, example_images_NOT_ROI)
+        return few_shot_cache[signature]
+
+ROI_DECISION_FIRST_INSTRUCTION = """Give the decision before your reasoning, in this exact JSON format:{"ROI": "<Yes or No>", "Thoughts": "<your brief analysis and reasoning>"}
+                    """
+
+def build_roi_messages(prefix, base64_image, decision_first = False):
+    # Everything up to the query tile is identical across calls, so servers with
+    # prefix caching (e.g. vLLM) can reuse the few-shot part of the prompt.
+    system_message, user_content = prefix
+    if decision_first:
+        user_content = (*user_content, {"type": "text", "text": ROI_DECISION_FIRST_INSTRUCTION})
+    return [
+        system_message,
+        {
+            "role": "user",
+            "content": [
+                *user_content,
                 {
                     "type": "image_url",
                     "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
                 }
-                ]
-            }
-        ],
+            ]
+        }
+    ]
+
+class RoiStreaming:
+    # Streams the is_roi answer and scans it as it arrives. The decision is known
+    # as soon as the "ROI" value is complete; with thoughts_chars set, the stream is
+    # closed once the decision and that many characters of reasoning (0 = none)
+    # are in, which frees the server slot without generating the rest. With
+    # decision_first the prompt asks for {"ROI", "Thoughts"} so the decision
+    # comes before the reasoning. thoughts_chars=None reads the whole answer.
+    def __init__(self, decision_first = False, thoughts_chars = None):
+        self.decision_first = decision_first
+        self.thoughts_chars = thoughts_chars
+        self.time_to_decision = LatencyHistogram()
+        self.counts = {"requests": 0, "cancelled": 0, "no_decision": 0}
+        self.lock = threading.Lock()
+
+    def settings(self):
+        return {"decision_first": self.decision_first, "thoughts_chars": self.thoughts_chars}
+
+    def done(self, scanner):
+        if scanner.decision is None or self.thoughts_chars is None:
+            return False
+        return scanner.thoughts_done or len(scanner.thoughts) >= self.thoughts_chars
+
+    def schema(self):
+        return ROI_DECISION_FIRST_JSON_SCHEMA if self.decision_first else ROI_JSON_SCHEMA
+
+    def read(self, stream, start):
+        # Reads a streamed answer started at `start` (time.monotonic()). The request itself is
+        # sent by is_roi, so the instrumentation records it under the is_roi stage
+        scanner = RoiDecisionScanner()
+        parts = []
+        cancelled = False
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content or ''
+                parts.append(content)
+                decided = scanner.decision is not None
+                scanner.feed(content)
+                if not decided and scanner.decision is not None:
+                    self.time_to_decision.observe(time.monotonic() - start)
+                if self.done(scanner):
+                    cancelled = True
+                    break
+        finally:
+            stream.close()
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["cancelled"] += cancelled
+            self.counts["no_decision"] += scanner.decision is None
+        if cancelled:
+            return json.dumps({"Thoughts": scanner.thoughts[:self.thoughts_chars], "ROI": scanner.decision}, ensure_ascii = False)
+        return ''.join(parts)
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return {**counts, "time_to_decision_p50": self.time_to_decision.percentile(50), "time_to_decision_p95": self.time_to_decision.percentile(95)}
+
+def is_roi(client, example_images_ROI, example_images_NOT_ROI, base64_image, model_name, max_tokens, temperature, structured_output = None, streaming = None):
+    prefix = get_few_shot_prefix(example_images_ROI, example_images_NOT_ROI)
+    if streaming is not None:
+        start = time.monotonic()
+        stream = create_structured(client, structured_output, streaming.schema(), 'roi_decision',
+            model = model_name,
+            messages = build_roi_messages(prefix, base64_image, streaming.decision_first),
+            max_tokens = max_tokens,
+            temperature = temperature,
+            stream = True,
+            stream_options = {"include_usage": True})
+        return streaming.read(stream, start)
+    response = create_structured(client, structured_output, ROI_JSON_SCHEMA, 'roi_decision',
+        model = model_name,
+        messages = build_roi_messages(prefix, base64_image),
         max_tokens=max_tokens,
         temperature=temperature)
     
     file_content = response.choices[0].message.content
     return file_content   
 
+ROI_BATCH_INSTRUCTION = """Instead of a single image, you will receive {n_tiles} numbered tiles. Evaluate every tile independently with the criteria above.
+                    Your output should follow this exact JSON format, with one entry per tile in the given order:{{"Tiles": [{{"Tile": 1, "Thoughts": "<your brief analysis and reasoning>", "ROI": "<Yes or No>"}}, ...]}}
+                    """
+
+def build_roi_batch_messages(prefix, base64_images):
+    # The few-shot prefix is left byte-identical so it stays cacheable; the
+    # batch instruction and the numbered tiles follow it
+    system_message, user_content = prefix
+    tiles = []
+    for number, base64_image in enumerate(base64_images, 1):
+        tiles.append({"type": "text", "text": f"Tile {number}:"})
+        tiles.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}})
+    return [
+        system_message,
+        {
+            "role": "user",
+            "content": [*user_content, {"type": "text", "text": ROI_BATCH_INSTRUCTION.format(n_tiles = len(base64_images))}, *tiles]
+        }
+    ]
+
+def is_roi_batch(client, example_images_ROI, example_images_NOT_ROI, base64_images, model_name, max_tokens, temperature, structured_output = None):
+    prefix = get_few_shot_prefix(example_images_ROI, example_images_NOT_ROI)
+    response = create_structured(client, structured_output, roi_batch_json_schema(len(base64_images)), 'roi_batch_decision',
+        model = model_name,
+        messages = build_roi_batch_messages(prefix, base64_images),
+        max_tokens = max_tokens * len(base64_images),
+        temperature = temperature)
+    return response.choices[0].message.content
+
+def roi_prompt_hash(example_images_ROI, example_images_NOT_ROI, structured_output = None, batched = False, streaming = None):
+    prompt_hash = hash_messages(build_roi_messages(get_few_shot_prefix(example_images_ROI, example_images_NOT_ROI), ''))
+    if structured_output is not None:
+        prompt_hash = hash_messages([prompt_hash, structured_output])
+    if batched:
+        prompt_hash = hash_messages([prompt_hash, ROI_BATCH_INSTRUCTION])
+    if streaming is not None:
+        # Decision-first prompts and shortened reasoning give different stored answers
+        prompt_hash = hash_messages([prompt_hash, streaming.settings()])
+    return prompt_hash
+
+def prefilter_tile(prefilter, image, data = None):
+    # Returns (response, triage): a stand-in is_roi answer for tiles the prefilter
+    # decides on its own (None otherwise) and the triage record for the manifest
+    decision, reason, metrics = prefilter.check(read_tile(image) if data is None else data)
+    triage = {"Triage": {"reject": "auto_reject", "accept": "auto_accept"}.get(decision, "model"), **metrics}
+    if decision == "model":
+        return None, triage
+    return json.dumps({"Thoughts": f"Prefilter: {reason}", "ROI": "Yes" if decision == "accept" else "No"}), triage
+
+def prepare_tile(image, model_name, store = None, prompt_hash = None, prefilter = None, data = None):
+    # The local work before an is_roi request, returned as (response, triage, key, base64_image).
+    # Tiles the prefilter decides on never reach the model; with a result store,
+    # tiles already answered in an earlier run are served from it. In both cases
+    # `response` is set and the tile is not encoded. The tile is read once (not at
+    # all when `data` already holds its bytes) for the prefilter, the key and the encoding.
+    data = read_tile(image) if data is None else data
+    triage = None
+    if prefilter is not None:
+        response_str, triage = prefilter_tile(prefilter, image, data)
+        if response_str is not None:
+            return response_str, triage, None, None
+    key = None
+    if store is not None:
+        key = make_key(tile_patient(image), hash_bytes(data), model_name, prompt_hash)
+        if key in store:
+            return store.get(key), triage, key, None
+    return None, triage, key, encode_tile(image, data)
+
+def classify_tile(client, image, example_images_ROI, example_images_NOT_ROI, model_name, max_tokens, temperature, store = None, prompt_hash = None,
+                  structured_output = None, prefilter = None, streaming = None, prepared = None):
+    # `prepared` is the prepare_tile result when a Prefetcher already did the local work
+    response_str, triage, key, base64_image = prepared if prepared is not None else prepare_tile(image, model_name, store, prompt_hash, prefilter)
+    if response_str is not None:
+        return image, response_str, triage
+    response_str = is_roi(client = client, base64_image = base64_image, example_images_ROI = example_images_ROI, example_images_NOT_ROI = example_images_NOT_ROI, 
+                          max_tokens = max_tokens, temperature = temperature, model_name = model_name, structured_output = structured_output,
+                          streaming = streaming)
+    if key is not None:
+        store.put(key, response_str)
+    return image, response_str, triage
+
+def classify_tile_batch(client, images, example_images_ROI, example_images_NOT_ROI, model_name, max_tokens, temperature, store = None, prompt_hash = None,
+                        structured_output = None, prefilter = None, streaming = None, prepared = None):
+    # Classifies up to K tiles with one is_roi_batch request and returns the same
+    # (image, response, triage) triples as classify_tile. If the answer does not
+    # hold exactly one decision per tile, the batch is split in half and retried;
+    # a single remaining tile falls back to the plain is_roi prompt.
+    results = [None] * len(images)
+    queued = []
+    if prepared is None:
+        prepared = [prepare_tile(image, model_name, store, prompt_hash, prefilter) for image in images]
+    for index, (image, (response_str, triage, key, base64_image)) in enumerate(zip(images, prepared)):
+        if response_str is not None:
+            results[index] = (image, response_str, triage)
+            continue
+        queued.append((index, image, triage, key, base64_image))
+    del prepared
+
+    def ask(batch):
+        if len(batch) == 1:
+            response_strs = [is_roi(client = client, base64_image = batch[0][4], example_images_ROI = example_images_ROI, example_images_NOT_ROI = example_images_NOT_ROI,
+                                    max_tokens = max_tokens, temperature = temperature, model_name = model_name, structured_output = structured_output,
+                                    streaming = streaming)]
+        else:
+            response = is_roi_batch(client, example_images_ROI, example_images_NOT_ROI, [entry[4] for entry in batch], model_name, max_tokens, temperature, structured_output)
+            decisions = parse_roi_batch(response, len(batch))
+            if decisions is None:
+                print(f"Batched ROI answer does not match its {len(batch)} tiles, splitting the batch")
+                ask(batch[:len(batch) // 2])
+                ask(batch[len(batch) // 2:])
+                return
+            response_strs = [json.dumps(decision, ensure_ascii = False) for decision in decisions]
+        for (index, image, triage, key, _), response_str in zip(batch, response_strs):
+            if key is not None:
+                store.put(key, response_str)
+            results[index] = (image, response_str, triage)
+
+    if queued:
+        ask(queued)
+    return results
+
+def classify_tiles(client, images, example_images_ROI, example_images_NOT_ROI, model_name, max_tokens, temperature, max_in_flight = 8, store = None, prompt_hash = None,
+                   structured_output = None, prefilter = None, tiles_per_request = 1, streaming = None, prefetcher = None, dedup = None, loaded = None):
+    # Yields (image, response, triage) in the order of `images` while keeping at most
+    # `max_in_flight` requests open; submitting blocks until a slot frees up and
+    # finished results waiting behind a slow tile are capped at 2 * max_in_flight.
+    # With tiles_per_request > 1 every request classifies that many tiles at once;
+    # `streaming` (a RoiStreaming) applies to the single-tile is_roi requests.
+    # With a Prefetcher, prepare_tile (prefilter, store lookup, read and encode)
+    # runs ahead in the background while requests are waiting for a slot.
+    # With a TileDeduplicator only one tile per group of near-duplicates is
+    # classified; the others reuse its answer and come out as soon as it is known.
+    # `loaded` maps (patient, tile name) to bytes already read (by the deduplicator);
+    # they are taken out as the tiles are prepared, so no tile is read twice.
+    if dedup is not None:
+        key_of = (lambda image, data: make_key(tile_patient(image), hash_bytes(data), model_name, prompt_hash)) if store is not None else None
+        yield from dedup.classify(images, lambda unique, loaded: classify_tiles(client, unique, example_images_ROI, example_images_NOT_ROI, model_name, max_tokens,
+                                                                                temperature, max_in_flight, store, prompt_hash, structured_output, prefilter,
+                                                                                tiles_per_request, streaming, prefetcher, loaded = loaded),
+                                  key_of, store)
+        return
+    slots = threading.BoundedSemaphore(max_in_flight)
+    pending = deque()
+    take = (lambda image: loaded.pop((tile_patient(image), tile_name(image)), None)) if loaded is not None else (lambda image: None)
+    if tiles_per_request > 1:
+        images = iter(images)
+        units = iter(lambda: list(islice(images, tiles_per_request)), [])
+        classify = classify_tile_batch
+        prepare = lambda unit: [prepare_tile(image, model_name, store, prompt_hash, prefilter, take(image)) for image in unit]
+    else:
+        units = images
+        classify = classify_tile
+        prepare = lambda unit: prepare_tile(unit, model_name, store, prompt_hash, prefilter, take(unit))
+    units = prefetcher.iterate(units, prepare) if prefetcher is not None else ((unit, None) for unit in units)
+
+    def work(unit, prepared):
+        # Without a prefetcher the local work runs here, in the request's thread
+        return classify(client, unit, example_images_ROI, example_images_NOT_ROI, model_name, max_tokens, temperature, store, prompt_hash, structured_output,
+                        prefilter, streaming, prepared if prepared is not None else prepare(unit))
+
+    def results(future):
+        return future.result() if tiles_per_request > 1 else [future.result()]
+
+    with ThreadPoolExecutor(max_workers = max_in_flight) as executor:
+        for unit, prepared in units:
+            while len(pending) >= 2 * max_in_flight:
+                yield from results(pending.popleft())
+            slots.acquire()
+            future = executor.submit(work, unit, prepared)
+            # The encoded tile is only referenced by the request from here on
+            del prepared
+            future.add_done_callback(lambda _: slots.release())
+            pending.append(future)
+            while pending and pending[0].done():
+                yield from results(pending.popleft())
+        while pending:
+            yield from results(pending.popleft())
+
+def write_roi_batch(images, example_images_ROI, example_images_NOT_ROI, model_name, max_tokens, temperature, store, prompt_hash, batch_dir,
+                    structured_output = None, prefilter = None):
+    # Renders the is_roi request of every tile not yet in the store into batch shards;
+    # tiles the prefilter decides on are left out, ingestion re-triages them locally
+    writer = BatchShardWriter(batch_dir, 'roi')
+    prefix = get_few_shot_prefix(example_images_ROI, example_images_NOT_ROI)
+    # Byte-identical tiles of one patient share a key; the batch service rejects a repeated custom_id
+    seen = set()
+    for image in images:
+        data = read_tile(image)
+        if prefilter is not None and prefilter_tile(prefilter, image, data)[0] is not None:
+            continue
+        key = make_key(tile_patient(image), hash_bytes(data), model_name, prompt_hash)
+        if key in store or key in seen:
+            continue
+        seen.add(key)
+        writer.add(batch_request(key, model_name, build_roi_messages(prefix, encode_tile(image, data)), max_tokens = max_tokens, temperature = temperature,
+                                 **structured_output_kwargs(ROI_JSON_SCHEMA, 'roi_decision', structured_output)))
+    return writer.close()
+
+def sort_tile(tile, response_str, roi_folder, not_roi_folder, sorter = None, manifest = None, triage = None, sampling = None):
+    # With tile sampling, tiles that were never sent to the model come with response_str None
+    # and are only recorded: 'inferred' ones as Is_ROI No, 'unvisited' ones without a decision
+    image = tile_name(tile)
+    x, y = parse_tile_coordinates(image)
+    if response_str is None:
+        roi_description = {"ROI": 'ROI_' + image.split('_')[-1].replace('.png', ''), "Sampling": sampling}
+        if sampling == 'inferred':
+            roi_description["Is_ROI"] = "No"
+        if manifest is not None:
+            manifest.add({"Patient": tile_patient(tile), "Tile": image, "X": x, "Y": y, "Is_ROI": roi_description.get("Is_ROI"), "Sampling": sampling})
+        return roi_description
+    try:
+        response_json = json.loads(response_str)
+        roi_description = {
+            "ROI": 'ROI_' + image.split('_')[-1].replace('.png', ''),
+            "Thoughts": response_json["Thoughts"],
+            "Is_ROI": response_json["ROI"]
+        }
+        if triage is not None and triage["Triage"] != "model":
+            roi_description["Triage"] = triage["Triage"]
+        if triage is not None and "Duplicate_Of" in triage:
+            roi_description["Duplicate_Of"] = triage["Duplicate_Of"]
+        if sampling is not None:
+            roi_description["Sampling"] = sampling
+        if response_json["ROI"] == "Yes":
+            destination = os.path.join(roi_folder, image.split('_')[-1])
+        else:
+            destination = os.path.join(not_roi_folder, image.split('_')[-1])
+        if sorter is None:
+            materialize_tile(tile, destination)
+        else:
+            sorter.place(tile, destination)
+    except:
+        print(image)
+        roi_description = {
+            "ROI": 'ROI_' + image.split('_')[-1].replace('.png', ''),
+            "Error": response_str
+        }
+    if manifest is not None:
+        manifest.add({"Patient": tile_patient(tile), "Tile": image, "X": x, "Y": y,
+                      "Is_ROI": roi_description.get("Is_ROI"), "Thoughts": roi_description.get("Thoughts"), "Sampling": sampling, **(triage or {})})
+    return roi_description
+
+def make_patient_folders(out_dir, patient):
+    PATIENT_OUT_DIR = os.path.join(out_dir, patient)
+    os.makedirs(PATIENT_OUT_DIR, exist_ok = True)
+    
+    ROI_FOLDER = os.path.join(PATIENT_OUT_DIR, 'ROIs')
+    os.makedirs(ROI_FOLDER, exist_ok = True)
+    
+    NOT_ROI_FOLDER = os.path.join(PATIENT_OUT_DIR, 'NOT_ROIs')
+    os.makedirs(NOT_ROI_FOLDER, exist_ok = True)
+    return ROI_FOLDER, NOT_ROI_FOLDER
+
 if __name__ == "__main__":
     
     
     unzipFiles = False
+    # 'interactive' queries the server directly; 'batch_submit' writes OpenAI Batch JSONL shards to <run>/batch_requests and stops;
+    # 'batch_ingest' (with resume_run set to that run) loads the outputs from <run>/batch_outputs and then runs as usual
+    run_mode = 'interactive'
+    # Classify tiles straight out of the zip archives instead of extracting them to IMG_DIR first
+    streamZipFiles = False
+    max_archives_in_flight = 4
+    # How classified tiles land in ROIs/NOT_ROIs: 'copy', 'hardlink', 'symlink' or 'manifest' (no files, manifest only)
+    output_mode = 'copy'
+    max_in_flight = 8
+    # Tiles classified per is_roi request; >1 shares the few-shot context between tiles (batch modes always send single tiles)
+    tiles_per_request = 1
+    # Set to an existing 'run_<timestamp>' folder name to resume it; finished tiles are not re-queried
+    resume_run = None
+    # Responses are cached across runs under MAIN_DIR/response_cache; cache_only fails fast on a miss.
+    # Off by default: with the cache on, rerunning the same request returns the stored answer instead of a new sample
+    use_response_cache = False
+    cache_only = False
+    # Downscale and re-encode images as JPEG before sending them; bytes saved are printed at the end
+    preprocess_images = False
+    # Constrain decoding to the {"Thoughts", "ROI"} schema: None (free-form), 'json_schema', 'guided_json' (vLLM) or 'json_object'
+    structured_output = None
+    # Local image-quality triage before is_roi: clear negatives (background, blur, little tissue) are rejected without
+    # a model call, with auto_accept_tiles also clear positives; thresholds override tile_prefilter.DEFAULT_THRESHOLDS
+    prefilter_tiles = False
+    auto_accept_tiles = False
+    prefilter_thresholds = {}
+    # Stream is_roi answers and act on the decision as soon as it arrives (interactive mode only). With roi_decision_first
+    # the model answers {"ROI", "Thoughts"}; roi_thoughts_chars closes the stream after the decision plus that many
+    # characters of reasoning (0 = decision only), None keeps the full reasoning
+    stream_roi = False
+    roi_decision_first = False
+    roi_thoughts_chars = None
+    # Read, hash and encode upcoming tiles in the background while requests are in flight; the encoded tiles
+    # waiting for a request are capped at prefetch_mb (None reads each tile right before its request)
+    prefetch_mb = 256
+    # Coarse-to-fine sampling per slide (extracted tiles, interactive mode): a lattice of every sampling_stride-th tile
+    # first, then the neighbours of positive tiles, until target_rois_per_patient ROIs are found. With the prefilter on,
+    # lattice tiles with at least sampling_tissue_threshold tissue coverage are expanded as well. Tiles never sent to
+    # the model are marked 'inferred' (No) or 'unvisited' in the manifest
+    sample_tiles = False
+    target_rois_per_patient = 30
+    sampling_stride = 4
+    sampling_tissue_threshold = None
+    # Group near-identical tiles of a patient by perceptual hash (within dedup_threshold bits) and classify one tile per
+    # group; the hash index is kept across runs in MAIN_DIR/tile_hash_index.jsonl, groups are listed in the manifest
+    dedup_tiles = False
+    dedup_threshold = 4
+    # Shared server limits, None disables a limit
+    max_connections = 32
+    requests_per_second = 8
+    tokens_per_minute = None
     MAIN_DIR = '/mnt/bulk-ganymede/narmin/narmin/AML_Project/roi_detection'
     IMG_DIR = '/mnt/bulk-ganymede/narmin/narmin/AML_Project/tiles'
     OUT_DIR = MAIN_DIR + '/output'
@@ -112,8 +556,8 @@ if __name__ == "__main__":
     
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     folder_name = f"run_{timestamp}"
-    OUT_DIR = os.path.join(OUT_DIR, folder_name)
-    os.makedirs(OUT_DIR, exist_ok = True)
+    OUT_DIR = get_run_dir(OUT_DIR, folder_name, resume_run)
+    store = ResultStore(os.path.join(OUT_DIR, 'results_store.jsonl'))
     
     shutil.copy('/mnt/bulk-ganymede/narmin/narmin/AML_Project/AML_Project/roi_detection.py', os.path.join(OUT_DIR, 'roi_detection.txt'))
 
@@ -132,51 +576,92 @@ if __name__ == "__main__":
     with open('/mnt/bulk-ganymede/narmin/narmin/MSI_LLM/key.json', 'r') as f:
         config = json.load(f)
     
-    client = OpenAI(api_key=config['Pluto'], base_url= 'http://192.168.33.27/v1')
+    # All model calls share one pooled, rate-limited and retrying client
+    api_client = create_client(api_key=config['Pluto'], base_url= 'http://192.168.33.27/v1', max_connections = max_connections,
+                               requests_per_second = requests_per_second, tokens_per_minute = tokens_per_minute)
+    # Every request that reaches the server is logged to model_calls.jsonl; a per-stage summary and metrics.prom follow at the end
+    recorder = CallRecorder(os.path.join(OUT_DIR, 'model_calls.jsonl'))
+    client = InstrumentedClient(api_client, recorder)
+    if use_response_cache:
+        response_cache = ResponseCache(os.path.join(MAIN_DIR, 'response_cache'), cache_only = cache_only)
+        client = CachingClient(client, response_cache)
+    if preprocess_images:
+        image_preprocessor = ImagePreprocessor(max_side = 1024, jpeg_quality = 85, cache_dir = os.path.join(MAIN_DIR, 'preprocessed_images'))
+    prefilter = TilePrefilter(prefilter_thresholds, auto_accept = auto_accept_tiles) if prefilter_tiles else None
+    prefetcher = Prefetcher(prefetch_mb * 1024**2) if prefetch_mb is not None else None
+    dedup = TileDeduplicator(os.path.join(MAIN_DIR, 'tile_hash_index.jsonl'), dedup_threshold) if dedup_tiles else None
+    streaming = RoiStreaming(roi_decision_first, roi_thoughts_chars) if stream_roi and run_mode == 'interactive' else None
     
-    if unzipFiles:
-        patients = unzip_files(input_files = ['/mnt/bulk-saturn/chiara/chiara/02_features/HAEMA/UNI/AML_Cache_Cytomorph_Proj/AML_Box1_OT02.56cfab1ca35970e42e8faaf702ecb1d0915f561ad56caf5f71488e670d85a6e5.zip',
-                                '/mnt/bulk-saturn/chiara/chiara/02_features/HAEMA/UNI/AML_Cache_Cytomorph_Proj/AML_Box1_OT07.91f38e22c02cba09ca71626faead1cca0b8cc7c7a12cf752bd801384791d0dbb.zip', 
-                                '/mnt/bulk-saturn/chiara/chiara/02_features/HAEMA/UNI/AML_Cache_Cytomorph_Proj/AML_Box1_OT16.a0412ad97200ac615ddfcf3aa9fe8ba4ffb625ac9a8948240494c5ba684ce0a2.zip'],
-                    output_folder = IMG_DIR)
+    zip_files = ['/mnt/bulk-saturn/chiara/chiara/02_features/HAEMA/UNI/AML_Cache_Cytomorph_Proj/AML_Box1_OT02.56cfab1ca35970e42e8faaf702ecb1d0915f561ad56caf5f71488e670d85a6e5.zip',
+                 '/mnt/bulk-saturn/chiara/chiara/02_features/HAEMA/UNI/AML_Cache_Cytomorph_Proj/AML_Box1_OT07.91f38e22c02cba09ca71626faead1cca0b8cc7c7a12cf752bd801384791d0dbb.zip', 
+                 '/mnt/bulk-saturn/chiara/chiara/02_features/HAEMA/UNI/AML_Cache_Cytomorph_Proj/AML_Box1_OT16.a0412ad97200ac615ddfcf3aa9fe8ba4ffb625ac9a8948240494c5ba684ce0a2.zip']
+    
+    if streamZipFiles:
+        tile_counts = {zip_patient(zip_file): count_zip_tiles(zip_file) for zip_file in zip_files}
+        tiles = stream_zip_tiles(zip_files, max_workers = max_archives_in_flight)
+    else:
+        if unzipFiles:
+            patients = unzip_files(input_files = zip_files, output_folder = IMG_DIR)
+        else:
+            patients = os.listdir(IMG_DIR)
+        patient_images = {patient: load_images(os.path.join(IMG_DIR, patient)) for patient in patients}
+        tile_counts = {patient: len(images) for patient, images in patient_images.items()}
+        tiles = (image for images in patient_images.values() for image in images)
+    
+    model_name = 'Llama-4-Maverick-17B-128E-Instruct-FP8'
+    prompt_hash = roi_prompt_hash(example_images_ROI, example_images_NOT_ROI, structured_output, batched = tiles_per_request > 1 and run_mode == 'interactive',
+                                  streaming = streaming)
+    
+    if run_mode == 'batch_ingest':
+        stored, failed = ingest_batch_outputs(os.path.join(OUT_DIR, 'batch_outputs'), store)
+        print(f"Ingested {stored} batch results, {failed} failed requests will be queried interactively")
+    
+    if run_mode == 'batch_submit':
+        shards = write_roi_batch(tqdm(tiles, total = sum(tile_counts.values())), example_images_ROI, example_images_NOT_ROI, model_name, 1000, 0.2,
+                                 store, prompt_hash, os.path.join(OUT_DIR, 'batch_requests'), structured_output, prefilter)
+        print(f"Wrote {len(shards)} batch shards to {os.path.join(OUT_DIR, 'batch_requests')}; put their outputs into "
+              f"{os.path.join(OUT_DIR, 'batch_outputs')} and rerun with run_mode = 'batch_ingest', resume_run = '{os.path.basename(OUT_DIR)}'")
     else:
-        patients = os.listdir(IMG_DIR)
-    
-    for patient in patients:
-        images = load_images(os.path.join(IMG_DIR, patient))
-        patient_output_folder = os.path.join(OUT_DIR, patient + '.json')
-        roi_descriptions = []
-        
-        PATIENT_OUT_DIR = os.path.join(OUT_DIR, patient)
-        os.makedirs(PATIENT_OUT_DIR, exist_ok = True)
-        
-        ROI_FOLDER = os.path.join(PATIENT_OUT_DIR, 'ROIs')
-        os.makedirs(ROI_FOLDER, exist_ok = True)
-        
-        NOT_ROI_FOLDER = os.path.join(PATIENT_OUT_DIR, 'NOT_ROIs')
-        os.makedirs(NOT_ROI_FOLDER, exist_ok = True)
-    
-        for image in tqdm(images):
-            base64_image = encode_image(image)
-            response_str = is_roi(client = client, base64_image = base64_image, example_images_ROI = example_images_ROI, example_images_NOT_ROI = example_images_NOT_ROI, max_tokens = 1000, temperature = 0.2, 
-                                     model_name = 'Llama-4-Maverick-17B-128E-Instruct-FP8')
-            try:
-                response_json = json.loads(response_str)
-                roi_descriptions.append({
-                    "ROI": 'ROI_' + image.split('_')[-1].replace('.png', ''),
-                    "Thoughts": response_json["Thoughts"],
-                    "Is_ROI": response_json["ROI"]
-                })
-                if response_json["ROI"] == "Yes":
-                    shutil.copy(image, os.path.join(ROI_FOLDER, image.split('_')[-1]))
-                else:
-                    shutil.copy(image, os.path.join(NOT_ROI_FOLDER, image.split('_')[-1]))
-            except:
-                print(image)
-                roi_descriptions.append({
-                    "ROI": 'ROI_' + image.split('_')[-1].replace('.png', ''),
-                    "Error": response_str
-                })
+        # Tiles of several patients may be interleaved; a patient's JSON is written once all its tiles are sorted
+        roi_descriptions = {patient: [] for patient in tile_counts}
+        sorter = TileSorter(output_mode)
+        manifest = ManifestWriter(os.path.join(OUT_DIR, 'manifest.csv'))
+        patient_folders = {patient: make_patient_folders(OUT_DIR, patient) for patient in tile_counts}
+        for patient, count in tile_counts.items():
+            if count == 0:
+                write_json_atomic(os.path.join(OUT_DIR, patient + '.json'), roi_descriptions.pop(patient))
+    
+        classify = lambda images: classify_tiles(client = client, images = images, example_images_ROI = example_images_ROI, example_images_NOT_ROI = example_images_NOT_ROI,
+                                                 max_tokens = 1000, temperature = 0.2, model_name = model_name, max_in_flight = max_in_flight, store = store,
+                                                 prompt_hash = prompt_hash, structured_output = structured_output, prefilter = prefilter, streaming = streaming,
+                                                 prefetcher = prefetcher, dedup = dedup, tiles_per_request = tiles_per_request if run_mode == 'interactive' else 1)
+        if sample_tiles and run_mode == 'interactive' and not streamZipFiles:
+            results = (result for images in patient_images.values()
+                       for result in sample_slide(images, classify, target_rois_per_patient, sampling_stride, sampling_tissue_threshold))
+        else:
+            results = ((image, response_str, triage, None) for image, response_str, triage in classify(tiles))
+        for image, response_str, triage, sampling in tqdm(results, total = sum(tile_counts.values())):
+            patient = tile_patient(image)
+            ROI_FOLDER, NOT_ROI_FOLDER = patient_folders[patient]
+            roi_descriptions[patient].append(sort_tile(image, response_str, ROI_FOLDER, NOT_ROI_FOLDER, sorter, manifest, triage, sampling))
+            if len(roi_descriptions[patient]) == tile_counts[patient]:
+                write_json_atomic(os.path.join(OUT_DIR, patient + '.json'), roi_descriptions.pop(patient))
+        sorter.close()
+        manifest.close()
             
-        with open(patient_output_folder, "w", encoding="utf-8") as f:
-            json.dump(roi_descriptions, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+        print(api_client.histogram.summary())
+        print(recorder.format_summary())
+        recorder.write_prometheus(os.path.join(OUT_DIR, 'metrics.prom'))
+        recorder.close()
+        if use_response_cache:
+            print(response_cache.stats())
+        if preprocess_images:
+            print(image_preprocessor.stats())
+        if prefilter is not None:
+            print(prefilter.stats())
+        if streaming is not None:
+            print(streaming.stats())
+        if prefetcher is not None:
+            print(prefetcher.stats())
+        if dedup is not None:
+            print(dedup.stats())
\ No newline at end of file
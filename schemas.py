@@ -0,0 +1,72 @@
+# Single definition of the fields the models are asked to return
+
+DIAGNOSIS_FIELDS = [
+    "gedanken",
+    "Qualität des Ausstrichs-Markbröckelchen",
+    "Qualität des Ausstrichs-Zellgehalt",
+    "Erythropoese",
+    "Granulopoese",
+    "Megakaryopoese",
+    "Lymphopoese",
+    "Blastengehalt",
+    "Besonderheiten",
+    "Diagnose",
+]
+
+# Spellings used by older prompts (and by the Maverick prompt) mapped to the canonical field
+DIAGNOSIS_FIELD_ALIASES = {
+    "Blasentgehalt": "Blastengehalt",
+    "Qualität des Ausstrichs-Bröckelchen": "Qualität des Ausstrichs-Markbröckelchen",
+}
+
+ROI_FIELDS = ["Thoughts", "ROI"]
+
+def normalize_key(key):
+    return " ".join(key.split()).casefold()
+
+def canonical_field(key, fields=DIAGNOSIS_FIELDS, aliases=DIAGNOSIS_FIELD_ALIASES):
+    # Map a key as written by the model to its schema field, tolerating case,
+    # whitespace and known spelling drift; unknown keys are returned unchanged.
+    normalized = normalize_key(key)
+    for alias, field in aliases.items():
+        if normalize_key(alias) == normalized:
+            return field
+    for field in fields:
+        if normalize_key(field) == normalized:
+            return field
+    return key.strip()
+
+STRUCTURED_OUTPUT_MODES = [None, 'json_schema', 'guided_json', 'json_object']
+
+def json_schema(fields, enums=None):
+    enums = enums or {}
+    properties = {}
+    for field in fields:
+        properties[field] = {"type": "string", "enum": enums[field]} if field in enums else {"type": "string"}
+    return {"type": "object", "properties": properties, "required": list(fields), "additionalProperties": False}
+
+DIAGNOSIS_JSON_SCHEMA = json_schema(DIAGNOSIS_FIELDS)
+ROI_JSON_SCHEMA = json_schema(ROI_FIELDS, enums={"ROI": ["Yes", "No"]})
+# Same fields with the decision generated before the reasoning (grammar-based decoders follow the property order)
+ROI_DECISION_FIRST_JSON_SCHEMA = json_schema(ROI_FIELDS[::-1], enums={"ROI": ["Yes", "No"]})
+
+def structured_output_kwargs(schema, name, mode):
+    # Extra chat.completions.create arguments that constrain decoding to `schema`:
+    # 'json_schema' uses OpenAI-style structured outputs, 'guided_json' vLLM's
+    # guided decoding and 'json_object' plain JSON mode. None keeps free-form output.
+    if mode not in STRUCTURED_OUTPUT_MODES:
+        raise ValueError(f"Unknown structured output mode {mode}, expected one of {STRUCTURED_OUTPUT_MODES}.")
+    if mode == 'json_schema':
+        return {"response_format": {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}}
+    if mode == 'guided_json':
+        return {"extra_body": {"guided_json": schema}}
+    if mode == 'json_object':
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+def roi_batch_json_schema(n_tiles):
+    # {"Tiles": [{"Tile": 1, "Thoughts": ..., "ROI": ...}, ...]} with exactly n_tiles entries
+    tile = json_schema(["Tile"] + ROI_FIELDS, enums={"ROI": ["Yes", "No"]})
+    tile["properties"]["Tile"] = {"type": "integer"}
+    return {"type": "object", "properties": {"Tiles": {"type": "array", "items": tile, "minItems": n_tiles, "maxItems": n_tiles}},
+            "required": ["Tiles"], "additionalProperties": False}
@@ -0,0 +1,78 @@
+import re
+import json
+import statistics
+from collections import Counter
+from output_parser import parse_diagnosis
+from schemas import DIAGNOSIS_FIELDS
+
+# Aggregation of several sampled diagnoses of the same patient (self-consistency):
+# the majority "Diagnose", the median "Blastengehalt" and a dispersion score per
+# field. For text fields the dispersion is the share of samples that disagree
+# with the most common answer (0 when all agree), for "Blastengehalt" the mean
+# absolute deviation from the median in percentage points (the median absolute
+# deviation is 0 for three of five samples agreeing). "gedanken" is free
+# reasoning and never agrees verbatim, so it gets no score.
+
+NUMBER = r'(\d+(?:[.,]\d+)?)'
+PERCENT_RANGE = re.compile(NUMBER + r'\s*(?:-|–|bis)\s*' + NUMBER)
+PERCENT = re.compile(NUMBER)
+DISPERSION_FIELDS = [field for field in DIAGNOSIS_FIELDS if field != "gedanken"]
+
+def parse_percentage(value):
+    # '45 %', 'ca. 30-40%', '<5 %' -> 45.0, 35.0, 5.0; a range counts as its midpoint
+    if value is None:
+        return None
+    text = str(value)
+    match = PERCENT_RANGE.search(text)
+    if match is not None:
+        low, high = (float(number.replace(',', '.')) for number in match.groups())
+        return (low + high) / 2
+    match = PERCENT.search(text)
+    return float(match.group(1).replace(',', '.')) if match is not None else None
+
+def normalize_answer(value):
+    # Case, punctuation and whitespace do not make two answers different
+    if value is None:
+        return None
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return " ".join(re.sub(r'[^\w%]+', ' ', text.casefold()).split())
+
+def majority(values):
+    # (most common normalized answer, its count); ties go to the answer seen first
+    counts = Counter(normalize_answer(value) for value in values)
+    return counts.most_common(1)[0] if counts else (None, 0)
+
+def aggregate_diagnoses(samples):
+    # Returns (diagnose, consistency). `diagnose` is the sample that has the
+    # majority "Diagnose" and a "Blastengehalt" closest to the median, as a JSON
+    # string with "Blastengehalt" set to the median; `consistency` holds the
+    # votes, the parsed percentages and the per-field dispersion.
+    parsed = [parse_diagnosis(sample)[0] for sample in samples]
+    winner, _ = majority([values.get("Diagnose") for values in parsed])
+    blasts = [parse_percentage(values.get("Blastengehalt")) for values in parsed]
+    known = [blast for blast in blasts if blast is not None]
+    median = statistics.median(known) if known else None
+    candidates = [i for i, values in enumerate(parsed) if normalize_answer(values.get("Diagnose")) == winner]
+    best = min(candidates, key=lambda i: abs(blasts[i] - median) if blasts[i] is not None and median is not None else float('inf'))
+    diagnose = {field: value for field, value in parsed[best].items() if field in DIAGNOSIS_FIELDS}
+    if median is not None:
+        diagnose["Blastengehalt"] = f"{median:g} %"
+    dispersion = {}
+    for field in DISPERSION_FIELDS:
+        if field == "Blastengehalt":
+            dispersion[field] = round(statistics.fmean(abs(blast - median) for blast in known), 2) if known else None
+        else:
+            dispersion[field] = round(1 - majority([values.get(field) for values in parsed])[1] / len(parsed), 3)
+    # Votes per normalized answer, shown with its first spelling
+    spellings = {}
+    for values in parsed:
+        spellings.setdefault(normalize_answer(values.get("Diagnose")), values.get("Diagnose"))
+    votes = {str(spellings[answer]): count for answer, count in Counter(normalize_answer(values.get("Diagnose")) for values in parsed).most_common()}
+    consistency = {"Samples": len(samples), "Diagnose_Votes": votes, "Blastengehalt_Values": blasts, "Dispersion": dispersion}
+    return json.dumps(diagnose, ensure_ascii=False), consistency
+
+def consistency_columns(consistency):
+    # Extra results table columns (see CONSISTENCY_RESULT_FIELDS)
+    dispersion = consistency["Dispersion"]
+    return {"Samples": consistency["Samples"], "Diagnose_Dispersion": dispersion["Diagnose"],
+            "Blastengehalt_Dispersion": dispersion["Blastengehalt"], "Dispersion": json.dumps(dispersion, ensure_ascii=False)}
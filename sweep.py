@@ -0,0 +1,176 @@
+import os
+import csv
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from tqdm import tqdm
+import evaluate_AML_All_In as all_in
+from image_preprocessing import ImagePreprocessor
+from instrumentation import CallRecorder, InstrumentedClient
+from llm_client import create_client, create_structured
+from response_cache import ResponseCache, CachingClient
+from result_store import ResultStore, get_run_dir, hash_files, hash_messages, make_key, write_json_atomic
+from results_table import ResultsTable, SWEEP_RESULT_FIELDS, export_excel
+from schemas import DIAGNOSIS_JSON_SCHEMA
+
+# Runs the All_In diagnosis prompt for several models in one run. Every
+# patient's ROIs are listed, hashed and encoded once and then sent to all
+# models, each through its own client and thread pool.
+
+class ModelStats:
+    # Patients served from the result store and failed patients; requests, latency
+    # and tokens come from the CallRecorder, which only sees calls that reached the server
+    def __init__(self):
+        self.cached = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+def model_summary(model, stats, server, response_cached = 0):
+    # `server` is the model's merged StageStats (CallRecorder.model_stats).
+    # Prices are per million tokens and default to 0 for self-hosted models
+    cost = (server.prompt_tokens * model.get("usd_per_1m_prompt_tokens", 0)
+            + server.completion_tokens * model.get("usd_per_1m_completion_tokens", 0)) / 1e6
+    return {"Model": model["name"], "Model_Name": model["model"], "Requests": server.requests, "Cached": stats.cached,
+            "Response_Cached": response_cached, "Errors": stats.errors,
+            "Latency_p50": server.latency.percentile(50), "Latency_p95": server.latency.percentile(95), "Latency_p99": server.latency.percentile(99),
+            "Prompt_Tokens": server.prompt_tokens, "Completion_Tokens": server.completion_tokens, "Cost_USD": round(cost, 4)}
+
+def diagnose_patient(model, client, stats, key, encoded_images, store, max_tokens, temperature, structured_output = None):
+    if key in store:
+        with stats.lock:
+            stats.cached += 1
+        return store.get(key)
+    response = create_structured(client, structured_output, DIAGNOSIS_JSON_SCHEMA, 'diagnosis',
+                                 model = model["model"],
+                                 messages = all_in.build_diagnose_messages(encoded_images),
+                                 max_tokens = max_tokens,
+                                 temperature = temperature)
+    diagnose = response.choices[0].message.content
+    store.put(key, diagnose)
+    return diagnose
+
+def run_sweep(models, clients, recorder, patients, image_dir, out_dir, store, prompt_hash, max_patients_in_flight = 4,
+              max_tokens = 2000, temperature = 0.2, structured_output = None):
+    # Encoded images are kept for at most `max_patients_in_flight` patients; a
+    # patient's rows are written once every model has answered it. `recorder` is
+    # the CallRecorder of the models' InstrumentedClients, labelled with the model's name.
+    stats = {model["name"]: ModelStats() for model in models}
+    executors = {model["name"]: ThreadPoolExecutor(max_workers = model.get("max_in_flight", 4)) for model in models}
+    table_path = os.path.join(out_dir, 'results.parquet')
+    results_table = ResultsTable(table_path, fields = SWEEP_RESULT_FIELDS)
+    for model in models:
+        os.makedirs(os.path.join(out_dir, 'diagnose', model["name"]), exist_ok = True)
+
+    def finish(patient, futures):
+        for model, future in futures:
+            entry = {"Patient": patient, "Model": model["name"]}
+            try:
+                entry["Ergebnis"] = future.result()
+            except Exception as error:
+                print(f"{model['name']} failed for {patient}: {error}")
+                with stats[model["name"]].lock:
+                    stats[model["name"]].errors += 1
+                entry["Ergebnis"] = None
+                entry["Error"] = str(error)
+            write_json_atomic(os.path.join(out_dir, 'diagnose', model["name"], patient + '.json'), entry)
+            results_table.add_diagnosis(patient, entry["Ergebnis"], Model = model["name"])
+
+    pending = deque()
+    try:
+        for patient in tqdm(patients):
+            images = all_in.load_images(image_dir = image_dir, patient = patient)
+            images_hash = hash_files(images)
+            # Keyed on the name: two entries may serve the same model from different endpoints
+            keys = {model["name"]: make_key(patient, images_hash, model["name"], prompt_hash) for model in models}
+            encoded_images = None
+            if any(key not in store for key in keys.values()):
+                encoded_images = [
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{all_in.encode_image(path)}"}}
+                    for path in images
+                ]
+            futures = [(model, executors[model["name"]].submit(diagnose_patient, model, clients[model["name"]], stats[model["name"]], keys[model["name"]],
+                                                               encoded_images, store, max_tokens, temperature, structured_output))
+                       for model in models]
+            pending.append((patient, futures))
+            while len(pending) > max_patients_in_flight:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+        results_table.close()
+    return table_path, [model_summary(model, stats[model["name"]], recorder.model_stats(model["name"]), getattr(clients[model["name"]], "hits", 0))
+                        for model in models]
+
+def write_summary(summary, output_file):
+    with open(output_file, 'w', newline = '', encoding = 'utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames = list(summary[0].keys()))
+        writer.writeheader()
+        writer.writerows(summary)
+
+if __name__ == "__main__":
+
+    MAIN_DIR = '/mnt/bulk-ganymede/narmin/narmin/AML_Project'
+    IMG_DIR = '/mnt/bulk-saturn/chiara/chiara/03_WSI/ROIs_manuell_Lara/AML_Box_1'
+    # Each model gets its own client and concurrency limit; prices are optional
+    models = [
+        {"name": "medgemma-27b", "model": "medgemma-27b-it-q6", "base_url": 'http://192.168.33.27/v1', "max_in_flight": 4},
+        {"name": "maverick", "model": "Llama-4-Maverick-17B-128E-Instruct-FP8", "base_url": 'http://192.168.33.27/v1', "max_in_flight": 8},
+    ]
+    max_patients_in_flight = 4
+    resume_run = None
+    # Off by default: with the cache on, rerunning the same request returns the stored answer instead of a new sample
+    use_response_cache = False
+    cache_only = False
+    preprocess_images = False
+    structured_output = None
+    requests_per_second = None
+    export_results_excel = True
+
+    TABLE_DIR = MAIN_DIR + '/tables'
+    OUT_DIR = MAIN_DIR + '/output'
+    os.makedirs(OUT_DIR, exist_ok = True)
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    OUT_DIR = get_run_dir(OUT_DIR, f"sweep_{timestamp}", resume_run)
+    store = ResultStore(os.path.join(OUT_DIR, 'results_store.jsonl'))
+    write_json_atomic(os.path.join(OUT_DIR, 'models.json'), models)
+
+    patients = all_in.get_patient_names(clini_table = TABLE_DIR + '/random_50_patients.csv')
+
+    with open('/mnt/bulk-ganymede/narmin/narmin/MSI_LLM/key.json', 'r') as f:
+        config = json.load(f)
+
+    if use_response_cache:
+        response_cache = ResponseCache(os.path.join(MAIN_DIR, 'response_cache'), cache_only = cache_only)
+    recorder = CallRecorder(os.path.join(OUT_DIR, 'model_calls.jsonl'))
+    clients = {}
+    for model in models:
+        client = create_client(api_key = config[model.get("api_key", 'Pluto')], base_url = model["base_url"], max_connections = model.get("max_in_flight", 4),
+                               requests_per_second = model.get("requests_per_second", requests_per_second))
+        client = InstrumentedClient(client, recorder, label = model["name"])
+        clients[model["name"]] = CachingClient(client, response_cache) if use_response_cache else client
+    if preprocess_images:
+        all_in.image_preprocessor = ImagePreprocessor(max_side = 1024, jpeg_quality = 85, cache_dir = os.path.join(MAIN_DIR, 'preprocessed_images'))
+
+    # Same prompt hash as evaluate_AML_All_In
+    prompt_hash = hash_messages(all_in.build_diagnose_messages([]))
+    if preprocess_images:
+        prompt_hash = hash_messages([prompt_hash, all_in.image_preprocessor.settings()])
+    if structured_output is not None:
+        prompt_hash = hash_messages([prompt_hash, structured_output])
+
+    table_path, summary = run_sweep(models, clients, recorder, patients, IMG_DIR, OUT_DIR, store, prompt_hash, max_patients_in_flight = max_patients_in_flight,
+                                    structured_output = structured_output)
+    write_summary(summary, os.path.join(OUT_DIR, 'sweep_summary.csv'))
+    for row in summary:
+        print(row)
+    print(recorder.format_summary())
+    recorder.write_prometheus(os.path.join(OUT_DIR, 'metrics.prom'))
+    recorder.close()
+    if use_response_cache:
+        print(response_cache.stats())
+    if export_results_excel:
+        export_excel(table_path, os.path.join(OUT_DIR, 'results.xlsx'), fields = SWEEP_RESULT_FIELDS)
@@ -0,0 +1,178 @@
+import io
+import os
+import json
+import threading
+from collections import deque
+import numpy as np
+from PIL import Image
+from tile_sources import read_tile, tile_name, tile_patient
+
+# Near-duplicate tiles (re-extracted archives, heavily overlapping neighbours)
+# are grouped by a 64-bit perceptual hash: tiles of the same patient within
+# `threshold` differing bits share one is_roi decision. Only the first tile of
+# a group (its representative) is classified. The index is appended to a JSONL
+# file, so representatives of earlier runs are matched too and their stored
+# answers reused.
+
+HASH_METHODS = ['phash', 'dhash']
+
+def load_grey(data, size):
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (size[0] * 4, size[1] * 4))
+        return np.asarray(image.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+
+def dct_matrix(n):
+    k = np.arange(n)[:, None]
+    return np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+
+DCT_32 = dct_matrix(32)
+
+def bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+def dhash(data):
+    # Sign of the horizontal gradient on a 9x8 thumbnail
+    grey = load_grey(data, (9, 8))
+    return bits_to_int(grey[:, 1:] > grey[:, :-1])
+
+def phash(data):
+    # Lowest 8x8 DCT coefficients of a 32x32 thumbnail against their median (DC term excluded)
+    grey = load_grey(data, (32, 32))
+    low = (DCT_32 @ grey @ DCT_32.T)[:8, :8]
+    return bits_to_int(low > np.median(low.ravel()[1:]))
+
+def hamming(hashes, value):
+    # Differing bits between every hash in a uint64 array and `value`
+    return np.unpackbits((hashes ^ np.uint64(value)).view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+class PatientHashes:
+    # Growable uint64 array of a patient's representative hashes with their index entries
+    def __init__(self):
+        self.hashes = np.empty(64, dtype=np.uint64)
+        self.entries = []
+
+    def add(self, value, entry):
+        if len(self.entries) == len(self.hashes):
+            self.hashes = np.concatenate([self.hashes, np.empty(len(self.hashes), dtype=np.uint64)])
+        self.hashes[len(self.entries)] = value
+        self.entries.append(entry)
+
+    def nearest(self, value):
+        if not self.entries:
+            return None, None
+        distances = hamming(self.hashes[:len(self.entries)], value)
+        best = int(distances.argmin())
+        return self.entries[best], int(distances[best])
+
+class TileDeduplicator:
+    def __init__(self, path=None, threshold=4, method='phash'):
+        if method not in HASH_METHODS:
+            raise ValueError(f"Unknown hash method {method}, expected one of {HASH_METHODS}.")
+        self.path = path
+        self.threshold = threshold
+        self.method = method
+        self.hash = phash if method == 'phash' else dhash
+        self.patients = {}
+        self.lock = threading.Lock()
+        self.counts = {"tiles": 0, "representatives": 0, "duplicates": 0, "reused_from_index": 0, "unhashable": 0}
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry.get("method") == method:
+                        self.patients.setdefault(entry["patient"], PatientHashes()).add(int(entry["hash"], 16), entry)
+
+    def settings(self):
+        return {"threshold": self.threshold, "method": self.method}
+
+    def add(self, patient, value, entry):
+        entry = {"patient": patient, "hash": f"{value:016x}", "method": self.method, **entry}
+        with self.lock:
+            self.patients.setdefault(patient, PatientHashes()).add(value, entry)
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+    def classify(self, tiles, classify, key_of=None, store=None):
+        # Yields (tile, response, triage) for every tile like classify_tiles, which
+        # `classify(representatives, loaded)` wraps; it only sees the representatives,
+        # and `loaded` hands on the bytes read for hashing, keyed by (patient, tile
+        # name), so classify_tiles does not read the tiles again. Duplicates come out as
+        # soon as their representative's answer is known, with a triage record
+        # {"Triage": "duplicate", "Duplicate_Of", "Hamming"} for the manifest.
+        # key_of(tile, data) gives a representative's result store key, which is
+        # what lets later runs reuse its answer.
+        ready = deque()
+        waiting = {}
+        responses = {}
+        loaded = {}
+
+        def duplicate(tile, entry, distance, response):
+            with self.lock:
+                self.counts["duplicates"] += 1
+            return tile, response, {"Triage": "duplicate", "Duplicate_Of": entry["tile"], "Hamming": distance}
+
+        def representatives():
+            for tile in tiles:
+                patient = tile_patient(tile)
+                data = read_tile(tile)
+                with self.lock:
+                    self.counts["tiles"] += 1
+                try:
+                    value = self.hash(data)
+                except (OSError, ValueError):
+                    with self.lock:
+                        self.counts["unhashable"] += 1
+                    loaded[(patient, tile_name(tile))] = data
+                    yield tile
+                    continue
+                with self.lock:
+                    entry, distance = self.patients[patient].nearest(value) if patient in self.patients else (None, None)
+                if entry is not None and entry["tile"] == tile_name(tile):
+                    # The tile is a representative from an earlier run (a resumed run); it stays one
+                    with self.lock:
+                        self.counts["representatives"] += 1
+                    waiting.setdefault((patient, entry["tile"]), [])
+                    loaded[(patient, tile_name(tile))] = data
+                    yield tile
+                    continue
+                if entry is not None and distance <= self.threshold:
+                    group = (patient, entry["tile"])
+                    if group in responses:
+                        ready.append(duplicate(tile, entry, distance, responses[group]))
+                        continue
+                    if group in waiting:
+                        waiting[group].append((tile, entry, distance))
+                        continue
+                    if store is not None and entry.get("key") in store:
+                        with self.lock:
+                            self.counts["reused_from_index"] += 1
+                        ready.append(duplicate(tile, entry, distance, store.get(entry["key"])))
+                        continue
+                    # A representative of an earlier run without a stored answer: this tile takes its place
+                self.add(patient, value, {"tile": tile_name(tile), "key": key_of(tile, data) if key_of is not None else None})
+                with self.lock:
+                    self.counts["representatives"] += 1
+                waiting[(patient, tile_name(tile))] = []
+                loaded[(patient, tile_name(tile))] = data
+                yield tile
+
+        for tile, response, triage in classify(representatives(), loaded):
+            group = (tile_patient(tile), tile_name(tile))
+            responses[group] = response
+            yield tile, response, triage
+            for dup, entry, distance in waiting.pop(group, []):
+                yield duplicate(dup, entry, distance, response)
+            while ready:
+                yield ready.popleft()
+        while ready:
+            yield ready.popleft()
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return {**counts, "model_call_fraction": counts["representatives"] / counts["tiles"] if counts["tiles"] else None}
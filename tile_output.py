@@ -0,0 +1,118 @@
+import os
+import re
+import csv
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from tile_sources import ZipTile, materialize_tile
+
+OUTPUT_MODES = ['copy', 'hardlink', 'symlink', 'manifest']
+MANIFEST_FIELDS = ['Patient', 'Tile', 'X', 'Y', 'Is_ROI', 'Thoughts', 'Sampling', 'Triage', 'Background', 'Tissue', 'Dark', 'Focus', 'Saturation', 'Stain',
+                   'Duplicate_Of', 'Hamming']
+MANIFEST_FLOAT_FIELDS = ('X', 'Y', 'Background', 'Tissue', 'Dark', 'Focus', 'Saturation', 'Stain', 'Hamming')
+
+def parse_tile_coordinates(name):
+    # Tiles are named 'tile_(x, y).jpg'
+    match = re.search(r'\(\s*([-+\d.eE]+)\s*,\s*([-+\d.eE]+)\s*\)', os.path.basename(name))
+    if match is None:
+        return None, None
+    return float(match.group(1)), float(match.group(2))
+
+def place_tile(tile, destination, mode):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if mode == 'copy' or isinstance(tile, ZipTile):
+        # Zip tiles have no file on disk to link to
+        materialize_tile(tile, destination)
+    elif mode == 'hardlink':
+        try:
+            os.link(tile, destination)
+        except OSError:
+            # Hardlinks cannot cross filesystems
+            shutil.copy(tile, destination)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(tile), destination)
+
+class TileSorter:
+    # Places classified tiles into the ROIs/NOT_ROIs folders according to `mode`
+    # on a background pool, so file I/O never blocks the inference loop.
+    # In 'manifest' mode nothing is written besides the manifest.
+    def __init__(self, mode='copy', max_workers=4, max_pending=64):
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode {mode}, expected one of {OUTPUT_MODES}.")
+        self.mode = mode
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if mode != 'manifest' else None
+        self.futures = []
+
+    def place(self, tile, destination):
+        if self.executor is None:
+            return
+        # Surface failed placements early and keep the backlog (and zip tile bytes) bounded
+        pending = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        while len(pending) >= self.max_pending:
+            pending.pop(0).result()
+        pending.append(self.executor.submit(place_tile, tile, destination, self.mode))
+        self.futures = pending
+
+    def close(self):
+        if self.executor is None:
+            return
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+
+class ManifestWriter:
+    # Collects one row per tile and appends them to a CSV manifest every
+    # `batch_size` rows. A '.parquet' path is a directory instead: every flushed
+    # batch becomes its own complete part file (written to a temp name and
+    # renamed), so a run that dies part-way leaves readable parts for the rows it
+    # flushed; read them back with results_table.iter_table_rows. A resumed run
+    # re-emits every tile, so an existing manifest is replaced. Parquet columns
+    # are strings except for `float_fields`.
+    def __init__(self, path, batch_size=500, fields=MANIFEST_FIELDS, float_fields=MANIFEST_FLOAT_FIELDS):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.batch_size = batch_size
+        self.fields = fields
+        self.float_fields = float_fields
+        self.rows = []
+        self.parts = 0
+        if path.endswith('.parquet'):
+            os.makedirs(path)
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([(field, pa.float64() if field in self.float_fields else pa.string()) for field in self.fields])
+            table = pa.Table.from_pylist([{field: row.get(field) for field in self.fields} for row in self.rows], schema=schema)
+            part = os.path.join(self.path, f'part-{self.parts:06d}.parquet')
+            pq.write_table(table, part + '.tmp')
+            os.replace(part + '.tmp', part)
+            self.parts += 1
+        else:
+            write_header = not os.path.exists(self.path)
+            with open(self.path, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=self.fields, extrasaction='ignore')
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
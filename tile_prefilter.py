@@ -0,0 +1,96 @@
+import io
+import threading
+import numpy as np
+from PIL import Image
+
+# Cheap image-quality triage in front of is_roi. Tiles are decoded at reduced
+# size and scored with a few vectorized metrics; clear negatives (background,
+# blur, too little tissue) are rejected without a model call and, optionally,
+# clear positives are accepted. Everything else goes to the model.
+#
+# The thresholds are starting points; the metrics of every tile are written to
+# the manifest so they can be calibrated against the model's decisions.
+DEFAULT_THRESHOLDS = {
+    # Reject if any of these hold
+    "reject_background": 0.85,   # fraction of bright, unstained pixels
+    "reject_tissue": 0.10,       # fraction of stained, non-debris pixels
+    "reject_focus": 25.0,        # variance of the Laplacian of the grey image
+    # Accept (only with auto_accept) if all of these hold
+    "accept_tissue": 0.80,
+    "accept_focus": 150.0,
+    "accept_saturation": 0.20,   # mean saturation of the tissue pixels
+    "accept_dark": 0.05,         # fraction of near-black debris pixels
+}
+
+TRIAGE_METRICS = ["Background", "Tissue", "Dark", "Focus", "Saturation", "Stain"]
+
+def load_pixels(data, max_side=256):
+    # JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale, which is much cheaper than a full decode
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("RGB", (max_side, max_side))
+        image = image.convert("RGB")
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side))
+        return np.asarray(image, dtype=np.float32)
+
+def tile_metrics(pixels):
+    grey = pixels @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    high = pixels.max(axis=-1)
+    low = pixels.min(axis=-1)
+    saturation = (high - low) / np.maximum(high, 1.0)
+    background = (grey > 215) & (saturation < 0.10)
+    dark = grey < 40
+    tissue = ~background & ~dark
+    laplacian = grey[:-2, 1:-1] + grey[2:, 1:-1] + grey[1:-1, :-2] + grey[1:-1, 2:] - 4 * grey[1:-1, 1:-1]
+    n_tissue = tissue.sum()
+    return {
+        "Background": float(background.mean()),
+        "Tissue": float(tissue.mean()),
+        "Dark": float(dark.mean()),
+        "Focus": float(laplacian.var()),
+        "Saturation": float(saturation[tissue].mean()) if n_tissue else 0.0,
+        "Stain": float(1 - grey[tissue].mean() / 255) if n_tissue else 0.0,
+    }
+
+def triage(metrics, thresholds=DEFAULT_THRESHOLDS, auto_accept=False):
+    # Returns ('reject' | 'accept' | 'model', reason)
+    if metrics["Background"] >= thresholds["reject_background"]:
+        return "reject", f"background {metrics['Background']:.2f}"
+    if metrics["Tissue"] < thresholds["reject_tissue"]:
+        return "reject", f"tissue coverage {metrics['Tissue']:.2f}"
+    if metrics["Focus"] < thresholds["reject_focus"]:
+        return "reject", f"out of focus ({metrics['Focus']:.1f})"
+    if (auto_accept and metrics["Tissue"] >= thresholds["accept_tissue"] and metrics["Focus"] >= thresholds["accept_focus"]
+            and metrics["Saturation"] >= thresholds["accept_saturation"] and metrics["Dark"] <= thresholds["accept_dark"]):
+        return "accept", f"tissue coverage {metrics['Tissue']:.2f}, focus {metrics['Focus']:.1f}"
+    return "model", ""
+
+class TilePrefilter:
+    def __init__(self, thresholds=None, auto_accept=False, max_side=256):
+        self.thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+        self.auto_accept = auto_accept
+        self.max_side = max_side
+        self.counts = {"reject": 0, "accept": 0, "model": 0, "unreadable": 0}
+        self.lock = threading.Lock()
+
+    def settings(self):
+        return {"thresholds": self.thresholds, "auto_accept": self.auto_accept, "max_side": self.max_side}
+
+    def check(self, data):
+        # Returns (decision, reason, metrics); tiles that cannot be decoded are left to the model
+        try:
+            metrics = tile_metrics(load_pixels(data, self.max_side))
+        except (OSError, ValueError):
+            with self.lock:
+                self.counts["unreadable"] += 1
+            return "model", "", {}
+        decision, reason = triage(metrics, self.thresholds, self.auto_accept)
+        with self.lock:
+            self.counts[decision] += 1
+        return decision, reason, metrics
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        return {**counts, "model_call_fraction": (counts["model"] + counts["unreadable"]) / total if total else None}
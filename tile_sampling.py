@@ -0,0 +1,101 @@
+from output_parser import parse_roi_decision
+from tile_output import parse_tile_coordinates
+from tile_sources import tile_name
+
+# Coarse-to-fine sampling of a slide's tiles. Tiles lie on a regular grid
+# ('tile_(x, y).jpg'), and ROIs cluster in the marrow particle areas, so a
+# sparse lattice is classified first and the search then only grows around
+# positive tiles (and, with prefilter metrics, tissue-rich lattice tiles).
+# If that runs dry before the target ROI count is reached, the lattice is
+# refined. Tiles that are never sent to the model are reported as 'inferred'
+# (only negative tiles around them, so taken as No) or 'unvisited'.
+
+def grid_step(values):
+    # Smallest gap between distinct coordinates; empty rows and columns only make gaps larger
+    values = sorted(set(values))
+    gaps = [b - a for a, b in zip(values, values[1:]) if b - a > 1e-6]
+    return min(gaps) if gaps else 1.0
+
+def is_roi_response(response_str):
+    values, _ = parse_roi_decision(response_str)
+    return str(values.get("ROI", "")).strip().capitalize() == "Yes"
+
+class SlideGrid:
+    # Spatial index of one slide: grid cell (column, row) -> tile. Tiles without
+    # parseable coordinates, or sharing a cell, are kept in `unplaced`.
+    def __init__(self, tiles):
+        coordinates = [(tile, *parse_tile_coordinates(tile_name(tile))) for tile in tiles]
+        placed = [(tile, x, y) for tile, x, y in coordinates if x is not None]
+        self.unplaced = [tile for tile, x, _ in coordinates if x is None]
+        self.cells = {}
+        if not placed:
+            return
+        x0 = min(x for _, x, _ in placed)
+        y0 = min(y for _, _, y in placed)
+        self.step = (grid_step([x for _, x, _ in placed]), grid_step([y for _, _, y in placed]))
+        for tile, x, y in placed:
+            cell = (round((x - x0) / self.step[0]), round((y - y0) / self.step[1]))
+            if cell in self.cells:
+                self.unplaced.append(tile)
+            else:
+                self.cells[cell] = tile
+
+    def lattice(self, stride):
+        return [cell for cell in sorted(self.cells) if cell[0] % stride == 0 and cell[1] % stride == 0]
+
+    def neighbors(self, cell, radius=1):
+        column, row = cell
+        return [(column + dx, row + dy) for dx in range(-radius, radius + 1) for dy in range(-radius, radius + 1)
+                if (dx or dy) and (column + dx, row + dy) in self.cells]
+
+def sample_slide(tiles, classify, target_rois, stride=4, tissue_threshold=None):
+    # Yields (tile, response, triage, stage) for every tile of the slide. `classify`
+    # takes a list of tiles and yields (tile, response, triage) like classify_tiles;
+    # it is called once per wave, so the requests of a wave run concurrently. A wave
+    # is always finished, the target is checked between waves. Skipped tiles come
+    # last with response None and stage 'inferred' or 'unvisited'.
+    grid = SlideGrid(tiles)
+    cell_of = {id(tile): cell for cell, tile in grid.cells.items()}
+    visited = {}
+    positives = 0
+    expanded = set()
+    # Cell -> sampling stage of the tiles in the current wave
+    wave = dict.fromkeys(grid.lattice(stride), 'lattice')
+    if grid.unplaced:
+        # Without a position they cannot be sampled, so they are classified up front
+        for tile, response_str, triage in classify(grid.unplaced):
+            positives += is_roi_response(response_str)
+            yield tile, response_str, triage, 'lattice'
+    while wave and positives < target_rois:
+        tissue_cells = []
+        for tile, response_str, triage in classify([grid.cells[cell] for cell in wave]):
+            cell = cell_of[id(tile)]
+            visited[cell] = is_roi_response(response_str)
+            positives += visited[cell]
+            if (tissue_threshold is not None and wave[cell] in ('lattice', 'refine') and not visited[cell]
+                    and (triage or {}).get("Tissue", 0) >= tissue_threshold):
+                tissue_cells.append(cell)
+            yield tile, response_str, triage, wave[cell]
+        if positives >= target_rois:
+            break
+        # Grow around every positive tile not expanded yet, then around tissue-rich lattice tiles
+        frontier = {}
+        sources = [(cell, 'neighbor') for cell, positive in visited.items() if positive and cell not in expanded]
+        for cell, stage in sources + [(cell, 'tissue') for cell in tissue_cells]:
+            expanded.add(cell)
+            for neighbor in grid.neighbors(cell):
+                if neighbor not in visited:
+                    frontier.setdefault(neighbor, stage)
+        if frontier:
+            wave = frontier
+        elif stride > 1:
+            stride //= 2
+            wave = dict.fromkeys([cell for cell in grid.lattice(stride) if cell not in visited], 'refine')
+        else:
+            wave = {}
+    # A skipped tile is inferred negative when the visited tiles within the last lattice spacing are all negative
+    for cell, tile in grid.cells.items():
+        if cell in visited:
+            continue
+        around = [visited[neighbor] for neighbor in grid.neighbors(cell, stride) if neighbor in visited]
+        yield tile, None, None, 'inferred' if around and not any(around) else 'unvisited'
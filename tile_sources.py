@@ -0,0 +1,87 @@
+import os
+import queue
+import shutil
+import zipfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# A tile read straight out of a feature-cache archive; `data` holds the JPEG bytes
+ZipTile = namedtuple("ZipTile", ["patient", "name", "data"])
+
+def zip_patient(zip_path):
+    return os.path.basename(zip_path).split('.')[0]
+
+def zip_tile_members(zip_ref):
+    return [info for info in zip_ref.infolist() if not info.is_dir() and info.filename.endswith('.jpg')]
+
+def count_zip_tiles(zip_path):
+    # Only reads the archive's central directory
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        return len(zip_tile_members(zip_ref))
+
+def iter_zip_tiles(zip_path):
+    patient = zip_patient(zip_path)
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for info in zip_tile_members(zip_ref):
+            yield ZipTile(patient, os.path.basename(info.filename), zip_ref.read(info))
+
+def stream_zip_tiles(zip_paths, max_workers=4, max_queued=256):
+    # Reads up to `max_workers` archives in parallel into a bounded queue.
+    # Tiles of one archive keep their order; archives are interleaved.
+    tiles = queue.Queue(maxsize=max_queued)
+    done = object()
+    stop = threading.Event()
+
+    def read_archive(zip_path):
+        for tile in iter_zip_tiles(zip_path):
+            while not stop.is_set():
+                try:
+                    tiles.put(tile, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+
+    def read_all():
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for future in [executor.submit(read_archive, zip_path) for zip_path in zip_paths]:
+                    future.result()
+            tiles.put(done)
+        except BaseException as error:
+            tiles.put(error)
+
+    threading.Thread(target=read_all, daemon=True).start()
+    try:
+        while True:
+            tile = tiles.get()
+            if tile is done:
+                return
+            if isinstance(tile, BaseException):
+                raise tile
+            yield tile
+    finally:
+        stop.set()
+
+def tile_name(tile):
+    return tile.name if isinstance(tile, ZipTile) else tile
+
+def tile_patient(tile):
+    # Extracted tiles live in IMG_DIR/<patient>/
+    return tile.patient if isinstance(tile, ZipTile) else os.path.basename(os.path.dirname(tile))
+
+def read_tile(tile):
+    if isinstance(tile, ZipTile):
+        return tile.data
+    with open(tile, "rb") as image_file:
+        return image_file.read()
+
+def materialize_tile(tile, destination):
+    # Zip tiles only touch the disk here, when they are sorted into an output folder
+    if isinstance(tile, ZipTile):
+        with open(destination, "wb") as f:
+            f.write(tile.data)
+    else:
+        shutil.copy(tile, destination)
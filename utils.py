@@ -1,34 +1,44 @@
 import os
-import random
+import glob
 import pandas as pd
-random.seed(23)
-# Generate all the patient names
-rois = os.listdir('/mnt/bulk-saturn/chiara/chiara/03_WSI/ROIs_manuell_Lara/AML_Box_1')
-rois = [i for i in rois if 'AML_' in i]
-print(len(rois))
+from image_index import build_image_index
 
-patients = ['_'.join(i.split('_')[0:3]) for i in rois]
-patients = list(set(patients))
-print(len(patients))
+def list_rois(image_dirs, index_file = None, max_workers = 8):
+    # One row per ROI from the shared image index (see image_index.build_image_index), so patient IDs
+    # follow get_patient_id and, with `index_file`, only box directories that changed are rescanned.
+    # Only AML patients are listed.
+    index = build_image_index(image_dirs, index_file = index_file, max_workers = max_workers)
+    rows = [(patient, os.path.basename(os.path.dirname(path)), os.path.basename(path), path)
+            for patient, paths in index.items() if 'AML_' in patient for path in paths]
+    return pd.DataFrame(rows, columns = ["Patient", "Box", "File", "Path"])
 
+def build_cohort(image_dirs, expected_slides = 10, index_file = None, max_workers = 8):
+    # One row per patient with its slide count; a patient is valid when it has exactly `expected_slides` ROIs
+    rois = list_rois(image_dirs, index_file, max_workers)
+    cohort = rois.groupby("Patient").agg(Slides = ("File", "size"), Boxes = ("Box", "nunique"), Box = ("Box", "first")).reset_index()
+    cohort["Valid"] = cohort["Slides"] == expected_slides
+    return cohort.sort_values("Patient", ignore_index = True)
 
-for patient in patients:
-    slides = [i for i in rois if patient+'_' in i]
-    if not len(slides) == 10:
-        patients.remove(patient)
-        print(f'Patient {patient} has {len(slides)} slides, expected 10.')
-        
-print(len(patients))
-
-df = pd.DataFrame(patients, columns=['Patients'])
-#df.to_csv('/mnt/bulk-ganymede/narmin/narmin/AML_Project/tables/all_patients.csv', index=False)
-random_selection = df.sample(n=50, random_state=23)
-#random_selection.to_csv('/mnt/bulk-ganymede/narmin/narmin/AML_Project/tables/random_50_patients.csv', index=False)
-
-
-import yt_dlp
+def write_cohort_tables(cohort, table_dir, sample_size = 50, seed = 23, overwrite = False):
+    # all_patients.csv and random_<n>_patients.csv in the 'Patients' format read by
+    # get_patient_names. Valid patients are sorted before sampling, so the sample
+    # only depends on the cohort and the seed. Existing tables are kept unless overwrite is set.
+    for _, row in cohort[~cohort["Valid"]].iterrows():
+        print(f'Patient {row["Patient"]} skipped: {row["Slides"]} slides.')
+    patients = cohort.loc[cohort["Valid"], ["Patient"]].rename(columns = {"Patient": "Patients"})
+    tables = {
+        os.path.join(table_dir, 'all_patients.csv'): patients,
+        os.path.join(table_dir, f'random_{sample_size}_patients.csv'): patients.sample(n = min(sample_size, len(patients)), random_state = seed),
+    }
+    for path, table in tables.items():
+        if os.path.exists(path) and not overwrite:
+            print(f'{path} exists, not overwritten.')
+            continue
+        table.to_csv(path, index = False)
+    return tables
 
 def download_audio(youtube_url, output_path="downloaded_audio.mp3"):
+    import yt_dlp
     ydl_opts = {
         'format': 'bestaudio/best',
         'outtmpl': output_path,
@@ -44,5 +54,15 @@ def download_audio(youtube_url, output_path="downloaded_audio.mp3"):
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([youtube_url])
 
-# Example usage
-download_audio("https://www.youtube.com/watch?v=VETpylOwwWI&ab_channel=ARIATVCanada%D8%AA%D9%84%D9%88%DB%8C%D8%B2%DB%8C%D9%88%D9%86%D8%A2%D8%B1%DB%8C%D8%A7")
\ No newline at end of file
+if __name__ == "__main__":
+
+    # Every box directory; the listing is persisted in tables/image_index.json and only changed boxes are rescanned
+    IMG_DIRS = sorted(glob.glob('/mnt/bulk-saturn/chiara/chiara/03_WSI/ROIs_manuell_Lara/AML_Box_*'))
+    TABLE_DIR = '/mnt/bulk-ganymede/narmin/narmin/AML_Project/tables'
+    # The evaluation runs read these tables, keep them unless the cohort is meant to change
+    overwrite_tables = False
+    expected_slides = 10
+
+    cohort = build_cohort(IMG_DIRS, expected_slides = expected_slides, index_file = os.path.join(TABLE_DIR, 'image_index.json'))
+    print(f'{cohort["Slides"].sum()} ROIs, {len(cohort)} patients, {cohort["Valid"].sum()} with {expected_slides} slides')
+    write_cohort_tables(cohort, TABLE_DIR, sample_size = 50, seed = 23, overwrite = overwrite_tables)